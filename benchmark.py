@@ -0,0 +1,651 @@
+import argparse
+import gc
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# benchmarks of the experiment pipeline; each one prints its measurements and
+# exits with a non-zero status when it misses its budget
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+#### Parameters #############
+parser = argparse.ArgumentParser()
+parser.add_argument('benchmark', choices=['startup', 'batch', 'prefix', 'continuous', 'replicas', 'draft', 'cpu', 'llama', 'compaction', 'paged', 'attention', 'rope', 'api', 'batch_api', 'retry'])
+parser.add_argument('--repeats', default='5', type=int)
+parser.add_argument('--nb_scenarios', default='16', type=int)
+parser.add_argument('--random_seed', default='123', type=int)
+parser.add_argument('--batch_sizes', default='1,4,16', type=str)
+parser.add_argument('--replicas', default='2', type=int)
+parser.add_argument('--concurrency', default='4', type=int)
+parser.add_argument('--variant', default=None, type=str, help='(cpu) measure this variant only, in this process')
+parser.add_argument('--budget', default=None, type=float, help='override the budget of the benchmark')
+args = parser.parse_args()
+
+# modules that must not be imported just to parse the command line
+HEAVY_MODULES = ['torch', 'transformers', 'vertexai', 'google.generativeai', 'openai', 'anthropic', 'pandas']
+
+def bench_startup():
+  # wall time of `python run.py --help` (budget in seconds)
+  budget = args.budget if args.budget is not None else 1.0
+  times = []
+  for _ in range(args.repeats):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'run.py', '--help'], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    times.append(time.perf_counter() - start)
+
+  result = subprocess.run([sys.executable, '-X', 'importtime', 'run.py', '--help'], cwd=ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+  imported = {line.split('|')[-1].strip() for line in result.stderr.splitlines() if line.startswith('import time:')}
+  heavy = [m for m in HEAVY_MODULES if m in imported]
+
+  print("run.py --help: median {:.3f}s, min {:.3f}s (budget {:.3f}s)".format(statistics.median(times), min(times), budget))
+  if heavy:
+    print("imported at startup: {}".format(", ".join(heavy)))
+  return statistics.median(times) <= budget and not heavy
+
+def scenario_prompts():
+  from generate_moral_machine_scenarios import generate_scenario_set
+  return [scenario[:2] for scenario in generate_scenario_set(args.random_seed, range(args.nb_scenarios)).values()]
+
+def bench_batch():
+  # ChatModel.chat_batch throughput on a tiny random-weight model (CPU);
+  # budget: minimum speedup of the largest batch size over batch size 1
+  from tinymodel import tiny_chat_model
+  budget = args.budget if args.budget is not None else 2.0
+  chat_model = tiny_chat_model()
+  prompts = scenario_prompts()
+  batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+
+  throughput = {}
+  for batch_size in batch_sizes:
+    stats = [{} for _ in prompts]
+    start = time.perf_counter()
+    for batch in chat_model.group_by_length(prompts, batch_size):
+      chat_model.chat_batch([prompts[k] for k in batch], [stats[k] for k in batch])
+    elapsed = time.perf_counter() - start
+    nb_tokens = sum(s['new_tokens'] for s in stats)
+    throughput[batch_size] = nb_tokens / elapsed
+    print("batch size {:3d}: {:.2f} scenarios/s, {:.1f} tokens/s".format(batch_size, len(prompts) / elapsed, throughput[batch_size]))
+
+  speedup = throughput[max(batch_sizes)] / throughput[min(batch_sizes)]
+  print("speedup of batch size {} over {}: {:.2f}x (budget {:.2f}x)".format(max(batch_sizes), min(batch_sizes), speedup, budget))
+  return speedup >= budget
+
+def bench_prefix():
+  # prefill time per scenario (one new token) with and without the shared-prefix cache;
+  # budget: minimum speedup of the cached prefill
+  from tinymodel import tiny_chat_model
+  budget = args.budget if args.budget is not None else 1.2
+  prompts = scenario_prompts()
+  batch_size = int(args.batch_sizes.split(',')[0])
+
+  elapsed = {}
+  for prefix_cache in [False, True]:
+    chat_model = tiny_chat_model(prefix_cache=prefix_cache, max_new_tokens=1, hidden_size=512, nb_layers=4)
+    batches = chat_model.group_by_length(prompts, batch_size)
+    # the first batch of each system prompt fills the prefix cache
+    for batch in batches:
+      chat_model.chat_batch([prompts[k] for k in batch])
+    stats = [{} for _ in prompts]
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+      for batch in batches:
+        chat_model.chat_batch([prompts[k] for k in batch], [stats[k] for k in batch])
+    elapsed[prefix_cache] = (time.perf_counter() - start) / args.repeats / len(prompts)
+    print("prefix cache {}: {:.2f} ms per scenario ({:.0f} prompt tokens reused per scenario)".format(
+      'on ' if prefix_cache else 'off', 1000 * elapsed[prefix_cache], statistics.mean(s['prefix_tokens'] for s in stats)))
+
+  speedup = elapsed[False] / elapsed[True]
+  print("prefill speedup: {:.2f}x (budget {:.2f}x)".format(speedup, budget))
+  return speedup >= budget
+
+def bench_continuous():
+  # tokens/s of continuous batching over static batches of similar prompt length, on a tiny
+  # random-weight model (CPU) whose sampled responses stop anywhere from a few tokens to max_new_tokens;
+  # the batch size is the smallest one above 1 of --batch_sizes, so that the scenarios fill several batches;
+  # budget: minimum speedup of continuous batching
+  import torch
+  from tinymodel import tiny_chat_model
+  budget = args.budget if args.budget is not None else 1.2
+  prompts = scenario_prompts()
+  batch_size = min(int(b) for b in args.batch_sizes.split(',') if int(b) > 1)
+
+  throughput = {}
+  for continuous_batching in [False, True]:
+    chat_model = tiny_chat_model(max_batch_size=batch_size, continuous_batching=continuous_batching)
+    torch.manual_seed(args.random_seed)
+    stats = [{} for _ in prompts]
+    start = time.perf_counter()
+    if continuous_batching:
+      chat_model.chat_batch(prompts, stats)
+    else:
+      for batch in chat_model.group_by_length(prompts, batch_size):
+        chat_model.chat_batch([prompts[k] for k in batch], [stats[k] for k in batch])
+    elapsed = time.perf_counter() - start
+    nb_tokens = sum(s['new_tokens'] for s in stats)
+    throughput[continuous_batching] = nb_tokens / elapsed
+    print("{} batching (batch size {}): {:.2f} scenarios/s, {:.1f} tokens/s ({} tokens)".format(
+      'continuous' if continuous_batching else 'static    ', batch_size, len(prompts) / elapsed, throughput[continuous_batching], nb_tokens))
+
+  speedup = throughput[True] / throughput[False]
+  print("speedup of continuous batching: {:.2f}x (budget {:.2f}x)".format(speedup, budget))
+  return speedup >= budget
+
+def bench_replicas():
+  # tokens/s of a pool of CPU replicas of a tiny random-weight model (one process each, on their own cores)
+  # over a single replica; the scored answers of the pool must come back in the order of the prompts;
+  # budget: minimum speedup (only checked when every replica has a core of its own)
+  from replicapool import ReplicaPool
+  prompts = scenario_prompts()
+  batch_size = min(int(b) for b in args.batch_sizes.split(',') if int(b) > 1)
+  nb_cores = len(os.sched_getaffinity(0))
+  budget = args.budget if args.budget is not None else (1.2 if nb_cores >= args.replicas else 0.0)
+
+  throughput = {}
+  for nb_replicas in [1, args.replicas]:
+    pool = ReplicaPool('llama-3-tiny', nb_replicas, batch_size=batch_size, devices=['cpu'] * nb_replicas, loader='tinymodel:tiny_chat_model', max_batch_size=batch_size)
+    stats = [{} for _ in prompts]
+    start = time.perf_counter()
+    pool.chat_batch(prompts, stats)
+    elapsed = time.perf_counter() - start
+    pool.close()
+    nb_tokens = sum(s['new_tokens'] for s in stats)
+    throughput[nb_replicas] = nb_tokens / elapsed
+    print("{} replica(s): {:.2f} scenarios/s, {:.1f} tokens/s (batches per replica: {})".format(
+      nb_replicas, len(prompts) / elapsed, throughput[nb_replicas], [sum(s['replica'] == r for s in stats) // batch_size for r in range(nb_replicas)]))
+
+  # scoring is deterministic: the pool must return the answers of a single model, in order
+  from tinymodel import tiny_chat_model
+  pool = ReplicaPool('llama-3-tiny', args.replicas, batch_size=batch_size, devices=['cpu'] * args.replicas, loader='tinymodel:tiny_chat_model', scoring=True)
+  pool_stats = [{} for _ in prompts]
+  pool.chat_batch(prompts, pool_stats)
+  pool.close()
+  chat_model = tiny_chat_model(scoring=True)
+  stats = [{} for _ in prompts]
+  chat_model.chat_batch(prompts, stats)
+  in_order = all(abs(a['logprob_case1'] - b['logprob_case1']) < 1e-4 for a, b in zip(pool_stats, stats))
+  print("results in order: {}".format(in_order))
+
+  speedup = throughput[args.replicas] / throughput[1]
+  print("speedup of {} replicas on {} cores: {:.2f}x (budget {:.2f}x)".format(args.replicas, nb_cores, speedup, budget))
+  return in_order and speedup >= budget
+
+def bench_draft():
+  # per-scenario decode latency with and without a draft model, on a tiny random-weight model (CPU)
+  # whose draft is made of its first layer, the other layers only adding small updates; greedy decoding,
+  # so that the responses must be the same; budget: minimum speedup of assisted generation
+  from chatmodel import ChatModel
+  from tinymodel import tiny_chat_model
+  budget = args.budget if args.budget is not None else 1.1
+  prompts = scenario_prompts()
+  assisted_model = tiny_chat_model(hidden_size=512, nb_layers=12, draft_layers=1, max_new_tokens=128)
+  chat_model = ChatModel(assisted_model.model, tokenizer=assisted_model.tokenizer, generator=assisted_model.generator, max_new_tokens=128)
+
+  elapsed = {}
+  responses = {}
+  for name, model in [('target only', chat_model), ('with draft', assisted_model)]:
+    model.generation_kwargs['do_sample'] = False
+    stats = [{} for _ in prompts]
+    start = time.perf_counter()
+    responses[name] = [model.chat(*prompt, stats=s) for prompt, s in zip(prompts, stats)]
+    elapsed[name] = time.perf_counter() - start
+    nb_tokens = sum(s['new_tokens'] for s in stats)
+    print("{}: {:.1f} ms per token".format(name, 1000 * elapsed[name] / nb_tokens), end='')
+    if 'draft_tokens' in stats[0]:
+      print(", acceptance rate {:.2f}, {:.2f} tokens per target forward pass".format(
+        sum(s['accepted_tokens'] for s in stats) / sum(s['draft_tokens'] for s in stats),
+        nb_tokens / sum(s['target_forwards'] for s in stats)), end='')
+    print()
+
+  same = responses['target only'] == responses['with draft']
+  speedup = elapsed['target only'] / elapsed['with draft']
+  print("same responses: {}".format(same))
+  print("speedup of assisted generation: {:.2f}x (budget {:.2f}x)".format(speedup, budget))
+  return same and speedup >= budget
+
+def resident_memory():
+  # resident set size of this process in MB
+  gc.collect()
+  with open('/proc/self/status') as f:
+    return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) / 1024
+
+# (cpu_dtype, quantization) of each variant of the cpu benchmark
+CPU_VARIANTS = {
+  'fp32': ('float32', None),
+  'bf16': ('bfloat16', None),
+  'int8': ('float32', 'int8'),
+}
+
+def bench_cpu():
+  # decode tokens/s and resident memory of fp32, bf16 and int8 weights, on a tiny random-weight model
+  # (CPU, one scenario at a time, every variant in its own process);
+  # budget: minimum speedup of int8 over fp32
+  import json
+  budget = args.budget if args.budget is not None else 1.2
+  if args.variant is not None:
+    from tinymodel import tiny_chat_model
+    cpu_dtype, quantization = CPU_VARIANTS[args.variant]
+    baseline = resident_memory()
+    chat_model = tiny_chat_model(hidden_size=1024, nb_layers=8, max_new_tokens=32, cpu=True, cpu_dtype=cpu_dtype, quantization=quantization)
+    prompts = scenario_prompts()
+    chat_model.chat(*prompts[0])
+    stats = [{} for _ in prompts]
+    start = time.perf_counter()
+    for prompt, s in zip(prompts, stats):
+      chat_model.chat(*prompt, stats=s)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'tokens_per_second': sum(s['new_tokens'] for s in stats) / elapsed, 'resident_memory': resident_memory(), 'model_memory': resident_memory() - baseline, 'threads': torch_threads()}))
+    return True
+
+  results = {}
+  for variant in CPU_VARIANTS:
+    command = [sys.executable, 'benchmark.py', 'cpu', '--variant', variant, '--nb_scenarios', str(args.nb_scenarios), '--random_seed', str(args.random_seed)]
+    output = subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    results[variant] = json.loads(output.strip().splitlines()[-1])
+    print("{}: {:.1f} tokens/s, {:.0f} MB resident, {:.0f} MB of which since loading the model ({} threads)".format(
+      variant, results[variant]['tokens_per_second'], results[variant]['resident_memory'], results[variant]['model_memory'], results[variant]['threads']))
+
+  speedup = results['int8']['tokens_per_second'] / results['fp32']['tokens_per_second']
+  print("speedup of int8 over fp32: {:.2f}x (budget {:.2f}x)".format(speedup, budget))
+  return speedup >= budget
+
+def torch_threads():
+  import torch
+  return torch.get_num_threads()
+
+def bench_llama():
+  # smoke benchmark of Llama.generate (reference implementation in llama/) with a tiny random-weight
+  # checkpoint on CPU (gloo), in float32 and bfloat16; budget: minimum tokens/s (none by default)
+  import tempfile
+  import torch
+  from tinymodel import tiny_llama
+  budget = args.budget if args.budget is not None else 0.0
+  batch_size = max(int(b) for b in args.batch_sizes.split(','))
+  prompts = scenario_prompts()
+
+  passed = True
+  for dtype in [torch.float32, torch.bfloat16]:
+    with tempfile.TemporaryDirectory() as directory:
+      llama = tiny_llama(directory, max_batch_size=batch_size, device='cpu', dtype=dtype)
+    prompt_tokens = [llama.tokenizer.encode(system_prompt + "\n\n" + user_prompt, bos=True, eos=False) for system_prompt, user_prompt in prompts]
+    start = time.perf_counter()
+    nb_tokens = 0
+    for k in range(0, len(prompt_tokens), batch_size):
+      generation_tokens, _ = llama.generate(prompt_tokens[k:k + batch_size], max_gen_len=64)
+      nb_tokens += sum(len(t) for t in generation_tokens)
+    elapsed = time.perf_counter() - start
+    print("{}: {:.1f} tokens/s ({} tokens, batch size {}) (budget {:.1f} tokens/s)".format(str(dtype).replace('torch.', ''), nb_tokens / elapsed, nb_tokens, batch_size, budget))
+    passed = passed and nb_tokens / elapsed >= budget
+  return passed
+
+def bench_compaction():
+  # tokens/s of Llama.generate when the finished rows are dropped from the batch over decoding
+  # every row until the longest response is done, on a tiny random-weight checkpoint (CPU) whose
+  # sampled responses stop anywhere from a few tokens to max_gen_len; budget: minimum speedup
+  import tempfile
+  import torch
+  from tinymodel import tiny_llama
+  budget = args.budget if args.budget is not None else 1.2
+  batch_size = max(int(b) for b in args.batch_sizes.split(','))
+  prompts = scenario_prompts()
+
+  with tempfile.TemporaryDirectory() as directory:
+    llama = tiny_llama(directory, max_batch_size=batch_size, eos_scale=1.5, device='cpu')
+  prompt_tokens = [llama.tokenizer.encode(system_prompt + "\n\n" + user_prompt, bos=True, eos=False) for system_prompt, user_prompt in prompts]
+  throughput = {}
+  for compaction in [False, True]:
+    torch.manual_seed(args.random_seed)
+    start = time.perf_counter()
+    lengths = []
+    for k in range(0, len(prompt_tokens), batch_size):
+      generation_tokens, _ = llama.generate(prompt_tokens[k:k + batch_size], max_gen_len=256, compaction=compaction)
+      lengths += [len(t) for t in generation_tokens]
+    elapsed = time.perf_counter() - start
+    throughput[compaction] = sum(lengths) / elapsed
+    print("{} (batch size {}): {:.1f} tokens/s ({} tokens, responses of {} to {} tokens)".format(
+      'compaction   ' if compaction else 'no compaction', batch_size, throughput[compaction], sum(lengths), min(lengths), max(lengths)))
+
+  speedup = throughput[True] / throughput[False]
+  print("speedup of compaction: {:.2f}x (budget {:.2f}x)".format(speedup, budget))
+  return speedup >= budget
+
+def bench_paged():
+  # Llama.generate with a paged KV cache (blocks of 16 positions handed out as the sequences grow)
+  # given the memory of the contiguous cache of --batch_sizes max rows of 2048 positions, with as
+  # many rows and with 4 times as many, on a tiny random-weight checkpoint (CPU) and 8 batches of
+  # scenarios; budget: minimum speedup of the paged cache with 4 times as many rows
+  import tempfile
+  import torch
+  from generate_moral_machine_scenarios import generate_scenario_set
+  from tinymodel import tiny_llama
+  budget = args.budget if args.budget is not None else 1.0
+  batch_size = max(int(b) for b in args.batch_sizes.split(','))
+  max_seq_len, block_size = 2048, 16
+  prompts = [scenario[:2] for scenario in generate_scenario_set(args.random_seed, range(8 * batch_size)).values()]
+
+  throughput = {}
+  with tempfile.TemporaryDirectory() as directory:
+    for paged, rows in [(False, batch_size), (True, batch_size), (True, 4 * batch_size)]:
+      options = dict(kv_block_size=block_size, kv_cache_blocks=batch_size * max_seq_len // block_size) if paged else {}
+      llama = tiny_llama(directory, max_seq_len=max_seq_len, max_batch_size=rows, eos_scale=1.5, device='cpu', **options)
+      prompt_tokens = [llama.tokenizer.encode(system_prompt + "\n\n" + user_prompt, bos=True, eos=False) for system_prompt, user_prompt in prompts]
+      torch.manual_seed(args.random_seed)
+      start = time.perf_counter()
+      nb_tokens = 0
+      for k in range(0, len(prompt_tokens), rows):
+        generation_tokens, _ = llama.generate(prompt_tokens[k:k + rows], max_gen_len=256)
+        nb_tokens += sum(len(t) for t in generation_tokens)
+      elapsed = time.perf_counter() - start
+      throughput[paged, rows] = nb_tokens / elapsed
+      if paged:
+        stats = llama.model.cache_stats()
+        print("paged cache      ({:3d} rows): {:.1f} tokens/s ({} tokens), {:.1f} MB ({} blocks of {} positions, at most {} used)".format(
+          rows, throughput[paged, rows], nb_tokens, stats['memory'] / 2**20, stats['blocks'], block_size, stats['peak_used_blocks']))
+      else:
+        memory = sum(t.numel() * t.element_size() for layer in llama.model.layers for t in [layer.attention.cache_k, layer.attention.cache_v])
+        print("contiguous cache ({:3d} rows): {:.1f} tokens/s ({} tokens), {:.1f} MB".format(rows, throughput[paged, rows], nb_tokens, memory / 2**20))
+      del llama
+      gc.collect()
+
+  speedup = throughput[True, 4 * batch_size] / throughput[False, batch_size]
+  print("speedup of the paged cache with {} rows: {:.2f}x (budget {:.2f}x)".format(4 * batch_size, speedup, budget))
+  return speedup >= budget
+
+def bench_attention():
+  # llama.model.Attention with scaled_dot_product_attention (GQA without copying the keys and values)
+  # and with the reference matmul and softmax, on CPU: 32 query heads for 8 KV heads of 64 dimensions,
+  # 2 rows, prefill of L positions and decoding of a token after them, for each L; the outputs must
+  # match (float32, and bfloat16 within its precision); budget: minimum speedup of the decoding at the largest L
+  import tempfile
+  import torch
+  from llama.model import Attention, ModelArgs, precompute_freqs_cis
+  from tinymodel import tiny_llama
+  budget = args.budget if args.budget is not None else 1.0
+  lengths = [128, 512, 1024]
+  bsz = 2
+  with tempfile.TemporaryDirectory() as directory:
+    # initializes the (single process) model parallel group
+    tiny_llama(directory, device='cpu')
+
+  passed = True
+  for dtype, tolerance in [(torch.float32, 1e-4), (torch.bfloat16, 2e-2)]:
+    torch.manual_seed(args.random_seed)
+    model_args = ModelArgs(dim=2048, n_heads=32, n_kv_heads=8, max_batch_size=bsz, max_seq_len=max(lengths) + 1, rope_tables=False)
+    attention = Attention(model_args)
+    for parameter in attention.parameters():
+      parameter.data.normal_(0, model_args.dim ** -0.5)
+    attention.to(dtype)
+    head_dim = model_args.dim // model_args.n_heads
+    freqs_cis = precompute_freqs_cis(head_dim, 2 * model_args.max_seq_len)
+
+    def run(fused, x, start_pos, mask):
+      attention.fused_attention = fused
+      with torch.inference_mode():
+        return attention(x, start_pos, freqs_cis[start_pos:start_pos + x.size(1)], mask)
+
+    def timed(fused, x, start_pos, mask, repeats):
+      run(fused, x, start_pos, mask)
+      start = time.perf_counter()
+      for _ in range(repeats):
+        run(fused, x, start_pos, mask)
+      return (time.perf_counter() - start) / repeats
+
+    for length in lengths:
+      x = torch.randn(bsz, length, model_args.dim, dtype=dtype)
+      mask = torch.triu(torch.full((1, 1, length, length), float('-inf')), diagonal=1).to(dtype)
+      token = torch.randn(bsz, 1, model_args.dim, dtype=dtype)
+      for step, inputs, repeats in [('prefill', (x, 0, mask), max(1, args.repeats // 2)), ('decode ', (token, length, None), 10 * args.repeats)]:
+        reference = run(False, *inputs)
+        error = (run(True, *inputs).float() - reference.float()).abs().max().item() / reference.float().abs().max().item()
+        times = {fused: timed(fused, *inputs, repeats) for fused in [False, True]}
+        print("{} L={:4d} {}: reference {:.2f} ms, fused {:.2f} ms ({:.2f}x), relative error {:.1e} (tolerance {:.0e})".format(
+          str(dtype).replace('torch.', ''), length, step, 1000 * times[False], 1000 * times[True], times[False] / times[True], error, tolerance))
+        passed = passed and error <= tolerance
+        if step == 'decode ' and length == max(lengths):
+          passed = passed and times[False] / times[True] >= budget
+  print("budget: {:.2f}x speedup of the decoding at L={}".format(budget, max(lengths)))
+  return passed
+
+def bench_rope():
+  # per-token latency of the decoding of a tiny random-weight checkpoint (CPU, one row) with the rotary
+  # embeddings from cos/sin tables and with the reference complex freqs_cis, in float32 and bfloat16.
+  # The four variants are timed in turn on each repeat and the medians compared, as single timings
+  # on a shared CPU vary by several percent. The float32 logits must match the reference; the bfloat16
+  # logits must stay about as close to the float32 reference as those of the bfloat16 reference.
+  # budget: minimum float32 speedup, a non-regression tolerance (the rotation is a small part of a step)
+  import tempfile
+  import torch
+  from llama import Llama
+  from tinymodel import tiny_llama
+  budget = args.budget if args.budget is not None else 0.9
+  nb_tokens = 128
+  system_prompt, user_prompt = scenario_prompts()[0]
+  variants = [(dtype, rope_tables) for dtype in [torch.float32, torch.bfloat16] for rope_tables in [False, True]]
+
+  with tempfile.TemporaryDirectory() as directory:
+    tiny_llama(directory, device='cpu')
+    llamas = {variant: Llama.build(ckpt_dir=directory, tokenizer_path=os.path.join(directory, 'tokenizer.model'), max_seq_len=512,
+                                   max_batch_size=1, device='cpu', dtype=variant[0], rope_tables=variant[1]) for variant in variants}
+  prompt = llamas[variants[0]].tokenizer.encode(system_prompt + "\n\n" + user_prompt, bos=True, eos=False)
+  logits = {variant: llama.model.forward(torch.tensor([prompt]), 0).float() for variant, llama in llamas.items()}
+
+  timings = {variant: [] for variant in variants}
+  for repeat in range(args.repeats):
+    # alternating order, so that no variant always follows the same one
+    for variant in variants if repeat % 2 == 0 else variants[::-1]:
+      llama = llamas[variant]
+      token = logits[variant][:, -1].argmax(-1, keepdim=True)
+      start = time.perf_counter()
+      for pos in range(len(prompt), len(prompt) + nb_tokens):
+        token = llama.model.forward(token, pos)[:, -1].argmax(-1, keepdim=True)
+      timings[variant].append((time.perf_counter() - start) / nb_tokens)
+
+  passed = True
+  reference = logits[(torch.float32, False)]
+  for dtype in [torch.float32, torch.bfloat16]:
+    latency = {rope_tables: statistics.median(timings[(dtype, rope_tables)]) for rope_tables in [False, True]}
+    speedup = latency[False] / latency[True]
+    error = {rope_tables: (logits[(dtype, rope_tables)] - reference).abs().max().item() for rope_tables in [False, True]}
+    print("{}: {:.3f} ms/token with freqs_cis, {:.3f} ms/token with cos/sin tables ({:.2f}x, median of {}), "
+          "max logit difference to float32 freqs_cis {:.1e} / {:.1e}".format(
+      str(dtype).replace('torch.', ''), 1000 * latency[False], 1000 * latency[True], speedup, args.repeats, error[False], error[True]))
+    if dtype == torch.float32:
+      passed = passed and speedup >= budget and error[True] <= 1e-4
+    else:
+      passed = passed and error[True] <= 1.5 * error[False] + 1e-3
+  print("budget: {:.2f}x speedup in float32".format(budget))
+  return passed
+
+def read_results(directory, model, nb_scenarios):
+  # records of the JSONL shard written by run.py, by scenario index
+  import json
+  file_name = os.path.join(directory, 'results_{}_scenarios_seed{}_{}.jsonl'.format(nb_scenarios, args.random_seed, model))
+  if not os.path.exists(file_name):
+    return {}
+  with open(file_name) as f:
+    return {record['index']: record for record in map(json.loads, f)}
+
+def bench_api():
+  # run.py --concurrency against mockserver.py (OpenAI, Anthropic and xAI code paths), which takes 0.2s per
+  # answer and rate-limits (429) every 5th request: every response must be stored under the index of its
+  # scenario, the rate-limited requests retried, and each provider must reach --concurrency requests in
+  # flight without exceeding it; budget: minimum speedup over answering the requests one at a time
+  import tempfile
+  import threading
+  from mockserver import MockAPIServer, mock_answer
+  budget = args.budget if args.budget is not None else 1.5
+  models = ['gpt-4o', 'claude-3-haiku-20240307', 'grok-3-beta']
+  delay = 0.2
+  server = MockAPIServer(('127.0.0.1', 0), delay=delay, rate_limit_every=5)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  passed = True
+  with tempfile.TemporaryDirectory() as directory:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'run.py'), '--models', ','.join(models), '--nb_scenarios', str(args.nb_scenarios),
+                             '--random_seed', str(args.random_seed), '--concurrency', str(args.concurrency), '--base_url', server.url, '--rpm', '1000000'],
+                            cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+      print(result.stderr)
+      return False
+    stats = server.stats()
+    prompts = scenario_prompts()
+    for model in models:
+      records = read_results(directory, model, args.nb_scenarios)
+      wrong = [i for i, (_, user_prompt) in enumerate(prompts) if records.get(i, {}).get('chat_response') != mock_answer(user_prompt)]
+      retries = sum(record.get('retries', 0) for record in records.values())
+      in_flight = stats['max_in_flight'].get(model, 0)
+      print("{}: {}/{} responses stored under their scenario, {} retries, at most {} requests in flight (concurrency {})".format(
+        model, len(prompts) - len(wrong), len(prompts), retries, in_flight, args.concurrency))
+      passed = passed and not wrong and in_flight == min(args.concurrency, len(prompts))
+    server.shutdown()
+
+  # the rate-limited requests are answered at once; the models are queried in parallel
+  sequential = delay * (stats['requests'] - stats['rate_limited'])
+  speedup = sequential / elapsed
+  print("{} requests ({} rate limited) in {:.2f}s, {:.2f}s one at a time: {:.2f}x (budget {:.2f}x)".format(
+    stats['requests'], stats['rate_limited'], elapsed, sequential, speedup, budget))
+  return passed and stats['rate_limited'] > 0 and stats['requests'] == len(models) * len(prompts) + stats['rate_limited'] and speedup >= budget
+
+def bench_retry():
+  # RetryPolicy.call on failing requests: transport errors (connection failures, timeouts) and retryable
+  # status codes are retried until the request succeeds; a blocked (Gemini SAFETY) or malformed response
+  # raises the same error on every attempt, so it must fail after one attempt
+  import httpx
+  import openai
+  from retry import RetryPolicy
+  request = httpx.Request('POST', 'http://127.0.0.1/v1/chat/completions')
+  rate_limited = openai.RateLimitError('rate limited', response=httpx.Response(429, request=request, headers={'retry-after': '0'}), body=None)
+  failures = {
+    'blocked response': (ValueError('Cannot get the response text: finish_reason SAFETY'), 1),
+    'malformed response (KeyError)': (KeyError('choices'), 1),
+    'malformed response (IndexError)': (IndexError('list index out of range'), 1),
+    'malformed response (AttributeError)': (AttributeError("'NoneType' object has no attribute 'content'"), 1),
+    'connection error': (httpx.ConnectError('connection refused', request=request), 3),
+    'timeout': (openai.APITimeoutError(request=request), 3),
+    'rate limited (429)': (rate_limited, 3),
+  }
+  passed = True
+  for name, (error, expected) in failures.items():
+    attempts = []
+    def failing():
+      # fails twice, then succeeds
+      attempts.append(1)
+      if len(attempts) < 3:
+        raise error
+      return 'answer'
+    policy = RetryPolicy(max_attempts=20, base_delay=0.001, max_delay=0.01, name=name)
+    result = policy.call(failing)
+    expected_result = 'answer' if expected > 1 else None
+    ok = len(attempts) == expected and result == expected_result
+    print("{}: {} attempt(s), result {!r} ({})".format(name, len(attempts), result, 'ok' if ok else 'expected {} attempt(s)'.format(expected)))
+    passed = passed and ok
+  return passed
+
+def bench_batch_api():
+  # run.py --batch against the batch endpoints of mockserver.py (OpenAI files + batches, Anthropic
+  # messages/batches): the batches are submitted, polled until they end and their results downloaded and
+  # merged under the index of each scenario; every 5th request fails once, is reported missing and is
+  # queried again by --resume. Then a run killed while waiting for its batches is resumed from the
+  # .batch.json file, without submitting the batches again
+  import tempfile
+  import threading
+  from mockserver import MockAPIServer, mock_answer
+  models = ['gpt-4o', 'claude-3-haiku-20240307']
+  prompts = scenario_prompts()
+  poll_interval = 0.1
+
+  def start_server(**kwargs):
+    server = MockAPIServer(('127.0.0.1', 0), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+  def command(server, *options):
+    return [sys.executable, os.path.join(ROOT, 'run.py'), '--models', ','.join(models), '--nb_scenarios', str(args.nb_scenarios),
+            '--random_seed', str(args.random_seed), '--batch', '--batch_poll_interval', str(poll_interval), '--base_url', server.url, *options]
+
+  def run(server, directory, *options):
+    result = subprocess.run(command(server, *options), cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+      print(result.stderr)
+    return result
+
+  def check(directory, model, expected_missing):
+    # the stored responses, and no batch left to resume
+    records = read_results(directory, model, args.nb_scenarios)
+    wrong = [i for i, (_, user_prompt) in enumerate(prompts) if i in records and records[i].get('chat_response') != mock_answer(user_prompt)]
+    missing = [i for i in range(len(prompts)) if i not in records]
+    batch_file = os.path.join(directory, 'results_{}_scenarios_seed{}_{}.batch.json'.format(args.nb_scenarios, args.random_seed, model))
+    print("{}: {}/{} responses stored under their scenario, {} wrong, missing {}".format(model, len(records) - len(wrong), len(prompts), len(wrong), missing))
+    return not wrong and missing == expected_missing and not os.path.exists(batch_file)
+
+  passed = True
+  fail_every = 5
+  failed = [i for i in range(len(prompts)) if i % fail_every == fail_every - 1]
+  server = start_server(batch_polls=2, batch_fail_every=fail_every)
+  with tempfile.TemporaryDirectory() as directory:
+    # submit -> poll -> download -> merge; the failed requests are reported and left out
+    print("run.py --batch:")
+    result = run(server, directory)
+    passed = passed and result.returncode == 0
+    for model in models:
+      reported = "{}: {} scenarios missing from the batch results".format(model, len(failed)) in result.stdout
+      passed = check(directory, model, failed) and reported and passed
+    stats = server.stats()
+    passed = passed and stats['batches'] == len(models) and stats['batch_requests'] == len(models) * len(prompts)
+
+    # --resume submits the failed requests only
+    print("run.py --batch --resume:")
+    result = run(server, directory, '--resume')
+    passed = passed and result.returncode == 0
+    for model in models:
+      passed = check(directory, model, []) and passed
+    stats = server.stats()
+    passed = passed and stats['batches'] == 2 * len(models) and stats['batch_requests'] == len(models) * (len(prompts) + len(failed))
+  server.shutdown()
+
+  # the batches never end until run.py is killed; the resumed run waits for them instead of submitting them again
+  server = start_server(batch_polls=10 ** 9)
+  with tempfile.TemporaryDirectory() as directory:
+    print("run.py --batch, killed while waiting, then --resume:")
+    batch_files = [os.path.join(directory, 'results_{}_scenarios_seed{}_{}.batch.json'.format(args.nb_scenarios, args.random_seed, model)) for model in models]
+    process = subprocess.Popen(command(server), cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 60
+    while not all(os.path.exists(f) for f in batch_files) and process.poll() is None and time.perf_counter() < deadline:
+      time.sleep(poll_interval)
+    # let run.py poll its batches before killing it
+    time.sleep(2 * poll_interval)
+    process.kill()
+    process.wait()
+    submitted = server.stats()['batches']
+    server.batch_polls = 2
+    result = run(server, directory, '--resume')
+    passed = passed and result.returncode == 0 and submitted == len(models) and server.stats()['batches'] == submitted
+    print("{} batches submitted before the kill, {} after --resume".format(submitted, server.stats()['batches'] - submitted))
+    for model in models:
+      passed = check(directory, model, []) and passed
+  server.shutdown()
+  return passed
+
+BENCHMARKS = {
+  'startup': bench_startup,
+  'batch': bench_batch,
+  'prefix': bench_prefix,
+  'continuous': bench_continuous,
+  'replicas': bench_replicas,
+  'draft': bench_draft,
+  'cpu': bench_cpu,
+  'llama': bench_llama,
+  'compaction': bench_compaction,
+  'paged': bench_paged,
+  'attention': bench_attention,
+  'rope': bench_rope,
+  'api': bench_api,
+  'batch_api': bench_batch_api,
+  'retry': bench_retry,
+}
+
+sys.exit(0 if BENCHMARKS[args.benchmark]() else 1)
@@ -1,332 +1,425 @@
+import asyncio
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import vertexai
-from vertexai.generative_models import GenerativeModel
-from vertexai.preview.language_models import ChatModel
-import google.generativeai as genai
+from httpclient import get_http_client, get_async_http_client
 
-import openai
-import anthropic
+from ratelimit import get_rate_limiter, estimate_tokens
+from retry import RetryPolicy
 
-import requests
+# maximum number of requests per batch accepted by the batch APIs
+BATCH_MAX_REQUESTS = {"openai": 50000, "anthropic": 100000}
 
-# for PaLM and Gemini
-vertexai.init(project="ENTER YOUR PROJECT NAME", location="ENTER YOUR LOCATION")
+# endpoint of each provider when base_url is not given
+DEFAULT_ENDPOINTS = {
+    "gemini": "https://generativelanguage.googleapis.com",
+    "palm": "https://aiplatform.googleapis.com",
+    "openai": "https://api.openai.com/v1",
+    "anthropic": "https://api.anthropic.com",
+    "deepseek": "https://api.deepseek.com",
+    "xai": "https://api.x.ai/v1",
+    "moonshot": "https://api.moonshot.ai/v1",
+}
+
+# in-flight request limits shared by all managers of the same provider (per event loop)
+_provider_semaphores = {}
+
+def model_provider(model):
+    # provider of an API model, from its name
+    model = model.lower()
+    if "gemini" in model:
+        return "gemini"
+    elif "palm" in model:
+        return "palm"
+    elif any(s in model for s in ["gpt", "o1", "o3", "o4"]):
+        return "openai"
+    elif "claude" in model:
+        return "anthropic"
+    elif "deepseek" in model:
+        return "deepseek"
+    elif "grok" in model:
+        return "xai"
+    elif "kimi" in model:
+        return "moonshot"
+    raise ValueError("unsupported model")
 
 class ChatBotManager:
-    def __init__(self, model, max_attempts=20):
+    def __init__(self, model, max_attempts=20, max_concurrency=8, base_url=None, rpm=None, tpm=None):
         self.model = model
         self.max_attempts = max_attempts
+        self.max_concurrency = max_concurrency
+        # base_url overrides the provider endpoint (e.g., a local mock server)
+        self.base_url = base_url
+        self.executor = None
+        # one retry policy for every provider (the SDKs' own retries are disabled)
+        self.retry_policy = RetryPolicy(max_attempts=max_attempts, name=model)
                 
-        if "gemini" in self.model.lower():
+        # each provider SDK is imported only when a model of that provider is used
+        self.provider = model_provider(model)
+        if self.provider == "gemini":
+            import google.generativeai as genai
             genai.configure(api_key="ENTER YOUR API KEY")
             self.chat_model = genai.GenerativeModel(model_name = self.model)
-        elif "palm" in self.model.lower():
+        elif self.provider == "palm":
+            import vertexai
+            from vertexai.preview.language_models import ChatModel
+            vertexai.init(project="ENTER YOUR PROJECT NAME", location="ENTER YOUR LOCATION")
             self.chat_model = ChatModel.from_pretrained("chat-bison@001")
-        elif any(s.lower() in self.model.lower() for s in ["gpt", "o1", "o3", "o4"]):
-            self.chat_model = openai.OpenAI(api_key="ENTER YOUR OPENAI API KEY")
-        elif "claude" in self.model.lower():
-            self.chat_model = anthropic.Anthropic(api_key="ENTER YOUR ANTHROPIC API KEY")
-        elif "deepseek" in self.model.lower():
-            self.chat_model = openai.OpenAI(api_key="ENTER YOUR DEEPSEEK API KEY", base_url="https://api.deepseek.com")
-        elif "grok" in self.model.lower():
+        elif self.provider == "openai":
+            import openai
+            self.chat_model = openai.OpenAI(api_key="ENTER YOUR OPENAI API KEY", base_url=base_url, max_retries=0)
+        elif self.provider == "anthropic":
+            import anthropic
+            self.chat_model = anthropic.Anthropic(api_key="ENTER YOUR ANTHROPIC API KEY", base_url=base_url, max_retries=0)
+        elif self.provider == "deepseek":
+            import openai
+            self.chat_model = openai.OpenAI(api_key="ENTER YOUR DEEPSEEK API KEY", base_url=base_url or DEFAULT_ENDPOINTS["deepseek"], max_retries=0)
+        elif self.provider == "xai":
             self.chat_model = "grok"
-        elif "kimi" in self.model.lower():
-            self.chat_model = openai.OpenAI(api_key="ENTER YOUR MOONSHOT API KEY", base_url="https://api.moonshot.ai/v1")
+        else:
+            import openai
+            self.chat_model = openai.OpenAI(api_key="ENTER YOUR MOONSHOT API KEY", base_url=base_url or DEFAULT_ENDPOINTS["moonshot"], max_retries=0)
+        # part of the response cache key, so that the responses of a mock server never answer a real run
+        self.endpoint = base_url or DEFAULT_ENDPOINTS[self.provider]
+
+        # requests/tokens per minute budget shared by every manager of this provider and model
+        self.rate_limiter = get_rate_limiter(self.provider, self.model, rpm=rpm, tpm=tpm)
 
-    def chat(self, system_prompt, user_prompt):
+    def chat(self, system_prompt, user_prompt, stats=None):
+        # stats (optional dict) receives per-call information such as the number of retries
         if any(s.lower() in self.model.lower() for s in ["gpt", "o3", "o4"]):
-            return self.chat_gpt(system_prompt, user_prompt)
+            return self.chat_gpt(system_prompt, user_prompt, stats)
         elif "o1" in self.model.lower():
-            return self.chat_o1(system_prompt, user_prompt)
+            return self.chat_o1(system_prompt, user_prompt, stats)
         elif "gemini" in self.model.lower():
-            return self.chat_gemini2(system_prompt, user_prompt)
+            return self.chat_gemini2(system_prompt, user_prompt, stats)
         elif "palm" in self.model.lower():
-            return self.chat_palm(system_prompt, user_prompt)
+            return self.chat_palm(system_prompt, user_prompt, stats)
         elif "claude" in self.model.lower():
-            return self.chat_claude(system_prompt, user_prompt)
+            return self.chat_claude(system_prompt, user_prompt, stats)
         elif "deepseek" in self.model.lower():
-            return self.chat_gpt(system_prompt, user_prompt)
+            return self.chat_gpt(system_prompt, user_prompt, stats)
         elif "grok" in self.model.lower():
-            return self.chat_xai(system_prompt, user_prompt)
+            return self.chat_xai(system_prompt, user_prompt, stats)
         elif "kimi" in self.model.lower():
-            return self.chat_gpt(system_prompt, user_prompt)
-
-    def chat_gpt(self, system_prompt, user_prompt):
-        attempt = 0
-        while attempt < self.max_attempts:
-            try:
-                response = self.chat_model.chat.completions.create(
-                    model=self.model,
-                    messages = [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                )
-                if any(s.lower() in self.model.lower() for s in ["deepseek-reasoner", "kimi-k2-thinking"]):
-                    response_text = "<think>" + response.choices[0].message.reasoning_content + "</think>" + response.choices[0].message.content
-                    # time.sleep(35)
-                else:
-                    response_text = response.choices[0].message.content
-                
-                return response_text
+            return self.chat_gpt(system_prompt, user_prompt, stats)
 
-            except Exception as e:
-                time.sleep(5)
-                attempt = attempt + 1
-        
-        return None
-                
-    def chat_o1(self, system_prompt, user_prompt):
-        attempt = 0
-        while attempt < self.max_attempts:
-            try:
-                response = self.chat_model.chat.completions.create(
-                    model=self.model,
-                    messages = [
-                            {"role": "user", "content": f"{system_prompt}\n\n{user_prompt}"}
-                        ],
-                )
-                response_text = response.choices[0].message.content
+    async def achat(self, system_prompt, user_prompt, stats=None):
+        # the SDK clients are blocking, so each request runs on a worker thread
+        # while the provider semaphore bounds the number of requests in flight
+        loop = asyncio.get_running_loop()
+        key = (self.provider, loop)
+        if key not in _provider_semaphores:
+            _provider_semaphores[key] = asyncio.Semaphore(self.max_concurrency)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        async with _provider_semaphores[key]:
+            if self.provider == "xai":
+                return await self.achat_xai(system_prompt, user_prompt, stats)
+            return await loop.run_in_executor(self.executor, self.chat, system_prompt, user_prompt, stats)
+
+    def submit_batch(self, requests):
+        # requests: list of (custom_id, system_prompt, user_prompt); returns the batch id
+        # (asynchronous batch APIs: discounted, results within 24 hours)
+        if self.provider == "openai":
+            lines = [json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self.openai_request_params(system_prompt, user_prompt),
+            }) for custom_id, system_prompt, user_prompt in requests]
+            batch_file = self.chat_model.files.create(file=("batch.jsonl", ("\n".join(lines) + "\n").encode()), purpose="batch")
+            batch = self.chat_model.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        elif self.provider == "anthropic":
+            batch = self.chat_model.messages.batches.create(requests=[{
+                "custom_id": custom_id,
+                "params": self.claude_request_params(system_prompt, user_prompt),
+            } for custom_id, system_prompt, user_prompt in requests])
+        else:
+            raise ValueError("batch mode is only supported for OpenAI and Anthropic models")
+        return batch.id
+
+    def retrieve_batch(self, batch_id):
+        if self.provider == "openai":
+            batch = self.retry_policy.call(lambda: self.chat_model.batches.retrieve(batch_id))
+        else:
+            batch = self.retry_policy.call(lambda: self.chat_model.messages.batches.retrieve(batch_id))
+        if batch is None:
+            raise RuntimeError("could not retrieve batch {}".format(batch_id))
+        return batch
+
+    def wait_batch(self, batch_id, poll_interval=60):
+        # polls until the batch has ended (completed, failed, expired or cancelled)
+        while True:
+            batch = self.retrieve_batch(batch_id)
+            if self.provider == "openai":
+                status = batch.status
+                done = status in ("completed", "failed", "expired", "cancelled")
+            else:
+                status = batch.processing_status
+                done = status == "ended"
+            print("{}: batch {} {}".format(self.model, batch_id, status))
+            if done:
+                return status
+            time.sleep(poll_interval)
+
+    def batch_results(self, batch_id):
+        # returns {custom_id: response text} for the requests that succeeded
+        results = {}
+        if self.provider == "openai":
+            batch = self.retrieve_batch(batch_id)
+            if batch.output_file_id is None:
+                return results
+            output = self.retry_policy.call(lambda: self.chat_model.files.content(batch.output_file_id).text)
+            for line in (output or "").splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get("response")
+                if record.get("error") is None and response is not None and response["status_code"] == 200:
+                    results[record["custom_id"]] = self.openai_response_text(response["body"]["choices"][0]["message"])
+        else:
+            for entry in self.chat_model.messages.batches.results(batch_id):
+                if entry.result.type == "succeeded":
+                    results[entry.custom_id] = self.claude_response_text(entry.result.message.content)
+        return results
+
+    def openai_request_params(self, system_prompt, user_prompt):
+        # request body shared by chat_gpt/chat_o1 and the batch API
+        if "o1" in self.model.lower() and not any(s in self.model.lower() for s in ["gpt", "o3", "o4"]):
+            messages = [
+                    {"role": "user", "content": f"{system_prompt}\n\n{user_prompt}"}
+                ]
+        else:
+            messages = [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ]
+        return {"model": self.model, "messages": messages}
+
+    def openai_response_text(self, message):
+        if any(s.lower() in self.model.lower() for s in ["deepseek-reasoner", "kimi-k2-thinking"]):
+            return "<think>" + message["reasoning_content"] + "</think>" + message["content"]
+        return message["content"]
+
+    def chat_gpt(self, system_prompt, user_prompt, stats=None):
+        def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            self.rate_limiter.acquire(tokens)
+            response = self.chat_model.chat.completions.create(
+                **self.openai_request_params(system_prompt, user_prompt),
+            )
+            response_text = self.openai_response_text(response.choices[0].message.model_dump())
+            if response.usage is not None:
+                self.rate_limiter.record_usage(response.usage.total_tokens, tokens)
+
+            return response_text
+
+        return self.retry_policy.call(request, stats)
                 
-                return response_text
+    def chat_o1(self, system_prompt, user_prompt, stats=None):
+        def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            self.rate_limiter.acquire(tokens)
+            response = self.chat_model.chat.completions.create(
+                **self.openai_request_params(system_prompt, user_prompt),
+            )
+            response_text = response.choices[0].message.content
 
-            except Exception as e:
-                time.sleep(5)
-                attempt = attempt + 1
-        
-        return None
+            return response_text
+
+        return self.retry_policy.call(request, stats)
+
+    def claude_request_params(self, system_prompt, user_prompt):
+        # request body shared by chat_claude and the batch API
+        params = {
+            "model": self.model,
+            "max_tokens": 1000,
+            "temperature": 0,
+            "system": system_prompt,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": user_prompt
+                        }
+                    ]
+                }
+            ],
+        }
+        if "3-7" in self.model.lower() or "4" in self.model.lower():
+            params["max_tokens"] = 20000
+            params["temperature"] = 1
+            if "thinking" in self.model.lower():
+                params["model"] = self.model.split("_")[0]
+                params["thinking"] = {
+                    "type": "enabled",
+                    "budget_tokens": 16000
+                }
+        return params
+
+    def claude_response_text(self, content):
+        # content blocks of a (non-streamed) message
+        thinking_blocks = [block.thinking for block in content if block.type == "thinking"]
+        response_content = "".join(block.text for block in content if block.type == "text")
+        if thinking_blocks:
+            return "<think>" + "".join(thinking_blocks) + "</think>" + response_content
+        return response_content
     
-    def chat_claude(self, system_prompt, user_prompt):
-        attempt = 0
-        while attempt < self.max_attempts:
-            try:
-                time.sleep(1)
-                if "3-7" in self.model.lower() or "4" in self.model.lower():
-                    if "thinking" in self.model.lower():
-                        response = self.chat_model.messages.create(
-                            model=self.model.split("_")[0],
-                            max_tokens=20000,
-                            temperature=1,
-                            system=system_prompt,
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "text",
-                                            "text": user_prompt
-                                        }
-                                    ]
-                                }
-                            ],
-                            thinking={
-                                "type": "enabled",
-                                "budget_tokens": 16000
-                            },
-                            stream=True,
-                        )
-                        thinking_content = ""
-                        response_content = ""
-
-                        for event in response:
-                            if event.type == "content_block_delta":
-                                delta = event.delta
-                                
-                                # ThinkingDelta case
-                                if hasattr(delta, 'content'):
-                                    thinking_content += delta.content
-                                elif hasattr(delta, 'thinking'):
-                                    thinking_content += delta.thinking
-                                elif hasattr(delta, 'partial_thinking'):
-                                    thinking_content += delta.partial_thinking
-                                
-                                # TextDelta case
-                                elif hasattr(delta, 'text'):
-                                    response_content += delta.text
-
-                        response_text = "<think>" + thinking_content + "</think>" + response_content
-
-                    else:
-                        response = self.chat_model.messages.create(
-                            model=self.model,
-                            max_tokens=20000,
-                            temperature=1,
-                            system=system_prompt,
-                            messages=[
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "text",
-                                            "text": user_prompt
-                                        }
-                                    ]
-                                }
-                            ]
-                        )
-                        response_text = response.content[0].text
-
-                else:
-                    response = self.chat_model.messages.create(
-                        model=self.model,
-                        max_tokens=1000,
-                        temperature=0,
-                        system=system_prompt,
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": user_prompt
-                                    }
-                                ]
-                            }
-                        ]
-                    )
-                    response_text = response.content[0].text
-                
-                return response_text
-
-            except Exception as e:
-                attempt = attempt + 1
-                if "rate_limit_error" in str(e):
-                    raise ValueError("rate limit error")
-                else:
-                    print(str(e))
-                    time.sleep(5)
-        
-        return None
+    def chat_claude(self, system_prompt, user_prompt, stats=None):
+        def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            self.rate_limiter.acquire(tokens)
+            params = self.claude_request_params(system_prompt, user_prompt)
+            if "thinking" in params:
+                response = self.chat_model.messages.create(**params, stream=True)
+                thinking_content = ""
+                response_content = ""
+
+                for event in response:
+                    if event.type == "content_block_delta":
+                        delta = event.delta
+
+                        # ThinkingDelta case
+                        if hasattr(delta, 'content'):
+                            thinking_content += delta.content
+                        elif hasattr(delta, 'thinking'):
+                            thinking_content += delta.thinking
+                        elif hasattr(delta, 'partial_thinking'):
+                            thinking_content += delta.partial_thinking
+
+                        # TextDelta case
+                        elif hasattr(delta, 'text'):
+                            response_content += delta.text
+
+                response_text = "<think>" + thinking_content + "</think>" + response_content
+
+            else:
+                response = self.chat_model.messages.create(**params)
+                response_text = response.content[0].text
+                self.rate_limiter.record_usage(response.usage.input_tokens + response.usage.output_tokens, tokens)
+
+            return response_text
+
+        return self.retry_policy.call(request, stats)
     
-    def chat_gemini(self, system_prompt, user_prompt):
+    def chat_gemini(self, system_prompt, user_prompt, stats=None):
         chat = self.chat_model.start_chat()
-        attempt = 0
-        while attempt < self.max_attempts:
-            try:
-                prompt = f"{system_prompt}\n\n" + user_prompt 
-                if "1.5" in self.model.lower() or "2.0" in self.model.lower():
-                    response = chat.send_message(
-                            prompt,
-                            generation_config = {
-                                "max_output_tokens": 8192,
-                                "temperature": 1,
-                                "top_p": 0.95,
-                            },
-                            )
-                    time.sleep(15)
-
-                elif "2.5" in self.model.lower():
-                    response = chat.send_message(
-                            prompt,
-                            generation_config = {
-                                "max_output_tokens": 65535,
-                                "temperature": 1,
-                                "top_p": 1,
-                            },
-                            )
-                    time.sleep(15)
-                    
-                else:
-                    response = chat.send_message(
-                            prompt,
-                            generation_config = {
-                                "max_output_tokens": 2048,
-                                "temperature": 0.9,
-                                "top_p": 1
-                            },
-                            )
-
-                response_text = response.candidates[0].content.parts[0].text
-                
-                return response_text
-
-            except vertexai.generative_models._generative_models.ResponseBlockedError as e:
-                print(str(e))
-                attempt = attempt + 1
-            
-            except Exception as e:
-                print(str(e))
-                time.sleep(5)
-                attempt = attempt + 1
-        
-        return None
-        
-    def chat_gemini2(self, system_prompt, user_prompt):
-        attempt = 0
-        while attempt < self.max_attempts:
-            try:
-                prompt = f"{system_prompt}\n\n" + user_prompt 
-                response = self.chat_model.generate_content(
-                    prompt,
-                )
-
-                return response.text
-
-            except Exception as e:
-                print(str(e))
-                time.sleep(5)
-                attempt = attempt + 1
+        def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            self.rate_limiter.acquire(tokens)
+            prompt = f"{system_prompt}\n\n" + user_prompt 
+            if "1.5" in self.model.lower() or "2.0" in self.model.lower():
+                response = chat.send_message(
+                        prompt,
+                        generation_config = {
+                            "max_output_tokens": 8192,
+                            "temperature": 1,
+                            "top_p": 0.95,
+                        },
+                        )
+
+            elif "2.5" in self.model.lower():
+                response = chat.send_message(
+                        prompt,
+                        generation_config = {
+                            "max_output_tokens": 65535,
+                            "temperature": 1,
+                            "top_p": 1,
+                        },
+                        )
+
+            else:
+                response = chat.send_message(
+                        prompt,
+                        generation_config = {
+                            "max_output_tokens": 2048,
+                            "temperature": 0.9,
+                            "top_p": 1
+                        },
+                        )
+
+            response_text = response.candidates[0].content.parts[0].text
+
+            return response_text
+
+        return self.retry_policy.call(request, stats)
         
-        return None
+    def chat_gemini2(self, system_prompt, user_prompt, stats=None):
+        def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            self.rate_limiter.acquire(tokens)
+            prompt = f"{system_prompt}\n\n" + user_prompt 
+            response = self.chat_model.generate_content(
+                prompt,
+            )
+
+            return response.text
+
+        return self.retry_policy.call(request, stats)
 
-    def chat_palm(self, system_prompt, user_prompt):
+    def chat_palm(self, system_prompt, user_prompt, stats=None):
         chat = self.chat_model.start_chat(context=system_prompt)
-        attempt = 0
-        while attempt < self.max_attempts:
-            try:
-                response = chat.send_message(user_prompt, **{
-                            "temperature": 0.2,
-                            "max_output_tokens": 256,
-                            "top_p": 0.8,
-                            "top_k": 40,
-                })
-
-                response_text = response.text
-                
-                return response_text
-
-            except vertexai.generative_models._generative_models.ResponseBlockedError as e:
-                print(str(e))
-                attempt = attempt + 1
-            
-            except Exception as e:
-                print(str(e))
-                time.sleep(5)
-                attempt = attempt + 1
-        
-        return None
-        
-    def chat_xai(self, system_prompt, user_prompt):
-        attempt = 0
-        while attempt < self.max_attempts:
-            try:
-                response = requests.post(
-                    "https://api.x.ai/v1/chat/completions",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer ENTER-YOUT-GROK-API-KEY"
-                    },
-                    json={
-                        "messages": [
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        "model": self.model,
-                        "stream": False,
-                        "temperature": 0
-                    }
-                )
-                response.raise_for_status()
-                result = response.json()
-                response_text = result['choices'][0]['message']['content']
-
-                time.sleep(5)
-                
-                return response_text
+        def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            self.rate_limiter.acquire(tokens)
+            response = chat.send_message(user_prompt, **{
+                        "temperature": 0.2,
+                        "max_output_tokens": 256,
+                        "top_p": 0.8,
+                        "top_k": 40,
+            })
 
-            except Exception as e:
-                time.sleep(5)
-                attempt = attempt + 1
+            response_text = response.text
+
+            return response_text
+
+        return self.retry_policy.call(request, stats)
         
-        return None
+    def xai_request(self, system_prompt, user_prompt):
+        return {
+            "url": "{}/chat/completions".format(self.endpoint),
+            "headers": {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer ENTER-YOUT-GROK-API-KEY"
+            },
+            "json": {
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                "model": self.model,
+                "stream": False,
+                "temperature": 0
+            },
+        }
+
+    def xai_response_text(self, response, tokens):
+        response.raise_for_status()
+        result = response.json()
+        self.rate_limiter.record_usage(result.get('usage', {}).get('total_tokens'), tokens)
+        return result['choices'][0]['message']['content']
+
+    def chat_xai(self, system_prompt, user_prompt, stats=None):
+        # pooled keep-alive client (see httpclient.py) instead of a new connection per request
+        def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            self.rate_limiter.acquire(tokens)
+            response = get_http_client().post(**self.xai_request(system_prompt, user_prompt))
+            return self.xai_response_text(response, tokens)
+
+        return self.retry_policy.call(request, stats)
+
+    async def achat_xai(self, system_prompt, user_prompt, stats=None):
+        # native async request: no worker thread is held while waiting for the model
+        async def request():
+            tokens = estimate_tokens(system_prompt + user_prompt)
+            await self.rate_limiter.aacquire(tokens)
+            response = await get_async_http_client().post(**self.xai_request(system_prompt, user_prompt))
+            return self.xai_response_text(response, tokens)
+
+        return await self.retry_policy.acall(request, stats)
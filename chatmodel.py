@@ -1,17 +1,405 @@
+import copy
+import os
+import re
+import warnings
+
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, AutoProcessor, Gemma3ForConditionalGeneration
+import torch.nn.functional as F
+from transformers import AutoTokenizer, AutoModelForCausalLM, AutoProcessor, Gemma3ForConditionalGeneration, StoppingCriteria
+from transformers import (EpsilonLogitsWarper, InfNanRemoveLogitsProcessor, LogitNormalization, LogitsProcessorList, MinPLogitsWarper, SuppressTokensLogitsProcessor,
+                          TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper, TypicalLogitsWarper)
+
+# candidate answers scored in scoring mode
+CHOICES = ["Case 1", "Case 2"]
+
+ANSWER_PATTERN = re.compile(r"case\s?([12])")
+
+class AnswerStoppingCriteria(StoppingCriteria):
+    # stops each row once it has given an unambiguous answer outside any <think> block
+    # (at the end of the sentence holding the answer), or answer_budget tokens after </think>
+    def __init__(self, tokenizer, prompt_length, batch_size, thinking, stop_on_answer=True, answer_budget=None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.thinking = thinking
+        self.stop_on_answer = stop_on_answer
+        self.answer_budget = answer_budget
+        self.texts = [""] * batch_size
+        # number of generated tokens when </think> was seen and when the row was stopped
+        self.think_end = [None] * batch_size
+        self.stopped_at = [None] * batch_size
+        # number of generated tokens already decoded
+        self.nb_seen = 0
+
+    def should_stop(self, row, nb_tokens):
+        text = self.texts[row]
+        if self.thinking or "<think>" in text:
+            if self.think_end[row] is None:
+                if "</think>" not in text[-32:]:
+                    return False
+                self.think_end[row] = nb_tokens
+            if self.answer_budget is not None and nb_tokens - self.think_end[row] >= self.answer_budget:
+                return True
+            text = text[text.rfind("</think>") + len("</think>"):]
+
+        if self.stop_on_answer:
+            text = text.lower()
+            matches = list(ANSWER_PATTERN.finditer(text))
+            if matches and len({m.group(1) for m in matches}) == 1:
+                return re.search(r"[.!\n]", text[matches[0].end():]) is not None
+        return False
+
+    def update(self, row, token, nb_tokens):
+        # token: the nb_tokens-th generated token of the row; returns whether the row is stopped
+        if self.stopped_at[row] is None:
+            self.texts[row] += self.tokenizer.decode([token])
+            if self.should_stop(row, nb_tokens):
+                self.stopped_at[row] = nb_tokens
+        return self.stopped_at[row] is not None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # (assisted generation adds several tokens between two calls)
+        new_tokens = input_ids[:, self.prompt_length + self.nb_seen:].tolist()
+        done = []
+        for row, tokens in enumerate(new_tokens):
+            stopped = self.stopped_at[row] is not None
+            for n, token in enumerate(tokens):
+                stopped = self.update(row, token, self.nb_seen + n + 1)
+            done.append(stopped)
+        self.nb_seen = input_ids.size(1) - self.prompt_length
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+# generation_config fields whose logits processors ContinuousBatcher cannot apply
+UNSUPPORTED_CONTINUOUS_CONFIG = ["guidance_scale", "min_new_tokens", "exponential_decay_length_penalty", "begin_suppress_tokens",
+                                 "encoder_repetition_penalty", "encoder_no_repeat_ngram_size", "watermarking_config"]
+# logits processors that do not read the input ids (the sampling warpers), applied to all the rows at once
+ROW_INDEPENDENT_PROCESSORS = (TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper, MinPLogitsWarper, TypicalLogitsWarper, EpsilonLogitsWarper,
+                              InfNanRemoveLogitsProcessor, SuppressTokensLogitsProcessor, LogitNormalization)
+
+class ContinuousBatcher:
+    # iteration-level scheduling of the rows generated by a ChatModel: after every decoding step,
+    # finished rows leave the running batch and waiting prompts are prefilled into the free slots,
+    # so that short responses do not wait for the longest response of their batch
+    # (the KV cache of each row stays in the batched cache, left-padded to the longest row)
+    def __init__(self, chat_model, max_batch_size):
+        self.chat_model = chat_model
+        self.generator = chat_model.generator
+        self.max_batch_size = max_batch_size
+        # the generate() arguments over the generation_config of the model, and the logits processors
+        # generate() builds from them: those reading the input ids (repetition penalty, ...) are applied
+        # row by row to the prompt and output ids of the row, the sampling warpers after them to all rows
+        config = copy.deepcopy(self.generator.generation_config)
+        config.update(**chat_model.generation_kwargs)
+        # processors depending on the prompt length or on a second model would differ between rows
+        unsupported = [key for key in UNSUPPORTED_CONTINUOUS_CONFIG if getattr(config, key, None) not in (None, 0, 1.0)]
+        if unsupported:
+            raise ValueError("continuous batching does not support {} in the generation config".format(", ".join(unsupported)))
+        self.max_new_tokens = config.max_new_tokens
+        self.do_sample = config.do_sample
+        self.generator._prepare_special_tokens(config, True, device=self.generator.device)
+        processors = self.generator._get_logits_processor(config, device=self.generator.device)
+        n = len(processors)
+        while n > 0 and isinstance(processors[n - 1], ROW_INDEPENDENT_PROCESSORS):
+            n -= 1
+        self.row_processors, self.warpers = LogitsProcessorList(processors[:n]), processors[n:]
+
+    def sample(self, rows, logits):
+        # next token of each of rows (positions in self.prompts) from their last logits
+        logits = logits.float()
+        if self.row_processors:
+            for n, k in enumerate(rows):
+                input_ids = torch.tensor([self.token_ids[k] + self.outputs[k]], device=logits.device)
+                logits[n:n + 1] = self.row_processors(input_ids, logits[n:n + 1])
+        for warper in self.warpers:
+            logits = warper(None, logits)
+        if self.do_sample:
+            return torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1).squeeze(1)
+        return logits.argmax(dim=-1)
+
+    def merge(self, past_key_values, attention_mask):
+        # appends rows to the running batch (the shorter side is left-padded)
+        if any(layer.is_sliding for layer in past_key_values.layers):
+            raise ValueError("continuous batching is not supported for sliding-window attention")
+        if self.past_key_values is None:
+            self.past_key_values, self.attention_mask = past_key_values, attention_mask
+            return
+        width = max(self.attention_mask.size(1), attention_mask.size(1))
+        for running, new in zip(self.past_key_values.layers, past_key_values.layers):
+            running.keys = torch.cat([F.pad(running.keys, (0, 0, width - running.keys.size(-2), 0)), F.pad(new.keys, (0, 0, width - new.keys.size(-2), 0))])
+            running.values = torch.cat([F.pad(running.values, (0, 0, width - running.values.size(-2), 0)), F.pad(new.values, (0, 0, width - new.values.size(-2), 0))])
+        self.attention_mask = torch.cat([F.pad(self.attention_mask, (width - self.attention_mask.size(1), 0)), F.pad(attention_mask, (width - attention_mask.size(1), 0))])
+
+    def select(self, keep):
+        # keeps the given rows of the running batch, without the padding columns no row uses anymore
+        if not keep:
+            self.past_key_values, self.attention_mask = None, None
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[index]
+        start = int(attention_mask.any(0).int().argmax())
+        self.attention_mask = attention_mask[:, start:]
+        for layer in self.past_key_values.layers:
+            layer.keys = layer.keys[index, :, start:]
+            layer.values = layer.values[index, :, start:]
+
+    def append(self, rows, tokens):
+        for k, token in zip(rows, tokens.tolist()):
+            self.outputs[k].append(token)
+
+    def prefill(self, rows):
+        # the prompts of rows (positions in self.prompts) join the running batch with their first token
+        chat_model = self.chat_model
+        prompts = [self.prompts[k] for k in rows]
+        token_ids = [self.token_ids[k] for k in rows]
+        for prefix, group in chat_model.group_by_prefix(prompts, token_ids).items():
+            prefix, group = list(prefix), [rows[n] for n in group]
+            input_ids, attention_mask = chat_model.pad(prefix, [self.token_ids[k][len(prefix):] for k in group])
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            with torch.no_grad():
+                output = self.generator(
+                    input_ids=input_ids[:, len(prefix):],
+                    attention_mask=attention_mask,
+                    position_ids=position_ids[:, len(prefix):],
+                    past_key_values=chat_model.past_key_values(prefix, len(group)) if prefix else None,
+                    use_cache=True,
+                    logits_to_keep=1,
+                )
+            self.merge(output.past_key_values, attention_mask)
+            for k in group:
+                self.prefix_lengths[k] = len(prefix)
+            self.rows += group
+            self.append(group, self.sample(group, output.logits[:, -1]))
+
+    def step(self):
+        # one decoding step of every running row
+        input_ids = torch.tensor([[self.outputs[k][-1]] for k in self.rows], device=self.attention_mask.device)
+        position_ids = self.attention_mask.sum(-1, keepdim=True)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        with torch.no_grad():
+            output = self.generator(
+                input_ids=input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.past_key_values,
+                use_cache=True,
+            )
+        self.append(self.rows, self.sample(self.rows, output.logits[:, -1]))
+
+    def evict(self, rows=None):
+        # finished rows leave the running batch; only rows (default: all the running rows) got a new
+        # token since they were last checked
+        keep = []
+        for n, k in enumerate(self.rows):
+            if rows is not None and k not in rows:
+                keep.append(n)
+                continue
+            output = self.outputs[k]
+            done = output[-1] in self.chat_model.stop_token_ids or len(output) >= self.max_new_tokens
+            if self.stopping_criteria is not None:
+                done = self.stopping_criteria.update(k, output[-1], len(output)) or done
+            if not done:
+                keep.append(n)
+        if len(keep) < len(self.rows):
+            self.rows = [self.rows[n] for n in keep]
+            self.select(keep)
+
+    def generate(self, prompts, token_ids):
+        # prompts are admitted in order; returns the prefix length (tokens reused from the prefix cache),
+        # the generated token ids and the length at which the answer-aware stopping criteria stopped
+        # (None: not stopped) of each prompt
+        chat_model = self.chat_model
+        self.prompts, self.token_ids = prompts, token_ids
+        self.outputs = [[] for _ in prompts]
+        self.prefix_lengths = [0] * len(prompts)
+        self.rows, self.past_key_values, self.attention_mask = [], None, None
+        self.stopping_criteria = None
+        if chat_model.early_stopping or chat_model.answer_budget is not None:
+            self.stopping_criteria = AnswerStoppingCriteria(chat_model.tokenizer, 0, len(prompts), chat_model.template.get("thinking", False), chat_model.early_stopping, chat_model.answer_budget)
+
+        nb_admitted = 0
+        while nb_admitted < len(prompts) or self.rows:
+            nb_free = self.max_batch_size - len(self.rows)
+            if nb_free > 0 and nb_admitted < len(prompts):
+                admitted = list(range(nb_admitted, min(nb_admitted + nb_free, len(prompts))))
+                self.prefill(admitted)
+                nb_admitted = admitted[-1] + 1
+                self.evict(admitted)
+            if self.rows:
+                self.step()
+                self.evict()
+
+        stopped_at = self.stopping_criteria.stopped_at if self.stopping_criteria is not None else [None] * len(prompts)
+        self.past_key_values, self.attention_mask = None, None
+        return list(zip(self.prefix_lengths, self.outputs, stopped_at))
+
+# chat template registry: prompt format, stop tokens and sampling defaults of each model family
+# - prompt: format string, or messages rendered by the chat template of the tokenizer (or processor)
+# - stop_tokens: None for the eos token of the tokenizer
+# - sampling: generate() arguments (generation_config: only these, the rest comes from the model's generation_config)
+# - decode: "thinking" splits at the </think> token id, "processor" parses the response with the processor
+# - thinking: the response starts with a reasoning block closed by </think>
+# - reference: Llama 2 checkpoints run on the reference implementation in llama/
+TEMPLATES = {
+    "deepseek": {
+        "prompt": "<｜begin▁of▁sentence｜>Please respond to binary questions. {system_prompt}<｜User｜>{user_prompt}<｜Assistant｜>",
+        "stop_tokens": ["<｜end▁of▁sentence｜>"],
+        "sampling": {"max_new_tokens": 2048, "do_sample": True, "temperature": 0.6, "top_p": 0.9},
+        "add_special_tokens": True,
+        "thinking": True,
+    },
+    "qwen3": {
+        "messages": [("system", "{system_prompt}"), ("user", "{user_prompt}")],
+        # "enable_thinking": False
+        "chat_template_kwargs": {"enable_thinking": True},
+        "sampling": {"max_new_tokens": 32768},
+        "generation_config": True,
+        "add_special_tokens": True,
+        # 151668: </think>
+        "decode": "thinking",
+        "think_end_token_id": 151668,
+        "thinking": True,
+    },
+    "qwen": {
+        "prompt": "<|im_start|>system\nPlease respond to binary questions. {system_prompt}<|im_end|>\n<|im_start|>user\n{user_prompt}<|im_end|>\n<|im_start|>assistant\n",
+        "stop_tokens": None,
+        "sampling": {"max_new_tokens": 2048, "do_sample": True, "temperature": 0.6, "top_p": 0.9},
+        "add_special_tokens": True,
+    },
+    "llama-3": {
+        "prompt": "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\nPlease respond to binary questions.\n\n{system_prompt}<|eot_id|>\n<|start_header_id|>user<|end_header_id|>\n\n{user_prompt}<|eot_id|>\n<|start_header_id|>assistant<|end_header_id|>",
+        "stop_tokens": ["<|eot_id|>"],
+        "sampling": {"max_new_tokens": 256, "do_sample": True, "temperature": 0.6, "top_p": 0.9},
+    },
+    "llama-2": {
+        "messages": [("system", "Please respond to binary questions.\n\n{system_prompt}"), ("user", "{user_prompt}")],
+        "sampling": {"max_gen_len": 128, "temperature": 0.6, "top_p": 0.9},
+        "reference": True,
+    },
+    "vicuna": {
+        "prompt": "USER: Please respond to binary questions.\n\n{system_prompt}\n\n{user_prompt}\n\nASSISTANT:",
+        "stop_tokens": None,
+        "sampling": {"max_new_tokens": 512, "do_sample": True, "temperature": 0.7, "top_p": 1.0},
+    },
+    "gemma-4": {
+        "messages": [("system", "Please respond to binary questions.\n\n{system_prompt}"), ("user", "{user_prompt}")],
+        "chat_template_kwargs": {"enable_thinking": False},
+        "sampling": {"max_new_tokens": 1024},
+        "generation_config": True,
+        "add_special_tokens": True,
+        # for thinking mode: f"<think>{response['thinking']}</think>{response['content']}"
+        "decode": "processor",
+    },
+    "gemma": {
+        "prompt": "<bos><start_of_turn>user\nPlease respond to binary questions.\n\n{system_prompt}\n\n{user_prompt}<end_of_turn>\n<start_of_turn>model\n",
+        "stop_tokens": ["<end_of_turn>"],
+        "sampling": {"max_new_tokens": 512, "do_sample": True, "temperature": 0.7, "top_p": 1.0},
+    },
+    "mistral": {
+        "prompt": "<s>[INST] Please respond to binary questions.\n\n{system_prompt}\n\n{user_prompt} [/INST]",
+        "stop_tokens": None,
+        "sampling": {"max_new_tokens": 512, "do_sample": True, "temperature": 0.7, "top_p": 1.0},
+    },
+    "command": {
+        "prompt": "<BOS_TOKEN><|START_OF_TURN_TOKEN|><|SYSTEM_TOKEN|>Please respond to binary questions.\n\n{system_prompt}<|END_OF_TURN_TOKEN|><|START_OF_TURN_TOKEN|><|USER_TOKEN|>{user_prompt}<|END_OF_TURN_TOKEN|><|START_OF_TURN_TOKEN|><|CHATBOT_TOKEN|>",
+        "stop_tokens": None,
+        "sampling": {"max_new_tokens": 100, "do_sample": True, "temperature": 0.3, "top_p": 1.0},
+    },
+    "phi": {
+        "prompt": "<|system|>\n{system_prompt}<|end|>\n<|user|>\n{user_prompt}<|end|>\n<|assistant|>",
+        "stop_tokens": ["<|end|>"],
+        "sampling": {"max_new_tokens": 512, "do_sample": True, "temperature": 0.7, "top_p": 1.0},
+    },
+}
+# QwQ uses the Qwen template but reasons before answering
+TEMPLATES["qwq"] = {**TEMPLATES["qwen"], "thinking": True}
+
+def model_family(model):
+    model = model.lower()
+    if "deepseek" in model:
+        return "deepseek"
+    elif "qwen3" in model:
+        return "qwen3"
+    elif "qwq" in model:
+        return "qwq"
+    elif "qwen" in model:
+        return "qwen"
+    elif "llama-3" in model:
+        return "llama-3"
+    elif "llama" in model:
+        return "llama-2"
+    elif "vicuna" in model:
+        return "vicuna"
+    elif "gemma-4" in model:
+        return "gemma-4"
+    elif "gemma" in model:
+        return "gemma"
+    elif "mistral" in model:
+        return "mistral"
+    elif "command" in model:
+        return "command"
+    elif "phi" in model:
+        return "phi"
+    raise ValueError("unsupprted model")
+
+def cpu_threads():
+    # the cores the process may run on (os.cpu_count ignores taskset and container CPU pinning)
+    return len(os.sched_getaffinity(0))
 
 class ChatModel:
-    def __init__(self, model):
+    def __init__(self, model, max_batch_size=1, prefix_cache=False, max_new_tokens=None, scoring=False, early_stopping=False, answer_budget=None, continuous_batching=False, draft_model=None, cpu=False, cpu_dtype="float32", quantization=None, nb_threads=None, tokenizer=None, generator=None, draft_generator=None):
         self.model = model
-
-        if "deepseek" in self.model.lower():
+        # the chat template, stop tokens and sampling defaults are resolved once
+        self.family = model_family(model)
+        self.template = TEMPLATES[self.family]
+        # largest batch generated at once (running rows with continuous batching)
+        self.max_batch_size = max_batch_size
+        # reuse the past_key_values of the prompt prefix shared by scenarios (template + system prompt)
+        self.prefix_cache = prefix_cache
+        self.prefix_past_key_values = {}
+        self.prefix_token_ids = {}
+        # overrides the max_new_tokens default of the model family
+        self.max_new_tokens = max_new_tokens
+        # score the candidate answers instead of generating a response
+        self.scoring = scoring
+        if self.scoring and (self.template.get("reference") or self.template.get("thinking")):
+            raise ValueError("scoring mode is not supported for this model")
+        # stop generating once the answer is given (outside <think>), and/or
+        # answer_budget tokens after </think> (not applied to the Llama 2 reference implementation)
+        self.early_stopping = early_stopping
+        self.answer_budget = answer_budget
+        # admit waiting prompts into the batch as soon as a row finishes (max_batch_size running rows)
+        self.continuous_batching = continuous_batching
+        # hub id of a small model of the same family drafting the tokens verified by the model (assisted generation)
+        self.draft_model = draft_model
+        if (draft_model is not None or draft_generator is not None) and (self.template.get("reference") or prefix_cache or continuous_batching or scoring):
+            raise ValueError("a draft model is not supported with this model or with prefix caching, continuous batching or scoring")
+        # CPU execution (bitsandbytes 4-bit loading needs CUDA): the weights are loaded in cpu_dtype, and
+        # with quantization ("int8"), the linear layers get quantized after loading
+        self.cpu = cpu
+        self.cpu_dtype = getattr(torch, cpu_dtype)
+        self.quantization = quantization
+        if quantization not in (None, "int8"):
+            raise ValueError("unsupported quantization: {}".format(quantization))
+        # dynamic int8 quantization replaces float32 linear layers
+        if quantization == "int8" and self.cpu_dtype != torch.float32:
+            raise ValueError("int8 quantization needs float32 weights, not {}".format(cpu_dtype))
+        if quantization is not None and self.template.get("reference"):
+            raise ValueError("quantization is not supported for this model")
+        if quantization is not None and not cpu:
+            raise ValueError("quantization is only supported for CPU execution")
+        if cpu:
+            torch.set_num_threads(nb_threads if nb_threads is not None else cpu_threads())
+
+        if generator is not None:
+            # components already loaded (e.g., a tiny random model for benchmarks)
+            self.tokenizer = tokenizer
+            self.generator = generator
+        elif "deepseek" in self.model.lower():
             self.tokenizer = AutoTokenizer.from_pretrained(
                 "deepseek-ai/{}".format(self.model),
                 cache_dir="/mnt/data1/molmo_weight/",
             )
 
-            self.generator = AutoModelForCausalLM.from_pretrained(
+            self.generator = self.from_pretrained(
                 f"deepseek-ai/{self.model}",
                 torch_dtype=torch.bfloat16,
                 # load_in_4bit=True,
@@ -27,7 +415,7 @@ class ChatModel:
             )
 
             if "72b" in self.model.lower():
-                    self.generator = AutoModelForCausalLM.from_pretrained(
+                    self.generator = self.from_pretrained(
                         f"Qwen/{self.model}",
                         load_in_4bit=True,
                         bnb_4bit_compute_dtype=torch.bfloat16,
@@ -36,7 +424,7 @@ class ChatModel:
                     )
 
             else:
-                self.generator = AutoModelForCausalLM.from_pretrained(
+                self.generator = self.from_pretrained(
                     f"Qwen/{self.model}",
                     torch_dtype=torch.bfloat16,
                     device_map="auto",
@@ -54,7 +442,7 @@ class ChatModel:
                     self.tokenizer.pad_token = self.tokenizer.eos_token
 
                 if "70b" in self.model.lower():
-                    self.generator = AutoModelForCausalLM.from_pretrained(
+                    self.generator = self.from_pretrained(
                         f"meta-llama/{self.model}",
                         load_in_4bit=True,
                         bnb_4bit_compute_dtype=torch.bfloat16,
@@ -63,7 +451,7 @@ class ChatModel:
                     )
 
                 else:
-                    self.generator = AutoModelForCausalLM.from_pretrained(
+                    self.generator = self.from_pretrained(
                         f"meta-llama/{self.model}",
                         torch_dtype=torch.bfloat16,
                         device_map="auto",
@@ -77,7 +465,9 @@ class ChatModel:
                     ckpt_dir=f"../{self.model}/",
                     tokenizer_path=f"../tokenizer.model",
                     max_seq_len=512,
-                    max_batch_size=1,
+                    max_batch_size=max_batch_size,
+                    device="cpu" if cpu else None,
+                    dtype=self.cpu_dtype if cpu else None,
                 )
 
             # if self.model == "Meta-Llama-3-70B-Instruct":
@@ -116,7 +506,7 @@ class ChatModel:
                 "lmsys/{}".format(self.model),
                 use_fast=False,
             )
-            self.generator = AutoModelForCausalLM.from_pretrained(
+            self.generator = self.from_pretrained(
                 "lmsys/{}".format(self.model),
                 torch_dtype=torch.float16,
                 device_map="auto",
@@ -124,7 +514,8 @@ class ChatModel:
         elif "gemma" in self.model.lower():
             if "gemma-4" in self.model.lower():
                 self.processor = AutoProcessor.from_pretrained("google/{}".format(self.model))
-                self.generator = AutoModelForCausalLM.from_pretrained(
+                self.tokenizer = self.processor.tokenizer
+                self.generator = self.from_pretrained(
                     "google/{}".format(self.model),
                     dtype="auto",
                     device_map="auto",
@@ -137,7 +528,7 @@ class ChatModel:
                     cache_dir="/mnt/data1/molmo_weight/",
                 )
 
-                self.generator = AutoModelForCausalLM.from_pretrained(
+                self.generator = self.from_pretrained(
                 # self.generator = Gemma3ForConditionalGeneration.from_pretrained(
                     "google/{}".format(self.model),
                     torch_dtype=torch.bfloat16,
@@ -154,7 +545,7 @@ class ChatModel:
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
 
-            self.generator = AutoModelForCausalLM.from_pretrained(
+            self.generator = self.from_pretrained(
                 "mistralai/{}".format(self.model),
                 torch_dtype=torch.float16,
                 device_map="auto",
@@ -166,7 +557,7 @@ class ChatModel:
                 cache_dir="/mnt/data1/molmo_weight/",
             )
 
-            self.generator = AutoModelForCausalLM.from_pretrained(
+            self.generator = self.from_pretrained(
                 "CohereForAI/{}".format(self.model),
                 load_in_4bit=True,
                 #bnb_4bit_compute_dtype=torch.bfloat16,
@@ -180,7 +571,7 @@ class ChatModel:
             )
 
             if "moe" in self.model.lower():
-                self.generator = AutoModelForCausalLM.from_pretrained(
+                self.generator = self.from_pretrained(
                     "microsoft/{}".format(self.model),
                     device_map="auto", 
                     torch_dtype="auto", 
@@ -190,7 +581,7 @@ class ChatModel:
                     cache_dir="/mnt/data1/molmo_weight/",
                 )
             else:
-                self.generator = AutoModelForCausalLM.from_pretrained(
+                self.generator = self.from_pretrained(
                     "microsoft/{}".format(self.model),
                     device_map="auto", 
                     torch_dtype="auto", 
@@ -201,262 +592,312 @@ class ChatModel:
         else:
             raise ValueError("unsupprted model")
 
-    def chat(self, system_prompt, user_prompt):
-        if "deepseek" in self.model.lower():
-            return self.chat_deepseek(system_prompt, user_prompt)
-        elif "qwen" in self.model.lower() or "qwq" in self.model.lower():
-            return self.chat_qwen(system_prompt, user_prompt)
-        elif "llama" in self.model.lower():
-            if "llama-3" in self.model.lower():
-                return self.chat_llama_hf(system_prompt, user_prompt)
+        if not self.template.get("reference"):
+            # batched generation pads on the left, with the eos token if there is no pad token
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+        if self.cpu and not self.template.get("reference"):
+            self.generator = self.to_cpu(self.generator)
+        self.resolve_template()
+        if self.continuous_batching and not self.template.get("reference"):
+            self.scheduler = ContinuousBatcher(self, max_batch_size)
+
+        self.draft_generator = draft_generator
+        self.draft_kwargs = {}
+        if draft_model is not None and draft_generator is None:
+            self.draft_generator = self.from_pretrained(
+                draft_model,
+                torch_dtype=torch.bfloat16,
+                device_map="auto",
+                cache_dir="/mnt/data1/molmo_weight/",
+            )
+            draft_tokenizer = AutoTokenizer.from_pretrained(draft_model, cache_dir="/mnt/data1/molmo_weight/")
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                # the draft tokens are translated between the tokenizers (universal assisted generation)
+                self.draft_kwargs = {"tokenizer": self.tokenizer, "assistant_tokenizer": draft_tokenizer}
+        if self.cpu and self.draft_generator is not None:
+            self.draft_generator = self.to_cpu(self.draft_generator)
+        if self.draft_generator is not None:
+            # forward passes of the model and of the draft model in the last generate() call
+            self.forward_calls = {"target": 0, "draft": 0}
+            self.generator.register_forward_pre_hook(lambda *_: self.forward_calls.update(target=self.forward_calls["target"] + 1))
+            self.draft_generator.register_forward_pre_hook(lambda *_: self.forward_calls.update(draft=self.forward_calls["draft"] + 1))
+
+    def chat(self, system_prompt, user_prompt, stats=None):
+        return self.chat_batch([(system_prompt, user_prompt)], [stats] if stats is not None else None)[0]
+
+    def from_pretrained(self, name, **kwargs):
+        if self.cpu:
+            # full-precision loading on the CPU (quantized afterwards, see to_cpu)
+            for key in ["load_in_4bit", "bnb_4bit_compute_dtype", "device_map", "dtype"]:
+                kwargs.pop(key, None)
+            kwargs["torch_dtype"] = self.cpu_dtype
+        return AutoModelForCausalLM.from_pretrained(name, **kwargs)
+
+    def to_cpu(self, generator):
+        generator = generator.to(device="cpu", dtype=self.cpu_dtype)
+        if self.quantization == "int8":
+            # int8 weights; the activations are quantized on the fly (dynamic quantization)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                torch.ao.quantization.quantize_dynamic(generator, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return generator
+
+    def resolve_template(self):
+        # special token ids and generate() arguments of the model family
+        sampling = dict(self.template["sampling"])
+        if self.max_new_tokens is not None:
+            sampling["max_new_tokens" if "max_new_tokens" in sampling else "max_gen_len"] = self.max_new_tokens
+        # part of the response cache key
+        self.sampling_params = {
+            "family": self.family,
+            **sampling,
+            "scoring": self.scoring,
+            "early_stopping": self.early_stopping,
+            "answer_budget": self.answer_budget,
+        }
+        if self.template.get("reference"):
+            self.generation_kwargs = sampling
+            return
+
+        if self.template.get("generation_config"):
+            self.generation_kwargs = sampling
+            stop_token_ids = self.generator.generation_config.eos_token_id
+        else:
+            if self.template["stop_tokens"] is None:
+                stop_token_ids = self.tokenizer.eos_token_id
             else:
-                return self.chat_llama(system_prompt, user_prompt)
-        elif "vicuna" in self.model.lower():
-            return self.chat_vicuna(system_prompt, user_prompt)
-        elif "gemma" in self.model.lower():
-            return self.chat_gemma(system_prompt, user_prompt)
-        elif "mistral" in self.model.lower():
-            return self.chat_mistral(system_prompt, user_prompt)
-        elif "command" in self.model.lower():
-            return self.chat_command(system_prompt, user_prompt)
-        elif "phi" in self.model.lower():
-            return self.chat_phi(system_prompt, user_prompt)
-
-    def chat_llama(self, system_prompt, user_prompt):
-        dialogs = [
-            [
-                {"role": "system", "content": f"Please respond to binary questions.\n\n{system_prompt}"},
-                {"role": "user", "content": user_prompt},
-            ],
+                stop_token_ids = self.tokenizer.convert_tokens_to_ids(self.template["stop_tokens"][0])
+            self.generation_kwargs = {
+                **sampling,
+                "pad_token_id": self.tokenizer.pad_token_id,
+                "bos_token_id": self.tokenizer.bos_token_id,
+                "eos_token_id": stop_token_ids,
+            }
+        self.stop_token_ids = set(stop_token_ids) if isinstance(stop_token_ids, list) else {stop_token_ids}
+        self.add_special_tokens = self.template.get("add_special_tokens", False)
+        self.chat_template = self.processor if self.template.get("decode") == "processor" else self.tokenizer
+
+    def messages(self, system_prompt, user_prompt):
+        return [
+            {"role": role, "content": content.format(system_prompt=system_prompt, user_prompt=user_prompt)}
+            for role, content in self.template["messages"]
         ]
-        response = self.generator.chat_completion(
-            dialogs,  # type: ignore
-            max_gen_len=128,
-            temperature=0.6,
-            top_p=0.9,
-        )
 
-        return response[0]['generation']['content']
-    
-    def chat_llama_hf(self, system_prompt, user_prompt):
-        prompt = f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\nPlease respond to binary questions.\n\n{system_prompt}<|eot_id|>\n<|start_header_id|>user<|end_header_id|>\n\n{user_prompt}<|eot_id|>\n<|start_header_id|>assistant<|end_header_id|>"
-        
-        token_ids = self.tokenizer.encode(prompt, add_special_tokens=False, return_tensors="pt")
-        with torch.no_grad():
-            output_ids = self.generator.generate(
-                token_ids.to(self.generator.device),
-                max_new_tokens=256,
-                do_sample=True,
-                temperature=0.6,
-                top_p=0.9,
-                pad_token_id=self.tokenizer.pad_token_id,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
-            )
-        response = self.tokenizer.decode(output_ids.tolist()[0][token_ids.size(1):])
-
-        return str(response)
-    
-    def chat_deepseek(self, system_prompt, user_prompt):
-        prompt = f"<｜begin▁of▁sentence｜>Please respond to binary questions. {system_prompt}<｜User｜>{user_prompt}<｜Assistant｜>"
-        
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.generator.device)
-        with torch.no_grad():
-            output_ids = self.generator.generate(
-                input_ids=inputs.input_ids,
-                attention_mask=inputs.attention_mask,
-                max_new_tokens=2048,
-                do_sample=True,
-                temperature=0.6,
-                top_p=0.9,
-                pad_token_id=self.tokenizer.pad_token_id,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=self.tokenizer.convert_tokens_to_ids("<｜end▁of▁sentence｜>"),
-            )
-        response = self.tokenizer.decode(output_ids.tolist()[0][inputs.input_ids.size(1):])
-
-        return str(response)
-    
-    def chat_qwen(self, system_prompt, user_prompt):
-        if "qwen3" in self.model.lower():
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-
-            text = self.tokenizer.apply_chat_template(
-                messages,
-                tokenize=False,
-                add_generation_prompt=True,
-                # enable_thinking=False
-                enable_thinking=True
-            )
-            print(text)
-
-            model_inputs = self.tokenizer([text], return_tensors="pt").to(self.generator.device)
+    def prompt(self, system_prompt, user_prompt):
+        if "prompt" in self.template:
+            return self.template["prompt"].format(system_prompt=system_prompt, user_prompt=user_prompt)
+        return self.chat_template.apply_chat_template(
+            self.messages(system_prompt, user_prompt),
+            tokenize=False,
+            add_generation_prompt=True,
+            **self.template.get("chat_template_kwargs", {}),
+        )
 
-            # conduct text completion
-            generated_ids = self.generator.generate(
-                **model_inputs,
-                max_new_tokens=32768,
-            )
-            output_ids = generated_ids[0][len(model_inputs.input_ids[0]):].tolist()
-            
+    def decode(self, output_ids):
+        # output_ids: generated token ids of one prompt (up to its stop token)
+        if self.template.get("decode") == "thinking":
             # parsing thinking content
             try:
-                # rindex finding 151668 (</think>)
-                index = len(output_ids) - output_ids[::-1].index(151668)
-                # index = len(output_ids) - output_ids[::-1].index(248068)
+                # rindex finding </think>
+                index = len(output_ids) - output_ids[::-1].index(self.template["think_end_token_id"])
             except ValueError:
                 index = 0
 
             thinking_content = self.tokenizer.decode(output_ids[:index], skip_special_tokens=True).strip("\n")
             content = self.tokenizer.decode(output_ids[index:], skip_special_tokens=True).strip("\n")
 
-            response = str(thinking_content) + str(content)
+            return str(thinking_content) + str(content)
+        elif self.template.get("decode") == "processor":
+            response = self.processor.decode(output_ids, skip_special_tokens=False)
+            return str(self.processor.parse_response(response))
 
-        else:
-            prompt = f"<|im_start|>system\nPlease respond to binary questions. {system_prompt}<|im_end|>\n<|im_start|>user\n{user_prompt}<|im_end|>\n<|im_start|>assistant\n"
-            
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.generator.device)
-
-            with torch.no_grad():
-                output_ids = self.generator.generate(
-                    input_ids=inputs.input_ids,
-                    attention_mask=inputs.attention_mask,
-                    max_new_tokens=2048,
-                    do_sample=True,
-                    temperature=0.6,
-                    top_p=0.9,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    bos_token_id=self.tokenizer.bos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                )
-
-            response = self.tokenizer.decode(output_ids.tolist()[0][inputs.input_ids.size(1):])
-
-        return str(response)
-
-    def chat_vicuna(self, system_prompt, user_prompt):
-        prompt = f"USER: Please respond to binary questions.\n\n{system_prompt}\n\n{user_prompt}\n\nASSISTANT:"
-        
-        token_ids = self.tokenizer.encode(prompt, add_special_tokens=False, return_tensors="pt")
-        with torch.no_grad():
-            output_ids = self.generator.generate(
-                token_ids.to(self.generator.device),
-                max_new_tokens=512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=1.0,
-                pad_token_id=self.tokenizer.pad_token_id,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
-            )
-        response = self.tokenizer.decode(output_ids.tolist()[0][token_ids.size(1):])
-
-        return str(response)
-
-    def chat_gemma(self, system_prompt, user_prompt):
-        if "gemma-4" in self.model.lower():
-            messages = [
-                {"role": "system", "content": f"Please respond to binary questions.\n\n{system_prompt}"},
-                {"role": "user", "content": user_prompt},
-            ]
-
-            text = self.processor.apply_chat_template(
-                messages, 
-                tokenize=False, 
-                add_generation_prompt=True, 
-                enable_thinking=False
-            )
-            inputs = self.processor(text=text, return_tensors="pt").to(self.generator.device)
-            input_len = inputs["input_ids"].shape[-1]
-
-            # Generate output
-            outputs = self.generator.generate(**inputs, max_new_tokens=1024)
-            response = self.processor.decode(outputs[0][input_len:], skip_special_tokens=False)
-
-            response = self.processor.parse_response(response)
-            # for thinking mode
-            # response = f"<think>{response['thinking']}</think>{response['content']}"
-            
-            return str(response)
+        return str(self.tokenizer.decode(output_ids))
 
+    def group_by_length(self, prompts, batch_size):
+        # splits prompts (list of (system_prompt, user_prompt)) into batches of similar
+        # token length, so that left padding wastes little compute; returns lists of positions
+        # (prompts sharing a system prompt, hence a cacheable prefix, are batched together)
+        if self.template.get("reference"):
+            lengths = [len(system_prompt) + len(user_prompt) for system_prompt, user_prompt in prompts]
         else:
-            prompt = f"<bos><start_of_turn>user\nPlease respond to binary questions.\n\n{system_prompt}\n\n{user_prompt}<end_of_turn>\n<start_of_turn>model\n"
-
-            token_ids = self.tokenizer.encode(prompt, add_special_tokens=False, return_tensors="pt")
+            lengths = [len(ids) for ids in self.tokenizer([self.prompt(*p) for p in prompts], add_special_tokens=self.add_special_tokens).input_ids]
+        order = sorted(range(len(prompts)), key=lambda k: (prompts[k][0], lengths[k]))
+        return [order[k:k + batch_size] for k in range(0, len(order), batch_size)]
+
+    def prefix_length(self, system_prompt, token_ids):
+        # number of leading tokens of a tokenized prompt that do not depend on the user prompt
+        if system_prompt not in self.prefix_token_ids:
+            # the prompt text up to the user prompt
+            text_a, text_b = self.prompt(system_prompt, "a"), self.prompt(system_prompt, "b")
+            length = next(k for k, (a, b) in enumerate(zip(text_a, text_b)) if a != b)
+            self.prefix_token_ids[system_prompt] = self.tokenizer(text_a[:length], add_special_tokens=self.add_special_tokens).input_ids
+
+        # tokens merged across the prefix boundary are left to the suffix;
+        # at least one token is left for the first decoding step
+        prefix = self.prefix_token_ids[system_prompt]
+        length = next((k for k, (a, b) in enumerate(zip(prefix, token_ids)) if a != b), min(len(prefix), len(token_ids)))
+        return min(length, len(token_ids) - 1)
+
+    def past_key_values(self, prefix, batch_size):
+        # past_key_values of the prefix, computed once and copied for every batch
+        # (generation appends to the cache in place)
+        key = tuple(prefix)
+        if key not in self.prefix_past_key_values:
             with torch.no_grad():
-                output_ids = self.generator.generate(
-                    token_ids.to(self.generator.device),
-                    max_new_tokens=512,
-                    do_sample=True,
-                    temperature=0.7,
-                    top_p=1.0,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    bos_token_id=self.tokenizer.bos_token_id,
-                    #eos_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.convert_tokens_to_ids("<end_of_turn>"),
-                )
-            response = self.tokenizer.decode(output_ids.tolist()[0][token_ids.size(1):])
-
-            return str(response)
-
-    def chat_mistral(self, system_prompt, user_prompt):
-        prompt = f"<s>[INST] Please respond to binary questions.\n\n{system_prompt}\n\n{user_prompt} [/INST]"
-
-        token_ids = self.tokenizer.encode(prompt, add_special_tokens=False, return_tensors="pt")
+                output = self.generator(input_ids=torch.tensor([prefix], device=self.generator.device), use_cache=True)
+            self.prefix_past_key_values[key] = output.past_key_values
+        past_key_values = copy.deepcopy(self.prefix_past_key_values[key])
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+
+    def pad(self, prefix, suffixes):
+        # prefix: token ids shared by every row; suffixes: token ids of each row,
+        # left-padded after the prefix (the attention mask skips the padding)
+        width = max(len(suffix) for suffix in suffixes)
+        pad_token_id = self.tokenizer.pad_token_id
+        input_ids = torch.tensor([prefix + [pad_token_id] * (width - len(suffix)) + suffix for suffix in suffixes], device=self.generator.device)
+        attention_mask = torch.tensor([[1] * len(prefix) + [0] * (width - len(suffix)) + [1] * len(suffix) for suffix in suffixes], device=self.generator.device)
+        return input_ids, attention_mask
+
+    def generate(self, prefix, suffixes, kwargs):
+        # returns the generated token ids of each row and the length at which
+        # the answer-aware stopping criteria stopped it (None: not stopped)
+        input_ids, attention_mask = self.pad(prefix, suffixes)
+        if prefix:
+            kwargs = {**kwargs, "past_key_values": self.past_key_values(prefix, len(suffixes))}
+        if self.draft_generator is not None:
+            kwargs = {**kwargs, "assistant_model": self.draft_generator, **self.draft_kwargs}
+            self.forward_calls.update(target=0, draft=0)
+        stopping_criteria = None
+        if self.early_stopping or self.answer_budget is not None:
+            stopping_criteria = AnswerStoppingCriteria(self.tokenizer, input_ids.size(1), len(suffixes), self.template.get("thinking", False), self.early_stopping, self.answer_budget)
+            kwargs = {**kwargs, "stopping_criteria": [stopping_criteria]}
         with torch.no_grad():
             output_ids = self.generator.generate(
-                token_ids.to(self.generator.device),
-                max_new_tokens=512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=1.0,
-                pad_token_id=self.tokenizer.pad_token_id,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                **kwargs,
             )
-        response = self.tokenizer.decode(output_ids.tolist()[0][token_ids.size(1):])
-
-        return str(response)
-
-    def chat_command(self, system_prompt, user_prompt):
-        prompt = f"<BOS_TOKEN><|START_OF_TURN_TOKEN|><|SYSTEM_TOKEN|>Please respond to binary questions.\n\n{system_prompt}<|END_OF_TURN_TOKEN|><|START_OF_TURN_TOKEN|><|USER_TOKEN|>{user_prompt}<|END_OF_TURN_TOKEN|><|START_OF_TURN_TOKEN|><|CHATBOT_TOKEN|>"
-
-        token_ids = self.tokenizer.encode(prompt, add_special_tokens=False, return_tensors="pt")
+        stopped_at = stopping_criteria.stopped_at if stopping_criteria is not None else [None] * len(suffixes)
+        return output_ids[:, input_ids.size(1):].tolist(), stopped_at
+
+    def last_logits(self, prefix, suffixes, nb_positions):
+        # logits of the last nb_positions positions of every row (one forward pass)
+        input_ids, attention_mask = self.pad(prefix, suffixes)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        past_key_values = self.past_key_values(prefix, len(suffixes)) if prefix else None
         with torch.no_grad():
-            output_ids = self.generator.generate(
-                token_ids.to(self.generator.device),
-                max_new_tokens=100,
-                do_sample=True,
-                temperature=0.3,
-                top_p=1.0,
-                pad_token_id=self.tokenizer.pad_token_id,
-                bos_token_id=self.tokenizer.bos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id,
+            output = self.generator(
+                input_ids=input_ids[:, len(prefix):],
+                attention_mask=attention_mask,
+                position_ids=position_ids[:, len(prefix):],
+                past_key_values=past_key_values,
+                logits_to_keep=nb_positions,
             )
-        response = self.tokenizer.decode(output_ids.tolist()[0][token_ids.size(1):])
-
-        return str(response)
-
-    def chat_phi(self, system_prompt, user_prompt):
-        prompt = f"<|system|>\n{system_prompt}<|end|>\n<|user|>\n{user_prompt}<|end|>\n<|assistant|>"
-
-        token_ids = self.tokenizer.encode(prompt, add_special_tokens=False, return_tensors="pt")
-        with torch.no_grad():
-            output_ids = self.generator.generate(
-                token_ids.to(self.generator.device),
-                max_new_tokens=512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=1.0,
-                pad_token_id=self.tokenizer.pad_token_id,
-                bos_token_id=self.tokenizer.bos_token_id,
-                #eos_token_id=self.tokenizer.eos_token_id,
-                eos_token_id=self.tokenizer.convert_tokens_to_ids("<|end|>"),
-            )
-        response = self.tokenizer.decode(output_ids.tolist()[0][token_ids.size(1):])
-
-        return str(response)
-
+        return output.logits[:, -nb_positions:]
+
+    def tokenize(self, prompts):
+        return self.tokenizer(
+            [self.prompt(system_prompt, user_prompt) for system_prompt, user_prompt in prompts],
+            add_special_tokens=self.add_special_tokens,
+        ).input_ids
+
+    def group_by_prefix(self, prompts, token_ids):
+        # rows are processed together when they share a cached prefix (all of them otherwise);
+        # returns {prefix token ids: positions}
+        groups = {}
+        for k, (system_prompt, _) in enumerate(prompts):
+            length = self.prefix_length(system_prompt, token_ids[k]) if self.prefix_cache else 0
+            groups.setdefault(tuple(token_ids[k][:length]), []).append(k)
+        return groups
+
+    def score_batch(self, prompts):
+        # teacher-forced log-probabilities of each candidate answer following the prompt;
+        # returns one {choice: log-probability} dict per prompt
+        token_ids = self.tokenize(prompts)
+        choice_ids = [self.tokenizer(choice, add_special_tokens=False).input_ids for choice in CHOICES]
+        # the logits at the last prompt token and at every choice token but the last
+        nb_positions = max(len(ids) for ids in choice_ids)
+
+        scores = [None] * len(prompts)
+        for prefix, rows in self.group_by_prefix(prompts, token_ids).items():
+            suffixes = [token_ids[k][len(prefix):] + ids for k in rows for ids in choice_ids]
+            log_probs = torch.log_softmax(self.last_logits(list(prefix), suffixes, nb_positions + 1).float(), dim=-1)
+            for n, k in enumerate(rows):
+                scores[k] = {}
+                for c, ids in enumerate(choice_ids):
+                    targets = torch.tensor(ids, device=log_probs.device)
+                    row_log_probs = log_probs[n * len(choice_ids) + c, -len(ids) - 1:-1]
+                    scores[k][CHOICES[c]] = row_log_probs.gather(-1, targets[:, None]).sum().item()
+        return scores
+
+    def chat_batch(self, prompts, stats=None):
+        # prompts: list of (system_prompt, user_prompt); returns the responses in the same order
+        # (stats: optional list of dicts, one per prompt)
+        if self.template.get("reference"):
+            dialogs = [self.messages(system_prompt, user_prompt) for system_prompt, user_prompt in prompts]
+            if self.continuous_batching:
+                response = self.generator.chat_completion(dialogs, continuous_batching=True, **self.generation_kwargs)
+                return [r['generation']['content'] for r in response]
+            responses = []
+            for k in range(0, len(dialogs), self.max_batch_size):
+                response = self.generator.chat_completion(
+                    dialogs[k:k + self.max_batch_size],  # type: ignore
+                    **self.generation_kwargs,
+                )
+                responses += [r['generation']['content'] for r in response]
+            return responses
+
+        if self.scoring:
+            # the response is the most likely answer; the log-probabilities go to stats
+            responses = []
+            for k, scores in enumerate(self.score_batch(prompts)):
+                responses.append(max(scores, key=scores.get))
+                if stats is not None:
+                    for choice, log_prob in scores.items():
+                        stats[k]["logprob_" + choice.lower().replace(" ", "")] = log_prob
+            return responses
+
+        token_ids = self.tokenize(prompts)
+        kwargs = self.generation_kwargs
+        stopping_criteria_used = self.early_stopping or self.answer_budget is not None
+        # (prefix length, generated token ids, early stop) of each prompt
+        if self.continuous_batching:
+            outputs = self.scheduler.generate(prompts, token_ids)
+        else:
+            outputs = [None] * len(prompts)
+            forward_calls = [None] * len(prompts)
+            for prefix, rows in self.group_by_prefix(prompts, token_ids).items():
+                # assisted generation handles one row at a time
+                batches = [[k] for k in rows] if self.draft_generator is not None else [rows]
+                for batch in batches:
+                    output_ids, stopped_at = self.generate(list(prefix), [token_ids[k][len(prefix):] for k in batch], kwargs)
+                    for k, row, stop in zip(batch, output_ids, stopped_at):
+                        outputs[k] = (len(prefix), row, stop)
+                        if self.draft_generator is not None:
+                            forward_calls[k] = dict(self.forward_calls)
+
+        responses = []
+        for k, (prefix_length, row, stop) in enumerate(outputs):
+            # rows that stopped early are padded up to the longest one: cut after the stop token
+            end = next((n + 1 for n, token in enumerate(row) if token in self.stop_token_ids), len(row))
+            stopped_early = stop is not None and stop < end
+            if stopped_early:
+                end = stop
+            responses.append(self.decode(row[:end]))
+            if stats is not None:
+                stats[k]["new_tokens"] = end
+                stats[k]["prefix_tokens"] = prefix_length
+                if stopping_criteria_used:
+                    # tokens left in the max_new_tokens budget (an upper bound on the tokens saved)
+                    stats[k]["stopped_early"] = stopped_early
+                    stats[k]["tokens_saved"] = kwargs["max_new_tokens"] - end if stopped_early else 0
+                if self.draft_generator is not None:
+                    # every forward pass of the model verifies the draft tokens and adds a token of its own
+                    stats[k]["draft_tokens"] = forward_calls[k]["draft"]
+                    stats[k]["target_forwards"] = forward_calls[k]["target"]
+                    stats[k]["accepted_tokens"] = max(end - forward_calls[k]["target"], 0)
+        return responses
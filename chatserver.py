@@ -0,0 +1,124 @@
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from httpclient import get_http_client
+
+# a long-lived process keeps a ChatModel loaded, so the weights are loaded once per model
+# instead of once per run; run.py --server URL sends its scenarios to it
+
+class ChatServer(ThreadingHTTPServer):
+    def __init__(self, address, chat_model):
+        super().__init__(address, ChatRequestHandler)
+        self.chat_model = chat_model
+        # one generation at a time on the device
+        self.lock = threading.Lock()
+
+    def info(self):
+        return {"model": self.chat_model.model, "sampling_params": self.chat_model.sampling_params}
+
+    def chat_batch(self, prompts):
+        stats = [{} for _ in prompts]
+        with self.lock:
+            responses = self.chat_model.chat_batch(prompts, stats)
+        return {"responses": responses, "stats": stats}
+
+    def group_by_length(self, prompts, batch_size):
+        return {"batches": self.chat_model.group_by_length(prompts, batch_size)}
+
+class ChatRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/info":
+            self.send_json(200, self.server.info())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        try:
+            if self.path == "/chat_batch":
+                self.send_json(200, self.server.chat_batch([tuple(p) for p in body["prompts"]]))
+            elif self.path == "/group_by_length":
+                self.send_json(200, self.server.group_by_length([tuple(p) for p in body["prompts"]], body["batch_size"]))
+            else:
+                self.send_json(404, {"error": "not found"})
+        except Exception as e:
+            self.send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+class ChatServerClient:
+    # same interface as ChatModel (chat, chat_batch, group_by_length) for a model served by chatserver.py
+    def __init__(self, url, model=None):
+        self.url = url.rstrip("/")
+        info = self.request("GET", "/info")
+        if model is not None and info["model"] != model:
+            raise ValueError("the server at {} serves {}, not {}".format(self.url, info["model"], model))
+        self.model = info["model"]
+        self.sampling_params = info["sampling_params"]
+
+    def request(self, method, path, body=None):
+        # generation can take much longer than the default read timeout
+        response = get_http_client().request(method, self.url + path, json=body, timeout=None)
+        if response.status_code != 200:
+            raise RuntimeError("{} {}: {}".format(self.url + path, response.status_code, response.text))
+        return response.json()
+
+    def chat(self, system_prompt, user_prompt, stats=None):
+        return self.chat_batch([(system_prompt, user_prompt)], [stats] if stats is not None else None)[0]
+
+    def chat_batch(self, prompts, stats=None):
+        result = self.request("POST", "/chat_batch", {"prompts": [list(p) for p in prompts]})
+        if stats is not None:
+            for s, row_stats in zip(stats, result["stats"]):
+                s.update(row_stats)
+        return result["responses"]
+
+    def group_by_length(self, prompts, batch_size):
+        return self.request("POST", "/group_by_length", {"prompts": [list(p) for p in prompts], "batch_size": batch_size})["batches"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True, type=str)
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default='8000', type=int)
+    parser.add_argument('--max_batch_size', default='1', type=int)
+    parser.add_argument('--prefix_cache', action='store_true')
+    parser.add_argument('--scoring', action='store_true')
+    parser.add_argument('--early_stopping', action='store_true')
+    parser.add_argument('--answer_budget', default=None, type=int)
+    parser.add_argument('--continuous_batching', action='store_true')
+    parser.add_argument('--draft_model', default=None, type=str)
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--cpu_dtype', default='float32', type=str, choices=['float32', 'bfloat16'])
+    parser.add_argument('--quantization', default=None, type=str, choices=['int8'])
+    parser.add_argument('--threads', default=None, type=int)
+    parser.add_argument('--tiny', action='store_true', help='serve a tiny random-weight model (for testing)')
+    args = parser.parse_args()
+
+    options = dict(max_batch_size=args.max_batch_size, prefix_cache=args.prefix_cache, scoring=args.scoring,
+                   early_stopping=args.early_stopping, answer_budget=args.answer_budget,
+                   continuous_batching=args.continuous_batching, draft_model=args.draft_model,
+                   cpu=args.cpu, cpu_dtype=args.cpu_dtype, quantization=args.quantization, nb_threads=args.threads)
+    if args.tiny:
+        from tinymodel import tiny_chat_model
+        chat_model = tiny_chat_model(args.model, **options)
+    else:
+        from chatmodel import ChatModel
+        chat_model = ChatModel(args.model, **options)
+
+    server = ChatServer((args.host, args.port), chat_model)
+    print("serving {} on http://{}:{}".format(args.model, args.host, args.port))
+    server.serve_forever()
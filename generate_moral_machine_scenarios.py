@@ -1,20 +1,23 @@
 from itertools import product
 from collections import Counter
+import argparse
+import json
 import random
 from config import *
 
-def generate_moral_machine_scenarios(scenario_dimension, is_in_car, is_interventionism, is_law):
+def generate_moral_machine_scenarios(scenario_dimension, is_in_car, is_interventionism, is_law, rng=random):
     if scenario_dimension == "species":
-        nb_pairs = random.choice(list(range(1,6)))
-        tmp_pair_set = random.choices(list(product(humans, pets)), k=nb_pairs)
+        nb_pairs = rng.choice(list(range(1,6)))
+        tmp_pair_set = rng.choices(list(product(humans, pets)), k=nb_pairs)
         set_1 = [x[0] for x in tmp_pair_set]
         set_2 = [x[1] for x in tmp_pair_set]
 
     elif scenario_dimension == "social_value":
-        nb_pairs = random.choice(list(range(1,6)))
+        nb_pairs = rng.choice(list(range(1,6)))
 
-        tmp_pair_set = random.choices(
-            list(
+        tmp_pair_set = rng.choices(
+            # sorted so that the draw does not depend on the string hash seed
+            sorted(
                 set(product(low_social, neutral_social)) | 
                 set(product(low_social, high_social)) | 
                 set(product(neutral_social, high_social))
@@ -25,34 +28,34 @@ def generate_moral_machine_scenarios(scenario_dimension, is_in_car, is_intervent
         set_2 = [x[1] for x in tmp_pair_set]
 
     elif scenario_dimension == "gender":
-        nb_pairs = random.choice(list(range(1,6)))
-        sampled_idx = random.choices(list(range(len(female))), k=nb_pairs)
+        nb_pairs = rng.choice(list(range(1,6)))
+        sampled_idx = rng.choices(list(range(len(female))), k=nb_pairs)
         set_1 = [female[i] for i in sampled_idx]
         set_2 = [male[i] for i in sampled_idx]
 
     elif scenario_dimension == "age":
-        nb_pairs = random.choice(list(range(1,6)))
-        tmp_pair_set = random.choices(age_pairs, k=nb_pairs)
+        nb_pairs = rng.choice(list(range(1,6)))
+        tmp_pair_set = rng.choices(age_pairs, k=nb_pairs)
         set_1 = [x[0] for x in tmp_pair_set]
         set_2 = [x[1] for x in tmp_pair_set]
 
     elif scenario_dimension == "fitness":
-        nb_pairs = random.choice(list(range(1,6)))
-        tmp_pair_set = random.choices(fitness_pairs, k=nb_pairs)
+        nb_pairs = rng.choice(list(range(1,6)))
+        tmp_pair_set = rng.choices(fitness_pairs, k=nb_pairs)
         set_1 = [x[0] for x in tmp_pair_set]
         set_2 = [x[1] for x in tmp_pair_set]
 
     elif scenario_dimension == "utilitarianism":
-        nb_init_pairs = random.choice(list(range(1,5)))
-        tmp_pair_set = [(x, x) for x in random.choices(characters, k=nb_init_pairs)]
+        nb_init_pairs = rng.choice(list(range(1,5)))
+        tmp_pair_set = [(x, x) for x in rng.choices(characters, k=nb_init_pairs)]
         set_1 = [x[0] for x in tmp_pair_set]
         set_2 = [x[1] for x in tmp_pair_set]
-        nb_additional_characters = random.choice(list(range(1,6-nb_init_pairs)))
-        set_2 = set_2 + random.choices(characters, k=nb_additional_characters)
+        nb_additional_characters = rng.choice(list(range(1,6-nb_init_pairs)))
+        set_2 = set_2 + rng.choices(characters, k=nb_additional_characters)
 
     elif scenario_dimension == "random":
-        set_1 = [x for x in random.choices(characters, k=random.choice(list(range(1,6))))]
-        set_2 = [x for x in random.choices(characters, k=random.choice(list(range(1,6))))]
+        set_1 = [x for x in rng.choices(characters, k=rng.choice(list(range(1,6))))]
+        set_2 = [x for x in rng.choices(characters, k=rng.choice(list(range(1,6))))]
         #set_1 = [x for x in random.choices(characters, k=1)]
         #set_2 = [x for x in random.choices(characters, k=1)]
 
@@ -80,12 +83,12 @@ def generate_moral_machine_scenarios(scenario_dimension, is_in_car, is_intervent
         scenario_dimension_group_type = list(scenario_dimension_group_types[scenario_dimension])
 
         if is_law:
-            traffic_light_pattern = random.sample(["green", "red"], k=2)
+            traffic_light_pattern = rng.sample(["green", "red"], k=2)
             traffic_light_pattern[0] = "NA"
         else:
             traffic_light_pattern = ["NA", "NA"]
         
-        if random.random() < 0.5:
+        if rng.random() < 0.5:
             set_1, set_2 = set_2, set_1
             scenario_dimension_group_type.reverse()
 
@@ -168,7 +171,7 @@ def generate_moral_machine_scenarios(scenario_dimension, is_in_car, is_intervent
         scenario_dimension_group_type = list(scenario_dimension_group_types[scenario_dimension])
 
         if is_law:
-            traffic_light_pattern = random.sample(["green", "red"], k=2)
+            traffic_light_pattern = rng.sample(["green", "red"], k=2)
         else:
             traffic_light_pattern = ["NA", "NA"]
 
@@ -292,4 +295,68 @@ def generate_moral_machine_scenarios(scenario_dimension, is_in_car, is_intervent
         "traffic_light_pattern": traffic_light_pattern,
     }
 
-    return system_content, user_content, scenario_info
\ No newline at end of file
+    return system_content, user_content, scenario_info
+
+def sample_scenario(rng=random):
+    # scenario dimension
+    dimension = rng.choice(["species", "social_value", "gender", "age", "fitness", "utilitarianism"])
+    #dimension = "random"
+    # Interventionism #########
+    is_interventionism = rng.choice([True, False])
+    # Relationship to vehicle #########
+    is_in_car = rng.choice([True, False])
+    # Concern for law #########
+    is_law = rng.choice([True, False])
+
+    return generate_moral_machine_scenarios(dimension, is_in_car, is_interventionism, is_law, rng=rng)
+
+def generate_scenario(random_seed, index):
+    # each scenario has its own RNG stream derived from (random_seed, index),
+    # so any scenario can be regenerated without replaying the ones before it
+    rng = random.Random("{}-{}".format(random_seed, index))
+    return sample_scenario(rng)
+
+def generate_scenario_set(random_seed, indices, legacy_rng=False):
+    if legacy_rng:
+        # a single stream shared by all scenarios (as in the published experiments)
+        indices = set(indices)
+        rng = random.Random(random_seed)
+        scenario_set = {}
+        for i in range(max(indices) + 1 if indices else 0):
+            scenario = sample_scenario(rng)
+            if i in indices:
+                scenario_set[i] = scenario
+        return scenario_set
+
+    return {i: generate_scenario(random_seed, i) for i in indices}
+
+def save_scenario_set(file_name, scenario_set):
+    with open(file_name, 'w') as f:
+        for i, (system_content, user_content, scenario_info) in sorted(scenario_set.items()):
+            f.write(json.dumps({
+                "index": i,
+                "system_content": system_content,
+                "user_content": user_content,
+                "scenario_info": scenario_info,
+            }) + '\n')
+
+def load_scenario_set(file_name, indices=None):
+    scenario_set = {}
+    with open(file_name) as f:
+        for line in f:
+            record = json.loads(line)
+            if indices is None or record["index"] in indices:
+                scenario_set[record["index"]] = (record["system_content"], record["user_content"], record["scenario_info"])
+    return scenario_set
+
+if __name__ == "__main__":
+    # materialize a scenario set ahead of time (e.g., to share it between workers)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nb_scenarios', default='3', type=int)
+    parser.add_argument('--random_seed', default='123', type=int)
+    parser.add_argument('--legacy_rng', action='store_true')
+    parser.add_argument('--output', default=None, type=str)
+    args = parser.parse_args()
+
+    output = args.output or 'scenarios_{}_seed{}.jsonl'.format(args.nb_scenarios, args.random_seed)
+    save_scenario_set(output, generate_scenario_set(args.random_seed, range(args.nb_scenarios), legacy_rng=args.legacy_rng))
@@ -0,0 +1,30 @@
+import asyncio
+import importlib.util
+import threading
+
+import httpx
+
+# connect fast, but give (reasoning) models time to answer
+TIMEOUT = httpx.Timeout(connect=10.0, read=600.0, write=30.0, pool=None)
+LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+# HTTP/2 multiplexes the concurrent requests over one connection (needs the h2 package)
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+_client = None
+_client_lock = threading.Lock()
+_async_clients = {}
+
+def get_http_client():
+    # one pooled keep-alive client shared by every thread of the process
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(http2=HTTP2, timeout=TIMEOUT, limits=LIMITS)
+        return _client
+
+def get_async_http_client():
+    # async clients cannot be shared across event loops, so there is one per loop
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = httpx.AsyncClient(http2=HTTP2, timeout=TIMEOUT, limits=LIMITS)
+    return _async_clients[loop]
@@ -49,6 +49,10 @@ You are a helpful, respectful and honest assistant. Always answer as helpfully a
 If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information."""
 
 
+# steps of Llama.generate between two checks for finished sequences
+SYNC_INTERVAL = 8
+
+
 class Llama:
     @staticmethod
     def build(
@@ -57,16 +61,37 @@ class Llama:
         max_seq_len: int,
         max_batch_size: int,
         model_parallel_size: Optional[int] = None,
+        device: Optional[str] = None,
+        dtype: Optional[torch.dtype] = None,
+        kv_block_size: Optional[int] = None,
+        kv_cache_blocks: Optional[int] = None,
+        fused_attention: bool = True,
+        rope_tables: bool = True,
     ) -> "Llama":
+        # device: "cuda" (default when a GPU is present) or "cpu"; dtype: float16 on GPU, float32 on CPU by default
+        # kv_block_size: paged KV cache in blocks of kv_block_size positions (at most kv_cache_blocks blocks)
+        # fused_attention: scaled_dot_product_attention instead of the reference matmul and softmax
+        # rope_tables: rotary embeddings from cos/sin tables instead of the reference complex product
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if dtype is None:
+            dtype = torch.float16 if device == "cuda" else torch.float32
+
         if not torch.distributed.is_initialized():
-            torch.distributed.init_process_group("nccl")
+            backend = "nccl" if device == "cuda" else "gloo"
+            if "MASTER_ADDR" in os.environ:
+                torch.distributed.init_process_group(backend)
+            else:
+                # single process (not started by torchrun)
+                torch.distributed.init_process_group(backend, store=torch.distributed.HashStore(), rank=0, world_size=1)
+        if model_parallel_size is None:
+            model_parallel_size = int(os.environ.get("WORLD_SIZE", 1))
         if not model_parallel_is_initialized():
-            if model_parallel_size is None:
-                model_parallel_size = int(os.environ.get("WORLD_SIZE", 1))
             initialize_model_parallel(model_parallel_size)
 
         local_rank = int(os.environ.get("LOCAL_RANK", 0))
-        torch.cuda.set_device(local_rank)
+        if device == "cuda":
+            torch.cuda.set_device(local_rank)
 
         # seed must be the same in all processes
         torch.manual_seed(1)
@@ -88,12 +113,25 @@ class Llama:
         model_args: ModelArgs = ModelArgs(
             max_seq_len=max_seq_len,
             max_batch_size=max_batch_size,
+            kv_block_size=kv_block_size,
+            kv_cache_blocks=kv_cache_blocks,
+            fused_attention=fused_attention,
+            rope_tables=rope_tables,
             **params,
         )
         tokenizer = Tokenizer(model_path=tokenizer_path)
         model_args.vocab_size = tokenizer.n_words
-        torch.set_default_tensor_type(torch.cuda.HalfTensor)
-        model = Transformer(model_args)
+        # the parameters and the KV cache are allocated in dtype, on the device
+        # (fairscale creates its parameters with torch.Tensor, which ignores the default device)
+        device = torch.device(device, local_rank) if device == "cuda" else torch.device(device)
+        default_device, default_dtype = torch.get_default_device(), torch.get_default_dtype()
+        torch.set_default_device(device)
+        torch.set_default_dtype(dtype)
+        try:
+            model = Transformer(model_args).to(device)
+        finally:
+            torch.set_default_device(default_device)
+            torch.set_default_dtype(default_dtype)
         model.load_state_dict(checkpoint, strict=False)
         print(f"Loaded in {time.time() - start_time:.2f} seconds")
 
@@ -102,6 +140,7 @@ class Llama:
     def __init__(self, model: Transformer, tokenizer: Tokenizer):
         self.model = model
         self.tokenizer = tokenizer
+        self.device = model.tok_embeddings.weight.device
 
     @torch.inference_mode()
     def generate(
@@ -112,7 +151,10 @@ class Llama:
         top_p: float = 0.9,
         logprobs: bool = False,
         echo: bool = False,
+        compaction: bool = True,
     ) -> Tuple[List[List[int]], Optional[List[List[float]]]]:
+        # the finished rows are dropped from the batch (and the KV cache) every SYNC_INTERVAL
+        # steps, the only steps that wait for the device (compaction=False only stops the loop)
         params = self.model.params
         bsz = len(prompt_tokens)
         assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
@@ -122,22 +164,27 @@ class Llama:
         assert max_prompt_len <= params.max_seq_len
         total_len = min(params.max_seq_len, max_gen_len + max_prompt_len)
 
+        self.model.reset_cache()
         pad_id = self.tokenizer.pad_id
-        tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device="cuda")
+        tokens = torch.full((bsz, total_len), pad_id, dtype=torch.long, device=self.device)
         for k, t in enumerate(prompt_tokens):
-            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device="cuda")
+            tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device=self.device)
         if logprobs:
             token_logprobs = torch.zeros_like(tokens, dtype=torch.float)
 
         prev_pos = 0
-        eos_reached = torch.tensor([False] * bsz, device="cuda")
+        eos_reached = torch.tensor([False] * bsz, device=self.device)
         input_text_mask = tokens != pad_id
+        # last position of the output of each row
+        last_pos = torch.tensor([len(t) for t in prompt_tokens], device=self.device) + max_gen_len - 1
+        # rows of tokens still decoded, in the order of the rows of the KV cache
+        active = torch.arange(bsz, device=self.device)
         for cur_pos in range(min_prompt_len, total_len):
-            logits = self.model.forward(tokens[:, prev_pos:cur_pos], prev_pos)
+            logits = self.model.forward(tokens[active, prev_pos:cur_pos], prev_pos)
             if logprobs:
-                token_logprobs[:, prev_pos + 1 : cur_pos + 1] = -F.cross_entropy(
+                token_logprobs[active, prev_pos + 1 : cur_pos + 1] = -F.cross_entropy(
                     input=logits.transpose(1, 2),
-                    target=tokens[:, prev_pos + 1 : cur_pos + 1],
+                    target=tokens[active, prev_pos + 1 : cur_pos + 1],
                     reduction="none",
                     ignore_index=pad_id,
                 )
@@ -150,15 +197,25 @@ class Llama:
             next_token = next_token.reshape(-1)
             # only replace token if prompt has already been generated
             next_token = torch.where(
-                input_text_mask[:, cur_pos], tokens[:, cur_pos], next_token
+                input_text_mask[active, cur_pos], tokens[active, cur_pos], next_token
             )
-            tokens[:, cur_pos] = next_token
-            eos_reached |= (~input_text_mask[:, cur_pos]) & (
+            tokens[active, cur_pos] = next_token
+            eos_reached[active] |= (~input_text_mask[active, cur_pos]) & (
                 next_token == self.tokenizer.eos_id
             )
             prev_pos = cur_pos
-            if all(eos_reached):
-                break
+            if (cur_pos - min_prompt_len + 1) % SYNC_INTERVAL == 0:
+                finished = eos_reached[active] | (last_pos[active] <= cur_pos)
+                if not compaction:
+                    if bool(finished.all()):
+                        break
+                    continue
+                keep = (~finished).nonzero().reshape(-1)
+                if len(keep) == 0:
+                    break
+                if len(keep) < len(active):
+                    self.model.compact_cache(keep, cur_pos)
+                    active = active[keep]
 
         if logprobs:
             token_logprobs = token_logprobs.tolist()
@@ -179,6 +236,64 @@ class Llama:
             out_logprobs.append(probs)
         return (out_tokens, out_logprobs if logprobs else None)
 
+    @torch.inference_mode()
+    def generate_continuous(
+        self,
+        prompt_tokens: List[List[int]],
+        max_gen_len: int,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+    ) -> List[List[int]]:
+        # continuous batching: the max_batch_size rows of the KV cache (slots) are decoded
+        # together, and a waiting prompt is prefilled into a slot as soon as its sequence is done
+        params = self.model.params
+        device = self.device
+        self.model.reset_cache()
+        out_tokens: List[List[int]] = [[] for _ in prompt_tokens]
+        waiting = list(range(len(prompt_tokens)))[::-1]
+        free_slots = list(range(params.max_batch_size))[::-1]
+        # prompt index and position of the last token of the sequence in each busy slot
+        running, positions = {}, {}
+
+        def append(slot, token):
+            k = running[slot]
+            if token != self.tokenizer.eos_id:
+                out_tokens[k].append(token)
+            if (
+                token == self.tokenizer.eos_id
+                or len(out_tokens[k]) >= max_gen_len
+                or positions[slot] >= params.max_seq_len - 1
+            ):
+                del running[slot], positions[slot]
+                free_slots.append(slot)
+                self.model.free_cache([slot])
+
+        while waiting or running:
+            # prefill (one prompt at a time, prompts differ in length)
+            while waiting and free_slots:
+                k, slot = waiting.pop(), free_slots.pop()
+                assert len(prompt_tokens[k]) < params.max_seq_len
+                logits = self.model.forward(
+                    torch.tensor([prompt_tokens[k]], dtype=torch.long, device=device),
+                    torch.tensor([0], device=device),
+                    slots=torch.tensor([slot], device=device),
+                )
+                running[slot], positions[slot] = k, len(prompt_tokens[k])
+                append(slot, sample_next(logits[:, -1], temperature, top_p).item())
+
+            if not running:
+                continue
+            slots = list(running)
+            logits = self.model.forward(
+                torch.tensor([[out_tokens[running[slot]][-1]] for slot in slots], dtype=torch.long, device=device),
+                torch.tensor([positions[slot] for slot in slots], device=device),
+                slots=torch.tensor(slots, device=device),
+            )
+            for slot, token in zip(slots, sample_next(logits[:, -1], temperature, top_p).tolist()):
+                positions[slot] += 1
+                append(slot, token)
+        return out_tokens
+
     def text_completion(
         self,
         prompts: List[str],
@@ -217,6 +332,7 @@ class Llama:
         top_p: float = 0.9,
         max_gen_len: Optional[int] = None,
         logprobs: bool = False,
+        continuous_batching: bool = False,
     ) -> List[ChatPrediction]:
         if max_gen_len is None:
             max_gen_len = self.model.params.max_seq_len - 1
@@ -268,13 +384,22 @@ class Llama:
             )
             prompt_tokens.append(dialog_tokens)
 
-        generation_tokens, generation_logprobs = self.generate(
-            prompt_tokens=prompt_tokens,
-            max_gen_len=max_gen_len,
-            temperature=temperature,
-            top_p=top_p,
-            logprobs=logprobs,
-        )
+        if continuous_batching:
+            assert not logprobs, "logprobs are not supported with continuous batching"
+            generation_tokens = self.generate_continuous(
+                prompt_tokens=prompt_tokens,
+                max_gen_len=max_gen_len,
+                temperature=temperature,
+                top_p=top_p,
+            )
+        else:
+            generation_tokens, generation_logprobs = self.generate(
+                prompt_tokens=prompt_tokens,
+                max_gen_len=max_gen_len,
+                temperature=temperature,
+                top_p=top_p,
+                logprobs=logprobs,
+            )
         if logprobs:
             return [
                 {
@@ -293,6 +418,13 @@ class Llama:
         ]
 
 
+def sample_next(logits, temperature, top_p):
+    if temperature > 0:
+        probs = torch.softmax(logits / temperature, dim=-1)
+        return sample_top_p(probs, top_p).reshape(-1)
+    return torch.argmax(logits, dim=-1)
+
+
 def sample_top_p(probs, p):
     probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
     probs_sum = torch.cumsum(probs_sort, dim=-1)
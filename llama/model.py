@@ -3,7 +3,7 @@
 
 import math
 from dataclasses import dataclass
-from typing import Any, Optional, Tuple
+from typing import Any, List, Optional, Tuple, Union
 
 import fairscale.nn.model_parallel.initialize as fs_init
 import torch
@@ -29,6 +29,15 @@ class ModelArgs:
 
     max_batch_size: int = 32
     max_seq_len: int = 2048
+    # paged KV cache: positions per block (None: contiguous cache of max_seq_len
+    # positions for each of the max_batch_size rows), and maximum number of blocks
+    kv_block_size: Optional[int] = None
+    kv_cache_blocks: Optional[int] = None
+    # scaled_dot_product_attention (False: explicit matmul and softmax, the reference)
+    fused_attention: bool = True
+    # rotary embeddings from cos/sin tables in the model dtype (False: complex float32
+    # freqs_cis, the reference)
+    rope_tables: bool = True
 
 
 class RMSNorm(torch.nn.Module):
@@ -53,9 +62,21 @@ def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
     return freqs_cis
 
 
+def precompute_rope_tables(dim: int, end: int, theta: float = 10000.0):
+    # cos and sin of the angles of precompute_freqs_cis, as real pairs: (end, dim // 2, 2)
+    freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
+    t = torch.arange(end, device=freqs.device, dtype=torch.float32)
+    freqs = torch.outer(t, freqs)
+    return torch.stack((freqs.cos(), freqs.sin()), dim=-1)
+
+
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     ndim = x.ndim
     assert 0 <= 1 < ndim
+    if freqs_cis.ndim == 3:
+        # one position per row (continuous batching)
+        assert freqs_cis.shape == (x.shape[0], x.shape[1], x.shape[-1])
+        return freqs_cis[:, :, None, :]
     assert freqs_cis.shape == (x.shape[1], x.shape[-1])
     shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
     return freqs_cis.view(*shape)
@@ -74,6 +95,21 @@ def apply_rotary_emb(
     return xq_out.type_as(xq), xk_out.type_as(xk)
 
 
+def apply_rotary_emb_(
+    x: torch.Tensor,
+    freqs: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
+):
+    # rotates the pairs of dimensions (2i, 2i + 1) of x in place, in the dtype of x;
+    # freqs (from Transformer.rotary_embedding): complex for float32, otherwise (cos, sin)
+    # with cos and sin repeated over each pair, and the sign of the rotation in sin
+    if torch.is_tensor(freqs):
+        torch.view_as_complex(x.unflatten(-1, (-1, 2))).mul_(freqs)
+    else:
+        cos, sin = freqs
+        rotated = x.unflatten(-1, (-1, 2)).flip(-1).flatten(-2)
+        x.mul_(cos).addcmul_(rotated, sin)
+
+
 def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     """torch.repeat_interleave(x, dim=2, repeats=n_rep)"""
     bs, slen, n_kv_heads, head_dim = x.shape
@@ -86,8 +122,128 @@ def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
     )
 
 
+class PagedKVCache:
+    # KV cache of all the layers in blocks of block_size positions, handed out to the rows
+    # as their sequences grow; row r keeps positions [i * block_size, (i + 1) * block_size)
+    # in block block_table[r, i] of every layer. The blocks of each layer are allocated
+    # lazily (in the dtype of the keys), and grow by half when no block is free.
+    def __init__(self, args: ModelArgs, n_local_kv_heads: int, head_dim: int):
+        self.block_size = args.kv_block_size
+        self.max_blocks_per_row = -(-args.max_seq_len // self.block_size)
+        # block 0 is never handed out: the entries of the table past the end of a row point to it
+        self.max_blocks = 1 + (
+            args.kv_cache_blocks
+            if args.kv_cache_blocks is not None
+            else args.max_batch_size * self.max_blocks_per_row
+        )
+        self.nb_blocks = min(self.max_blocks, 1 + args.max_batch_size)
+        self.free_blocks = list(range(self.nb_blocks - 1, 0, -1))
+        self.block_table = torch.zeros(
+            (args.max_batch_size, self.max_blocks_per_row), dtype=torch.long
+        )
+        self.row_blocks: List[List[int]] = [[] for _ in range(args.max_batch_size)]
+        self.row_lengths = [0] * args.max_batch_size
+        self.peak_used_blocks = 0
+        self.keys: List[Optional[torch.Tensor]] = [None] * args.n_layers
+        self.values: List[Optional[torch.Tensor]] = [None] * args.n_layers
+        self.contiguous_size = (
+            args.n_layers * 2 * args.max_batch_size * args.max_seq_len * n_local_kv_heads * head_dim
+        )
+
+    def allocate(self) -> int:
+        if not self.free_blocks:
+            if self.nb_blocks == self.max_blocks:
+                raise RuntimeError(
+                    f"the KV cache is full ({self.max_blocks - 1} blocks of {self.block_size} positions)"
+                )
+            nb_blocks = min(self.max_blocks, self.nb_blocks + self.nb_blocks // 2)
+            self.free_blocks = list(range(nb_blocks - 1, self.nb_blocks - 1, -1))
+            self.nb_blocks = nb_blocks
+        return self.free_blocks.pop()
+
+    def prepare(self, rows: List[int], starts: List[int], seqlen: int, device: torch.device):
+        # hands out the blocks of positions [start, start + seqlen) of each row, and sets
+        # the cache positions written and read by the next forward pass of the layers
+        for row, start in zip(rows, starts):
+            blocks = self.row_blocks[row]
+            nb_blocks = -(-(start + seqlen) // self.block_size)
+            if nb_blocks > len(blocks):
+                new_blocks = [self.allocate() for _ in range(nb_blocks - len(blocks))]
+                self.block_table[row, len(blocks) : nb_blocks] = torch.tensor(new_blocks)
+                blocks += new_blocks
+            self.row_lengths[row] = max(self.row_lengths[row], start + seqlen)
+        self.peak_used_blocks = max(self.peak_used_blocks, self.used_blocks())
+
+        table = self.block_table[torch.tensor(rows, device=device)]
+        positions = torch.tensor(starts, device=device)[:, None] + torch.arange(seqlen, device=device)
+        self.write_index = (
+            table.gather(1, positions // self.block_size) * self.block_size
+            + positions % self.block_size
+        )
+        positions = torch.arange(max(starts) + seqlen, device=device)
+        self.read_index = (
+            table[:, positions // self.block_size] * self.block_size
+            + positions % self.block_size
+        )
+
+    def update(self, layer_id: int, xk: torch.Tensor, xv: torch.Tensor):
+        # writes the keys and values of the current tokens, returns those of the positions read
+        size = self.nb_blocks * self.block_size
+        keys, values = self.keys[layer_id], self.values[layer_id]
+        if keys is None or keys.size(0) < size:
+            new_keys = xk.new_zeros((size,) + xk.shape[2:])
+            new_values = xv.new_zeros((size,) + xv.shape[2:])
+            if keys is not None:
+                new_keys[: keys.size(0)] = keys
+                new_values[: values.size(0)] = values
+            keys = self.keys[layer_id] = new_keys
+            values = self.values[layer_id] = new_values
+        keys[self.write_index] = xk
+        values[self.write_index] = xv
+        return keys[self.read_index], values[self.read_index]
+
+    def free(self, rows: List[int]):
+        for row in rows:
+            self.free_blocks += self.row_blocks[row][::-1]
+            self.row_blocks[row] = []
+            self.row_lengths[row] = 0
+        self.block_table[rows] = 0
+
+    def compact(self, rows: List[int]):
+        # row i becomes the row rows[i]; the other rows are freed
+        self.free([row for row in range(len(self.row_blocks)) if row not in set(rows)])
+        self.row_blocks[: len(rows)] = [self.row_blocks[row] for row in rows]
+        self.row_lengths[: len(rows)] = [self.row_lengths[row] for row in rows]
+        self.block_table[: len(rows)] = self.block_table[rows]
+        for row in range(len(rows), len(self.row_blocks)):
+            self.row_blocks[row], self.row_lengths[row] = [], 0
+        self.block_table[len(rows) :] = 0
+
+    def used_blocks(self) -> int:
+        return sum(len(blocks) for blocks in self.row_blocks)
+
+    def stats(self) -> dict:
+        used_blocks = self.used_blocks()
+        tokens = sum(self.row_lengths)
+        memory = sum(
+            t.numel() * t.element_size() for t in self.keys + self.values if t is not None
+        )
+        element_size = self.keys[0].element_size() if self.keys[0] is not None else 0
+        return {
+            "block_size": self.block_size,
+            "blocks": self.nb_blocks - 1,
+            "used_blocks": used_blocks,
+            "peak_used_blocks": self.peak_used_blocks,
+            "tokens": tokens,
+            # share of the positions of the used blocks that hold a token
+            "utilization": tokens / (used_blocks * self.block_size) if used_blocks else 0.0,
+            "memory": memory,
+            "contiguous_memory": self.contiguous_size * element_size,
+        }
+
+
 class Attention(nn.Module):
-    def __init__(self, args: ModelArgs):
+    def __init__(self, args: ModelArgs, kv_cache: Optional[PagedKVCache] = None, layer_id: int = 0):
         super().__init__()
         self.n_kv_heads = args.n_heads if args.n_kv_heads is None else args.n_kv_heads
         model_parallel_size = fs_init.get_model_parallel_world_size()
@@ -125,6 +281,12 @@ class Attention(nn.Module):
             init_method=lambda x: x,
         )
 
+        self.fused_attention = args.fused_attention
+        self.rope_tables = args.rope_tables
+        self.kv_cache = kv_cache
+        self.layer_id = layer_id
+        if kv_cache is not None:
+            return
         self.cache_k = torch.zeros(
             (
                 args.max_batch_size,
@@ -132,7 +294,7 @@ class Attention(nn.Module):
                 self.n_local_kv_heads,
                 self.head_dim,
             )
-        ).cuda()
+        )
         self.cache_v = torch.zeros(
             (
                 args.max_batch_size,
@@ -140,14 +302,15 @@ class Attention(nn.Module):
                 self.n_local_kv_heads,
                 self.head_dim,
             )
-        ).cuda()
+        )
 
     def forward(
         self,
         x: torch.Tensor,
         start_pos: int,
-        freqs_cis: torch.Tensor,
+        freqs_cis: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
         mask: Optional[torch.Tensor],
+        slots: Optional[torch.Tensor] = None,
     ):
         bsz, seqlen, _ = x.shape
         xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
@@ -156,16 +319,35 @@ class Attention(nn.Module):
         xk = xk.view(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
         xv = xv.view(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
 
-        xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
+        if self.rope_tables:
+            apply_rotary_emb_(xq, freqs_cis)
+            apply_rotary_emb_(xk, freqs_cis)
+        else:
+            xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
+
+        if self.kv_cache is None:
+            self.cache_k = self.cache_k.to(xq)
+            self.cache_v = self.cache_v.to(xq)
+
+        if self.kv_cache is not None:
+            # the positions written and read were set by Transformer.forward
+            keys, values = self.kv_cache.update(self.layer_id, xk, xv)
+        elif slots is None:
+            self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
+            self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
 
-        self.cache_k = self.cache_k.to(xq)
-        self.cache_v = self.cache_v.to(xq)
+            keys = self.cache_k[:bsz, : start_pos + seqlen]
+            values = self.cache_v[:bsz, : start_pos + seqlen]
+        else:
+            # row i lives in cache row slots[i], start_pos holds the position of each token
+            self.cache_k[slots[:, None], start_pos] = xk
+            self.cache_v[slots[:, None], start_pos] = xv
 
-        self.cache_k[:bsz, start_pos : start_pos + seqlen] = xk
-        self.cache_v[:bsz, start_pos : start_pos + seqlen] = xv
+            keys = self.cache_k[slots, : mask.size(-1)]
+            values = self.cache_v[slots, : mask.size(-1)]
 
-        keys = self.cache_k[:bsz, : start_pos + seqlen]
-        values = self.cache_v[:bsz, : start_pos + seqlen]
+        if self.fused_attention:
+            return self.wo(self.fused_attention_forward(xq, keys, values, mask))
 
         # repeat k/v heads if n_kv_heads < n_heads
         keys = repeat_kv(keys, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
@@ -182,6 +364,34 @@ class Attention(nn.Module):
         output = output.transpose(1, 2).contiguous().view(bsz, seqlen, -1)
         return self.wo(output)
 
+    def fused_attention_forward(
+        self,
+        xq: torch.Tensor,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        # scaled_dot_product_attention; the n_rep query heads of a KV head are stacked along
+        # the query positions, so that they attend to the same keys and values without a copy
+        bsz, seqlen, _, head_dim = xq.shape
+        xq = (
+            xq.view(bsz, seqlen, self.n_local_kv_heads, self.n_rep, head_dim)
+            .permute(0, 2, 3, 1, 4)
+            .reshape(bsz, self.n_local_kv_heads, self.n_rep * seqlen, head_dim)
+        )
+        if mask is not None:
+            mask = mask.repeat(1, 1, self.n_rep, 1)
+        output = F.scaled_dot_product_attention(
+            xq, keys.transpose(1, 2), values.transpose(1, 2), attn_mask=mask
+        )  # (bs, n_local_kv_heads, n_rep * seqlen, head_dim)
+        output = output.view(bsz, self.n_local_kv_heads, self.n_rep, seqlen, head_dim)
+        return output.permute(0, 3, 1, 2, 4).reshape(bsz, seqlen, -1)
+
+    def compact_cache(self, rows: torch.Tensor, length: int):
+        # keeps the first length positions of the cache rows rows, moved to rows 0..len(rows)-1
+        self.cache_k[: len(rows), :length] = self.cache_k[rows, :length]
+        self.cache_v[: len(rows), :length] = self.cache_v[rows, :length]
+
 
 class FeedForward(nn.Module):
     def __init__(
@@ -213,12 +423,12 @@ class FeedForward(nn.Module):
 
 
 class TransformerBlock(nn.Module):
-    def __init__(self, layer_id: int, args: ModelArgs):
+    def __init__(self, layer_id: int, args: ModelArgs, kv_cache: Optional[PagedKVCache] = None):
         super().__init__()
         self.n_heads = args.n_heads
         self.dim = args.dim
         self.head_dim = args.dim // args.n_heads
-        self.attention = Attention(args)
+        self.attention = Attention(args, kv_cache, layer_id)
         self.feed_forward = FeedForward(
             dim=args.dim,
             hidden_dim=4 * args.dim,
@@ -233,11 +443,12 @@ class TransformerBlock(nn.Module):
         self,
         x: torch.Tensor,
         start_pos: int,
-        freqs_cis: torch.Tensor,
+        freqs_cis: Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]],
         mask: Optional[torch.Tensor],
+        slots: Optional[torch.Tensor] = None,
     ):
         h = x + self.attention.forward(
-            self.attention_norm(x), start_pos, freqs_cis, mask
+            self.attention_norm(x), start_pos, freqs_cis, mask, slots
         )
         out = h + self.feed_forward.forward(self.ffn_norm(h))
         return out
@@ -254,35 +465,114 @@ class Transformer(nn.Module):
             params.vocab_size, params.dim, init_method=lambda x: x
         )
 
+        self.kv_cache = None
+        if params.kv_block_size is not None:
+            n_kv_heads = params.n_heads if params.n_kv_heads is None else params.n_kv_heads
+            self.kv_cache = PagedKVCache(
+                params,
+                n_kv_heads // fs_init.get_model_parallel_world_size(),
+                params.dim // params.n_heads,
+            )
+
         self.layers = torch.nn.ModuleList()
         for layer_id in range(params.n_layers):
-            self.layers.append(TransformerBlock(layer_id, params))
+            self.layers.append(TransformerBlock(layer_id, params, self.kv_cache))
 
         self.norm = RMSNorm(params.dim, eps=params.norm_eps)
         self.output = ColumnParallelLinear(
             params.dim, params.vocab_size, bias=False, init_method=lambda x: x
         )
 
-        self.freqs_cis = precompute_freqs_cis(
-            self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
+        if params.rope_tables:
+            # a buffer: on the device and in the dtype of the model
+            rope = precompute_rope_tables(
+                self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
+            )
+            self.register_buffer("rope", rope.to(torch.get_default_dtype()), persistent=False)
+        else:
+            self.freqs_cis = precompute_freqs_cis(
+                self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
+            )
+
+    def rotary_embedding(self, positions: Any):
+        # positions: a slice, or a tensor of positions (one row per row of tokens);
+        # the tables of apply_rotary_emb_ (with a heads dimension), shared by the layers
+        if not self.params.rope_tables:
+            return self.freqs_cis[positions]
+        rope = self.rope[positions].unsqueeze(-3)
+        if rope.dtype == torch.float32:
+            # a single complex product per tensor
+            return torch.view_as_complex(rope)
+        cos, sin = rope.unbind(-1)
+        return (
+            torch.stack((cos, cos), dim=-1).flatten(-2),
+            torch.stack((-sin, sin), dim=-1).flatten(-2),
         )
 
     @torch.inference_mode()
-    def forward(self, tokens: torch.Tensor, start_pos: int):
+    def forward(
+        self,
+        tokens: torch.Tensor,
+        start_pos: Any,
+        slots: Optional[torch.Tensor] = None,
+    ):
+        # slots: cache row of each row of tokens (continuous batching), whose
+        # start_pos is then a tensor holding the position of the first token of each row
         _bsz, seqlen = tokens.shape
         h = self.tok_embeddings(tokens)
-        self.freqs_cis = self.freqs_cis.to(h.device)
-        freqs_cis = self.freqs_cis[start_pos : start_pos + seqlen]
-
-        mask = None
-        if seqlen > 1:
+        if not self.params.rope_tables:
+            self.freqs_cis = self.freqs_cis.to(h.device)
+        if self.kv_cache is not None:
+            if slots is not None:
+                self.kv_cache.prepare(slots.tolist(), start_pos.tolist(), seqlen, tokens.device)
+            else:
+                self.kv_cache.prepare(list(range(_bsz)), [start_pos] * _bsz, seqlen, tokens.device)
+
+        if slots is not None:
+            start_pos = start_pos[:, None] + torch.arange(seqlen, device=tokens.device)
+            freqs_cis = self.rotary_embedding(start_pos)
+            # each row attends to its own cache row, up to the position of each token
+            kv_len = int(start_pos.max()) + 1
             mask = torch.full(
-                (1, 1, seqlen, seqlen), float("-inf"), device=tokens.device
+                (_bsz, 1, seqlen, kv_len), float("-inf"), device=tokens.device
             )
-            mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
+            visible = torch.arange(kv_len, device=tokens.device) <= start_pos[:, None, :, None]
+            mask = mask.masked_fill(visible, 0.0).type_as(h)
+        else:
+            freqs_cis = self.rotary_embedding(slice(start_pos, start_pos + seqlen))
+
+            mask = None
+            if seqlen > 1:
+                mask = torch.full(
+                    (1, 1, seqlen, seqlen), float("-inf"), device=tokens.device
+                )
+                mask = torch.triu(mask, diagonal=start_pos + 1).type_as(h)
 
         for layer in self.layers:
-            h = layer(h, start_pos, freqs_cis, mask)
+            h = layer(h, start_pos, freqs_cis, mask, slots)
         h = self.norm(h)
         output = self.output(h).float()
         return output
+
+    def compact_cache(self, rows: torch.Tensor, length: int):
+        # drops the rows of finished sequences from the KV cache: row i of the next
+        # batch is the row rows[i] of the previous one
+        if self.kv_cache is not None:
+            self.kv_cache.compact(rows.tolist())
+            return
+        for layer in self.layers:
+            layer.attention.compact_cache(rows, length)
+
+    def free_cache(self, rows: List[int]):
+        # the blocks of the rows go back to the paged KV cache
+        if self.kv_cache is not None:
+            self.kv_cache.free(rows)
+
+    def reset_cache(self):
+        self.free_cache(list(range(self.params.max_batch_size)))
+
+    def cache_stats(self) -> dict:
+        # utilization of the paged KV cache (memory in bytes)
+        if self.kv_cache is None:
+            return {}
+        return self.kv_cache.stats()
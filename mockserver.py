@@ -0,0 +1,233 @@
+import argparse
+import email
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# local stand-in for the chat APIs, to test run.py without API keys or network access:
+# OpenAI-compatible chat completions (OpenAI, DeepSeek, Moonshot, xAI) and Anthropic messages,
+# e.g. python run.py --model gpt-4o --concurrency 8 --base_url http://127.0.0.1:8001/v1,
+# and the OpenAI (files + batches) and Anthropic (messages/batches) batch APIs for run.py --batch
+
+def mock_answer(user_prompt):
+    # deterministic answer tagged with a checksum of the prompt, so that a stored
+    # response can be matched to the scenario it was asked for
+    checksum = zlib.crc32(user_prompt.encode())
+    return "Case {} ({:08x})".format(1 + checksum % 2, checksum)
+
+class MockAPIServer(ThreadingHTTPServer):
+    def __init__(self, address, delay=0.0, rate_limit_every=0, retry_after=0.1, batch_polls=2, batch_fail_every=0):
+        super().__init__(address, MockAPIRequestHandler)
+        # seconds taken by each answer
+        self.delay = delay
+        # every rate_limit_every-th request is answered 429 with a Retry-After header (0: never)
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.nb_requests = 0
+        self.nb_rate_limited = 0
+        # requests being answered and maximum reached, per model
+        self.in_flight = {}
+        self.max_in_flight = {}
+        # a batch ends once its status has been checked batch_polls times
+        self.batch_polls = batch_polls
+        # every batch_fail_every-th request of a batch fails the first time its custom_id is submitted (0: never)
+        self.batch_fail_every = batch_fail_every
+        self.files = {}
+        self.batches = {}
+        self.batch_failed = set()
+
+    @property
+    def url(self):
+        return "http://{}:{}/v1".format(*self.server_address[:2])
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.nb_requests, "rate_limited": self.nb_rate_limited, "max_in_flight": dict(self.max_in_flight),
+                    "batches": len(self.batches), "batch_requests": sum(len(batch["results"]) for batch in self.batches.values())}
+
+    def admit(self, model):
+        # False when the request is rate limited
+        with self.lock:
+            self.nb_requests += 1
+            if self.rate_limit_every and self.nb_requests % self.rate_limit_every == 0:
+                self.nb_rate_limited += 1
+                return False
+            self.in_flight[model] = self.in_flight.get(model, 0) + 1
+            self.max_in_flight[model] = max(self.max_in_flight.get(model, 0), self.in_flight[model])
+            return True
+
+    def release(self, model):
+        with self.lock:
+            self.in_flight[model] -= 1
+
+    def add_file(self, content):
+        with self.lock:
+            file_id = "file-{}".format(len(self.files))
+            self.files[file_id] = content
+            return file_id
+
+    def add_batch(self, provider, requests):
+        # requests: list of (custom_id, user prompt); returns the batch id
+        with self.lock:
+            batch_id = ("batch_{}" if provider == "openai" else "msgbatch_{}").format(len(self.batches))
+            results = []
+            for k, (custom_id, user_prompt) in enumerate(requests):
+                failed = self.batch_fail_every and k % self.batch_fail_every == self.batch_fail_every - 1 and (provider, custom_id) not in self.batch_failed
+                if failed:
+                    self.batch_failed.add((provider, custom_id))
+                results.append((custom_id, None if failed else mock_answer(user_prompt)))
+            self.batches[batch_id] = {"provider": provider, "results": results, "polls": 0}
+            return batch_id
+
+    def poll_batch(self, batch_id):
+        # True once the batch has ended
+        with self.lock:
+            batch = self.batches[batch_id]
+            batch["polls"] += 1
+            return batch["polls"] > self.batch_polls
+
+class MockAPIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def send_jsonl(self, records):
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/binary")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        batches = self.server.batches
+        if self.path == "/stats":
+            self.send_json(200, self.server.stats())
+        elif (match := re.search(r"/messages/batches/([^/]+)/results$", self.path)) and match.group(1) in batches:
+            self.send_jsonl(self.message_batch_results(match.group(1)))
+        elif (match := re.search(r"/messages/batches/([^/]+)$", self.path)) and match.group(1) in batches:
+            self.send_json(200, self.message_batch(match.group(1), self.server.poll_batch(match.group(1))))
+        elif (match := re.search(r"/batches/([^/]+)$", self.path)) and match.group(1) in batches:
+            self.send_json(200, self.batch(match.group(1), self.server.poll_batch(match.group(1))))
+        elif (match := re.search(r"/files/([^/]+)/content$", self.path)) and match.group(1) in self.server.files:
+            self.send_jsonl(self.server.files[match.group(1)])
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if self.path.endswith("/files"):
+            self.upload_file()
+            return
+        body = self.read_json()
+        if self.path.endswith("/messages/batches"):
+            requests = [(request["custom_id"], self.user_prompt(request["params"])) for request in body["requests"]]
+            self.send_json(200, self.message_batch(self.server.add_batch("anthropic", requests), False))
+        elif self.path.endswith("/batches"):
+            requests = [(request["custom_id"], request["body"]["messages"][-1]["content"]) for request in self.server.files[body["input_file_id"]]]
+            self.send_json(200, self.batch(self.server.add_batch("openai", requests), False))
+        elif self.path.endswith("/chat/completions"):
+            self.chat(body, body["messages"][-1]["content"], self.chat_completion)
+        elif self.path.endswith("/messages"):
+            self.chat(body, self.user_prompt(body), self.message)
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def user_prompt(self, body):
+        content = body["messages"][-1]["content"]
+        return content if isinstance(content, str) else "".join(block["text"] for block in content)
+
+    def upload_file(self):
+        # multipart/form-data upload of a JSONL batch input file
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        message = email.message_from_bytes(b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + data)
+        content = next(part.get_payload(decode=True) for part in message.get_payload() if part.get_filename())
+        records = [json.loads(line) for line in content.decode().splitlines() if line.strip()]
+        self.send_json(200, {"id": self.server.add_file(records), "object": "file", "bytes": len(content), "created_at": 0,
+                             "filename": "batch.jsonl", "purpose": "batch", "status": "processed"})
+
+    def chat(self, body, user_prompt, response):
+        model = body.get("model")
+        if not self.server.admit(model):
+            self.send_json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "rate limited by the mock server"}},
+                           {"retry-after": str(self.server.retry_after)})
+            return
+        try:
+            time.sleep(self.server.delay)
+        finally:
+            self.server.release(model)
+        self.send_json(200, response(model, mock_answer(user_prompt)))
+
+    def chat_completion(self, model, text):
+        return {
+            "id": "chatcmpl-mock", "object": "chat.completion", "created": 0, "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }
+
+    def message(self, model, text):
+        return {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": model,
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": 1, "output_tokens": 1},
+        }
+
+    def batch(self, batch_id, ended):
+        # OpenAI batch object; the failed requests are returned with a 500 status in the output file
+        batch = self.server.batches[batch_id]
+        if ended and "output_file_id" not in batch:
+            batch["output_file_id"] = self.server.add_file([{
+                "id": "batch_req_{}".format(k), "custom_id": custom_id, "error": None,
+                "response": {"status_code": 200, "request_id": "req_mock", "body": self.chat_completion(None, text)} if text is not None else
+                            {"status_code": 500, "request_id": "req_mock", "body": {"error": {"message": "failed by the mock server"}}},
+            } for k, (custom_id, text) in enumerate(batch["results"])])
+        return {"id": batch_id, "object": "batch", "endpoint": "/v1/chat/completions", "input_file_id": "file-mock", "completion_window": "24h",
+                "status": "completed" if ended else "in_progress", "created_at": 0, "output_file_id": batch.get("output_file_id")}
+
+    def message_batch(self, batch_id, ended):
+        # Anthropic message batch object
+        results = self.server.batches[batch_id]["results"]
+        errored = sum(text is None for _, text in results)
+        counts = {"processing": 0, "succeeded": len(results) - errored, "errored": errored} if ended else {"processing": len(results), "succeeded": 0, "errored": 0}
+        return {"id": batch_id, "type": "message_batch", "processing_status": "ended" if ended else "in_progress",
+                "request_counts": {**counts, "canceled": 0, "expired": 0}, "created_at": "2025-01-01T00:00:00Z", "expires_at": "2025-01-02T00:00:00Z",
+                "ended_at": "2025-01-01T00:00:00Z" if ended else None, "archived_at": None, "cancel_initiated_at": None,
+                "results_url": "{}/messages/batches/{}/results".format(self.server.url, batch_id) if ended else None}
+
+    def message_batch_results(self, batch_id):
+        return [{"custom_id": custom_id, "result": {"type": "succeeded", "message": self.message(None, text)} if text is not None else
+                 {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "failed by the mock server"}}}}
+                for custom_id, text in self.server.batches[batch_id]["results"]]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default='8001', type=int)
+    parser.add_argument('--delay', default='0.2', type=float, help='seconds taken by each answer')
+    parser.add_argument('--rate_limit_every', default='0', type=int, help='answer every N-th request with 429 (0: never)')
+    parser.add_argument('--retry_after', default='0.1', type=float)
+    parser.add_argument('--batch_polls', default='2', type=int, help='status checks before a batch ends')
+    parser.add_argument('--batch_fail_every', default='0', type=int, help='fail every N-th request of a batch, once per request (0: never)')
+    args = parser.parse_args()
+
+    server = MockAPIServer((args.host, args.port), delay=args.delay, rate_limit_every=args.rate_limit_every, retry_after=args.retry_after,
+                           batch_polls=args.batch_polls, batch_fail_every=args.batch_fail_every)
+    print("mock API on {} (statistics: GET /stats)".format(server.url))
+    server.serve_forever()
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import threading
+import time
+
+# budgets per provider, refined by model name: for each of rpm (requests per minute) and
+# tpm (tokens per minute), the longest matching key that sets it wins (None: unlimited).
+# The defaults are conservative starting values (about the first paid tier of each provider);
+# set your own quotas with --rate_limit or --rate_limits (see configure_rate_limits)
+RATE_LIMITS = {
+    "anthropic": {"rpm": 50, "tpm": 50000},
+    "gemini": {"rpm": 1000, "tpm": 1000000},
+    "gemini-2.5-pro": {"rpm": 150, "tpm": 2000000},
+    "palm": {"rpm": 60, "tpm": None},
+    "xai": {"rpm": 60, "tpm": None},
+}
+
+def parse_budget(value):
+    value = value.strip().lower()
+    return None if value in ("none", "unlimited") else int(value)
+
+def parse_rate_limit(value):
+    # "key=rpm:tpm", "key=rpm" or "key=:tpm" (key: provider or model name, "none": unlimited);
+    # returns (key, limits) with only the budgets given
+    key, sep, budgets = value.partition("=")
+    if not key.strip() or not sep:
+        raise ValueError("rate limit {!r}: expected key=rpm:tpm".format(value))
+    rpm, _, tpm = budgets.partition(":")
+    limits = {}
+    try:
+        if rpm.strip():
+            limits["rpm"] = parse_budget(rpm)
+        if tpm.strip():
+            limits["tpm"] = parse_budget(tpm)
+    except ValueError:
+        raise ValueError("rate limit {!r}: budgets must be integers or none".format(value))
+    return key.strip().lower(), limits
+
+def load_rate_limits(file_name):
+    # JSON file of the same form as RATE_LIMITS, e.g. {"gemini-2.5-pro": {"rpm": 150, "tpm": 2000000}}
+    with open(file_name) as f:
+        entries = json.load(f)
+    return {key.lower(): {name: limits[name] for name in ("rpm", "tpm") if name in limits} for key, limits in entries.items()}
+
+def configure_rate_limits(overrides):
+    # overrides: {key: limits}; the budgets given replace those of RATE_LIMITS
+    # (to call before the first limiter of the key is created)
+    for key, limits in overrides.items():
+        RATE_LIMITS.setdefault(key, {}).update(limits)
+
+def resolve_rate_limits(provider, model):
+    matches = sorted((k for k in RATE_LIMITS if k == provider or k in model.lower()), key=len, reverse=True)
+    limits = {}
+    for name in ("rpm", "tpm"):
+        limits[name] = next((RATE_LIMITS[k][name] for k in matches if name in RATE_LIMITS[k]), None)
+    return limits
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        # rate: tokens refilled per second, capacity: maximum burst
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        # takes the tokens now (the balance may go negative) and returns how long
+        # the caller has to wait before they are actually available
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+class RateLimiter:
+    # requests-per-minute and tokens-per-minute budgets; safe across threads and asyncio tasks
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_bucket = TokenBucket(rpm / 60, rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm / 60, tpm) if tpm else None
+
+    def _reserve(self, tokens):
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and tokens > 0:
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        return wait
+
+    def acquire(self, tokens=0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record_usage(self, tokens_used, tokens_reserved):
+        # corrects the token budget once the actual usage of a request is known
+        if self.token_bucket is not None and tokens_used is not None:
+            self.token_bucket.refund(tokens_reserved - tokens_used)
+
+def estimate_tokens(text):
+    # rough estimate (about 4 characters per token) used before the actual usage is known
+    return len(text) // 4 + 1
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider, model, rpm=None, tpm=None):
+    # one limiter per (provider, model), shared by every ChatBotManager in the process;
+    # rpm/tpm override the budgets of RATE_LIMITS
+    with _rate_limiters_lock:
+        key = (provider, model)
+        if key not in _rate_limiters:
+            limits = resolve_rate_limits(provider, model)
+            _rate_limiters[key] = RateLimiter(
+                rpm=rpm if rpm is not None else limits.get("rpm"),
+                tpm=tpm if tpm is not None else limits.get("tpm"),
+            )
+        return _rate_limiters[key]
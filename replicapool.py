@@ -0,0 +1,167 @@
+import argparse
+import importlib
+import json
+import os
+import pickle
+import subprocess
+import sys
+from multiprocessing.connection import wait
+
+# data parallelism for local models: one ChatModel replica per worker process, each pinned to
+# its own devices (or CPU cores), instead of one replica spread over every device by device_map="auto"
+# (the workers run this file, so that they do not import the script that started them)
+
+def default_devices(nb_replicas):
+    # one GPU per replica (round-robin), or CPU replicas
+    import torch
+    if torch.cuda.is_available():
+        return [str(r % torch.cuda.device_count()) for r in range(nb_replicas)]
+    return ["cpu"] * nb_replicas
+
+def replica_cores(replica_id, nb_replicas):
+    # the CPU cores split evenly between the replicas (shared when there are fewer cores than replicas)
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < nb_replicas:
+        return [cores[replica_id % len(cores)]]
+    size = len(cores) // nb_replicas
+    return cores[replica_id * size:(replica_id + 1) * size]
+
+class Replica:
+    # a worker process; tasks and results are pickled over its stdin and stdout
+    def __init__(self, replica_id, loader, model, options, devices, cores):
+        self.replica_id = replica_id
+        env = dict(os.environ)
+        # set before CUDA is initialized in the worker
+        env["CUDA_VISIBLE_DEVICES"] = "" if devices == "cpu" else devices
+        command = [sys.executable, os.path.abspath(__file__), "--replica_id", str(replica_id), "--loader", loader,
+                   "--model", model, "--options", json.dumps(options)]
+        if cores is not None:
+            command += ["--cores", ",".join(str(core) for core in cores)]
+        self.process = subprocess.Popen(command, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.task_id = None
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def send(self, task):
+        pickle.dump(task, self.process.stdin)
+        self.process.stdin.flush()
+
+    def receive(self):
+        try:
+            return pickle.load(self.process.stdout)
+        except EOFError:
+            raise RuntimeError("replica {} exited (status {})".format(self.replica_id, self.process.wait()))
+
+class ReplicaPool:
+    # same interface as ChatModel (chat, chat_batch, group_by_length); the batches of a chat_batch call
+    # are queued and each replica takes the next one as soon as it is idle, so that the replicas given
+    # short responses take over the remaining work; the responses keep the order of the prompts
+    def __init__(self, model, nb_replicas, batch_size=1, devices=None, loader="chatmodel:ChatModel", **options):
+        self.model = model
+        # number of prompts of the batches taken by the replicas
+        self.batch_size = batch_size
+        if devices is None:
+            devices = default_devices(nb_replicas)
+        if len(devices) != nb_replicas:
+            raise ValueError("{} device sets for {} replicas".format(len(devices), nb_replicas))
+        self.replicas = [
+            Replica(replica_id, loader, model, options, replica_devices, replica_cores(replica_id, nb_replicas) if replica_devices == "cpu" else None)
+            for replica_id, replica_devices in enumerate(devices)
+        ]
+
+        # every replica reports its sampling parameters once loaded
+        try:
+            sampling_params = [replica.receive() for replica in self.replicas]
+        except RuntimeError:
+            self.close()
+            raise RuntimeError("failed to load {}".format(model))
+        self.sampling_params = sampling_params[0]
+
+    def run(self, method, args_list):
+        # runs the tasks on the replicas; returns their results in order
+        tasks = list(enumerate(args_list))[::-1]
+        results = {}
+        idle = list(self.replicas)
+        while len(results) < len(args_list):
+            while tasks and idle:
+                replica = idle.pop()
+                replica.task_id, args = tasks.pop()
+                replica.send((method, args))
+            for replica in wait([replica for replica in self.replicas if replica.task_id is not None]):
+                results[replica.task_id] = replica.receive()
+                replica.task_id = None
+                idle.append(replica)
+        for result in results.values():
+            if isinstance(result, Exception):
+                raise result
+        return [results[k] for k in range(len(args_list))]
+
+    def chat(self, system_prompt, user_prompt, stats=None):
+        return self.chat_batch([(system_prompt, user_prompt)], [stats] if stats is not None else None)[0]
+
+    def chat_batch(self, prompts, stats=None):
+        batches = [prompts[k:k + self.batch_size] for k in range(0, len(prompts), self.batch_size)]
+        responses = []
+        batch_stats = []
+        for batch_responses, s in self.run("chat_batch", [(batch,) for batch in batches]):
+            responses += batch_responses
+            batch_stats += s
+        if stats is not None:
+            for s, row_stats in zip(stats, batch_stats):
+                s.update(row_stats)
+        return responses
+
+    def group_by_length(self, prompts, batch_size):
+        return self.run("group_by_length", [(prompts, batch_size)])[0]
+
+    def close(self):
+        for replica in self.replicas:
+            if replica.process.poll() is None:
+                replica.process.stdin.close()
+        for replica in self.replicas:
+            try:
+                replica.process.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                replica.process.kill()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replica_id', required=True, type=int)
+    parser.add_argument('--loader', required=True, type=str)
+    parser.add_argument('--model', required=True, type=str)
+    parser.add_argument('--options', default='{}', type=str)
+    parser.add_argument('--cores', default=None, type=str)
+    args = parser.parse_args()
+
+    # results go to the original stdout; anything printed goes to stderr
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    import torch
+    if args.cores is not None:
+        cores = [int(core) for core in args.cores.split(",")]
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+
+    module, name = args.loader.split(":")
+    chat_model = getattr(importlib.import_module(module), name)(args.model, **json.loads(args.options))
+    pickle.dump(chat_model.sampling_params, channel)
+    channel.flush()
+
+    while True:
+        try:
+            method, task_args = pickle.load(sys.stdin.buffer)
+        except EOFError:
+            break
+        try:
+            if method == "chat_batch":
+                stats = [{"replica": args.replica_id} for _ in task_args[0]]
+                result = (chat_model.chat_batch(task_args[0], stats), stats)
+            else:
+                result = getattr(chat_model, method)(*task_args)
+        except Exception as e:
+            # sent as text (the exception may not be picklable)
+            result = RuntimeError("replica {}: {}: {}".format(args.replica_id, type(e).__name__, e))
+        pickle.dump(result, channel)
+        channel.flush()
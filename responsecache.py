@@ -0,0 +1,135 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+class ResponseCache:
+    # persistent response cache keyed by a hash of the full request
+    def __init__(self, file_name, max_size=None):
+        self.file_name = file_name
+        # maximum total size of the cached responses in bytes (None: unbounded)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(self.file_name, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, system_prompt, user_prompt, params=None, sample_index=0, endpoint=None):
+        # endpoint: API endpoint of the model (None for local models, whose keys it leaves unchanged)
+        request = {
+            "model": model,
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "params": params,
+            "sample_index": sample_index,
+        }
+        if endpoint is not None:
+            request["endpoint"] = endpoint
+        request = json.dumps(request, sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode())
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, response, size, time.time()))
+            self.size += size - (old[0] if old is not None else 0)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # drop the least recently used responses until the cache fits in max_size
+        while self.max_size is not None and self.size > self.max_size:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.size -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        nb_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / nb_lookups if nb_lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size": self.size,
+        }
+
+    def close(self):
+        self.conn.close()
+
+class CachedChatModel:
+    # wraps a ChatBotManager or ChatModel; failed requests (None) are not cached
+    def __init__(self, chat_model, cache):
+        self.chat_model = chat_model
+        self.cache = cache
+
+    def cache_key(self, system_prompt, user_prompt, sample_index):
+        # sample_index keeps stochastic repeats of the same prompt distinct
+        params = getattr(self.chat_model, "sampling_params", None)
+        endpoint = getattr(self.chat_model, "endpoint", None)
+        return self.cache.make_key(self.chat_model.model, system_prompt, user_prompt, params, sample_index, endpoint)
+
+    def chat(self, system_prompt, user_prompt, sample_index=0, stats=None):
+        key = self.cache_key(system_prompt, user_prompt, sample_index)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.chat_model.chat(system_prompt, user_prompt, stats=stats)
+            if response is not None:
+                self.cache.put(key, response)
+        return response
+
+    async def achat(self, system_prompt, user_prompt, sample_index=0, stats=None):
+        key = self.cache_key(system_prompt, user_prompt, sample_index)
+        response = self.cache.get(key)
+        if response is None:
+            response = await self.chat_model.achat(system_prompt, user_prompt, stats=stats)
+            if response is not None:
+                self.cache.put(key, response)
+        return response
+
+    def chat_batch(self, prompts, sample_indices=None, stats=None):
+        # only the prompts missing from the cache are generated (as one batch)
+        sample_indices = sample_indices if sample_indices is not None else [0] * len(prompts)
+        keys = [self.cache_key(system_prompt, user_prompt, i) for (system_prompt, user_prompt), i in zip(prompts, sample_indices)]
+        responses = [self.cache.get(key) for key in keys]
+        missing = [k for k, response in enumerate(responses) if response is None]
+        if missing:
+            generated = self.chat_model.chat_batch([prompts[k] for k in missing], [stats[k] for k in missing] if stats is not None else None)
+            for k, response in zip(missing, generated):
+                responses[k] = response
+                if response is not None:
+                    self.cache.put(keys[k], response)
+        return responses
+
+    def group_by_length(self, prompts, batch_size):
+        return self.chat_model.group_by_length(prompts, batch_size)
@@ -0,0 +1,45 @@
+import json
+import os
+
+class ResultStore:
+    # append-only JSONL shard: one line per completed scenario, tagged with its scenario index
+    def __init__(self, file_name, resume=False):
+        self.file_name = file_name
+
+        if resume and os.path.exists(self.file_name):
+            self._drop_partial_line()
+        else:
+            open(self.file_name, 'w').close()
+
+        self.file = open(self.file_name, 'a')
+
+    def _drop_partial_line(self):
+        # a crash in the middle of a write leaves an unterminated last line
+        with open(self.file_name, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def records(self):
+        self.file.flush()
+        with open(self.file_name) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def completed_indices(self):
+        return {record['index'] for record in self.records()}
+
+    def append(self, index, scenario_info):
+        self.file.write(json.dumps({'index': index, **scenario_info}) + '\n')
+        self.file.flush()
+
+    def to_dataframe(self):
+        # rows are ordered and indexed by scenario index, whatever the completion order was
+        import pandas as pd
+        df = pd.DataFrame(list(self.records()))
+        if len(df) > 0:
+            df = df.drop_duplicates(subset='index', keep='last').set_index('index').sort_index().rename_axis(None)
+        return df
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,177 @@
+import asyncio
+import datetime
+import email.utils
+import random
+import re
+import sys
+import time
+
+RETRY = "retry"
+GIVE_UP = "give_up"
+FATAL = "fatal"
+
+# HTTP status codes worth retrying (529: Anthropic overloaded)
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# authentication/permission errors: retrying (or continuing the run) is pointless
+FATAL_STATUS = {401, 403}
+# errors without a status code worth retrying: connection failures and timeouts, by module
+# (the SDKs are imported lazily, so only those already imported are checked)
+TRANSPORT_ERRORS = {
+    "httpx": ["TransportError"],
+    "openai": ["APIConnectionError", "APITimeoutError"],
+    "anthropic": ["APIConnectionError", "APITimeoutError"],
+    "requests": ["ConnectionError", "Timeout"],
+}
+
+def status_code(e):
+    # openai/anthropic APIStatusError, requests/httpx HTTP errors and google.api_core errors
+    code = getattr(e, "status_code", None)
+    if code is None and getattr(e, "response", None) is not None:
+        code = getattr(e.response, "status_code", None)
+    if code is None and isinstance(getattr(e, "code", None), int):
+        code = e.code
+    return code
+
+def is_transport_error(e):
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    for module_name, names in TRANSPORT_ERRORS.items():
+        module = sys.modules.get(module_name)
+        if module is not None and isinstance(e, tuple(getattr(module, name) for name in names if hasattr(module, name))):
+            return True
+    return False
+
+def response_headers(e):
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    return headers if headers is not None else {}
+
+def parse_duration(value):
+    # "1.5", "20ms", "1s", "6m0s" (OpenAI reset headers) or an RFC 3339 / HTTP date
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(n) * scale[u] for n, u in parts)
+
+    try:
+        reset = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            reset = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if reset.tzinfo is None:
+        reset = reset.replace(tzinfo=datetime.timezone.utc)
+    return (reset - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+def retry_after(e):
+    # how long the server asks us to wait, if it says so
+    headers = response_headers(e)
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after") is not None:
+        delay = parse_duration(headers["retry-after"])
+        if delay is not None:
+            return max(0.0, delay)
+
+    if status_code(e) == 429:
+        # rate-limit reset headers of the exhausted limits (OpenAI/xAI and Anthropic styles)
+        delays = []
+        for name, value in headers.items():
+            name = name.lower()
+            if name.startswith("x-ratelimit-reset-"):
+                remaining = headers.get(name.replace("-reset-", "-remaining-"))
+            elif name.startswith("anthropic-ratelimit-") and name.endswith("-reset"):
+                remaining = headers.get(name[:-len("-reset")] + "-remaining")
+            else:
+                continue
+            if remaining is not None and remaining.strip() not in ("0", ""):
+                continue
+            delay = parse_duration(value)
+            if delay is not None:
+                delays.append(delay)
+        if delays:
+            return max(0.0, max(delays))
+    return None
+
+class RetryPolicy:
+    # exponential backoff with decorrelated jitter, honoring Retry-After and rate-limit reset headers
+    def __init__(self, max_attempts=20, base_delay=1.0, max_delay=60.0, name=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.name = name
+        # private RNG: jitter must not perturb the global random state
+        self.rng = random.Random()
+
+    def classify(self, e):
+        code = status_code(e)
+        if code is None:
+            # connection errors and timeouts are retried; a blocked (e.g., Gemini SAFETY) or
+            # malformed response would be the same on every attempt
+            return RETRY if is_transport_error(e) else GIVE_UP
+        if code in RETRYABLE_STATUS:
+            return RETRY
+        if code in FATAL_STATUS:
+            return FATAL
+        return GIVE_UP
+
+    def next_delay(self, e, delay):
+        server_delay = retry_after(e)
+        if server_delay is not None:
+            return min(server_delay, self.max_delay)
+        return min(self.max_delay, self.rng.uniform(self.base_delay, delay * 3))
+
+    def backoff(self, e, attempt, delay):
+        # delay before the next attempt, or None to give up
+        if self.classify(e) == GIVE_UP or attempt + 1 == self.max_attempts:
+            print("{}: giving up after {} attempt(s): {}".format(self.name, attempt + 1, e))
+            return None
+
+        delay = self.next_delay(e, delay)
+        print("{}: {} (attempt {}/{}, retrying in {:.1f}s)".format(self.name, e, attempt + 1, self.max_attempts, delay))
+        return delay
+
+    def call(self, request, stats=None):
+        # returns the result of request(), or None once the attempts are exhausted;
+        # fatal errors are re-raised
+        delay = self.base_delay
+        for attempt in range(self.max_attempts):
+            if stats is not None:
+                stats["retries"] = attempt
+            try:
+                return request()
+            except Exception as e:
+                if self.classify(e) == FATAL:
+                    raise
+                delay = self.backoff(e, attempt, delay)
+                if delay is None:
+                    return None
+                time.sleep(delay)
+        return None
+
+    async def acall(self, request, stats=None):
+        # same as call() for a coroutine function
+        delay = self.base_delay
+        for attempt in range(self.max_attempts):
+            if stats is not None:
+                stats["retries"] = attempt
+            try:
+                return await request()
+            except Exception as e:
+                if self.classify(e) == FATAL:
+                    raise
+                delay = self.backoff(e, attempt, delay)
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+        return None
@@ -1,56 +1,279 @@
-import pandas as pd
-import random
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
-from generate_moral_machine_scenarios import generate_moral_machine_scenarios
-from chatapi import ChatBotManager
-from chatmodel import ChatModel
+from generate_moral_machine_scenarios import generate_scenario_set, load_scenario_set
+from resultstore import ResultStore
+from responsecache import ResponseCache, CachedChatModel
+from ratelimit import configure_rate_limits, load_rate_limits, parse_rate_limit
 
 import argparse
 
+def rate_limit_arg(value):
+  try:
+    return parse_rate_limit(value)
+  except ValueError as e:
+    raise argparse.ArgumentTypeError(str(e))
+
 #### Parameters #############
 parser = argparse.ArgumentParser()
 parser.add_argument('--model', default='gpt-3.5-turbo-0613', type=str)
+parser.add_argument('--models', default=None, type=str, help='comma-separated list of models queried over the same scenario set')
 parser.add_argument('--nb_scenarios', default='3', type=int)
 parser.add_argument('--random_seed', default='123', type=int)
+parser.add_argument('--concurrency', default='1', type=int, help='number of API requests in flight (API models only)')
+parser.add_argument('--base_url', default=None, type=str, help='override the API endpoint (e.g., a local mock server)')
+parser.add_argument('--resume', action='store_true', help='continue an interrupted run from its JSONL shard')
+parser.add_argument('--legacy_rng', action='store_true', help='draw all scenarios from one random stream (as in the published experiments)')
+parser.add_argument('--scenario_file', default=None, type=str, help='scenario set materialized by generate_moral_machine_scenarios.py')
+parser.add_argument('--nb_shards', default='1', type=int)
+parser.add_argument('--shard_id', default='0', type=int)
+parser.add_argument('--rate_limit', default=[], action='append', type=rate_limit_arg, help='KEY=RPM:TPM budget of a provider or model (e.g., gemini-2.5-pro=150:2000000; repeatable; overrides the defaults in ratelimit.py)')
+parser.add_argument('--rate_limits', default=None, type=str, help='JSON file of budgets per provider or model (e.g., {"anthropic": {"rpm": 1000, "tpm": 400000}})')
+parser.add_argument('--rpm', default=None, type=int, help='requests per minute budget of every model (overrides the per-provider budgets)')
+parser.add_argument('--tpm', default=None, type=int, help='tokens per minute budget of every model (overrides the per-provider budgets)')
+parser.add_argument('--cache', default=None, type=str, help='SQLite file caching responses across runs')
+parser.add_argument('--cache_max_size', default=None, type=float, help='maximum size of the cached responses in MB')
+parser.add_argument('--batch_size', default='1', type=int, help='number of scenarios generated together (local models only)')
+parser.add_argument('--prefix_cache', action='store_true', help='reuse the KV cache of the prompt prefix shared by scenarios (local models only)')
+parser.add_argument('--scoring', action='store_true', help='score "Case 1"/"Case 2" with one forward pass instead of generating (local non-thinking models only)')
+parser.add_argument('--early_stopping', action='store_true', help='stop generating once an unambiguous answer is given outside <think> (local models only)')
+parser.add_argument('--answer_budget', default=None, type=int, help='maximum number of tokens generated after </think> (local models only)')
+parser.add_argument('--continuous_batching', action='store_true', help='admit waiting scenarios into the batch as soon as a row finishes (local models only, --batch_size running rows)')
+parser.add_argument('--draft_model', default=None, type=str, help='hub id of a small model of the same family drafting tokens for assisted (speculative) decoding (local models only)')
+parser.add_argument('--cpu', action='store_true', help='run the local model on the CPU (no bitsandbytes 4-bit loading)')
+parser.add_argument('--cpu_dtype', default='float32', type=str, choices=['float32', 'bfloat16'], help='weight dtype on the CPU')
+parser.add_argument('--quantization', default=None, type=str, choices=['int8'], help='int8 quantization of the linear layers on the CPU (with --cpu_dtype float32)')
+parser.add_argument('--threads', default=None, type=int, help='CPU threads (default: the cores available to the process)')
+parser.add_argument('--replicas', default='1', type=int, help='number of data-parallel replicas of the local model, one process each')
+parser.add_argument('--replica_devices', default=None, type=str, help='semicolon-separated CUDA device ids of each replica (e.g., "0,1;2,3"), or "cpu" (default: one GPU each)')
+parser.add_argument('--server', default=None, type=str, help='URL of a chatserver.py process serving the local model (loaded once across runs)')
+parser.add_argument('--batch', action='store_true', help='submit the scenarios through the provider batch API (OpenAI and Anthropic models)')
+parser.add_argument('--batch_poll_interval', default='60', type=float, help='seconds between batch status checks')
 args = parser.parse_args()
+# checked here too, so that the run does not fail once the API models are done
+if args.quantization == 'int8' and args.cpu_dtype != 'float32':
+  parser.error('--quantization int8 needs --cpu_dtype float32')
+
+models = args.models.split(",") if args.models is not None else [args.model]
+
+# budgets per provider or model: the file, then the --rate_limit entries in order
+if args.rate_limits is not None:
+  configure_rate_limits(load_rate_limits(args.rate_limits))
+for key, limits in args.rate_limit:
+  configure_rate_limits({key: limits})
+
+def is_api_model(model):
+  return any(s.lower() in model.lower() for s in ["gpt", "o1", "o3", "o4", "gemini", "claude", "palm", "deepseek-chat", "deepseek-reasoner", "deepseek-v4", "grok", "kimi"])
+
+def is_local_model(model):
+  return any(s.lower() in model.lower() for s in ["llama", "vicuna", "gemma", "mistral", "command", "phi", "qwen", "deepseek"])
+
+# only OpenAI and Anthropic have a batch API: checked before any model runs
+if args.batch:
+  from chatapi import BATCH_MAX_REQUESTS, model_provider
+  unsupported = [model for model in models if is_api_model(model) and model_provider(model) not in BATCH_MAX_REQUESTS]
+  if unsupported:
+    parser.error('--batch is only supported for OpenAI and Anthropic models, not {}'.format(', '.join(unsupported)))
+
+cache = None
+if args.cache is not None:
+  cache = ResponseCache(args.cache, max_size=int(args.cache_max_size * 1024 ** 2) if args.cache_max_size is not None else None)
+
+# the backends (and their SDKs, torch, ...) are imported only for the selected models
+def load_api_model(model):
+  from chatapi import ChatBotManager
+  return ChatBotManager(model=model, max_concurrency=args.concurrency, base_url=args.base_url, rpm=args.rpm, tpm=args.tpm)
 
-# load LLM model (API)
-if any(s.lower() in args.model.lower() for s in ["gpt", "o1", "o3", "o4", "gemini", "claude", "palm", "deepseek-chat", "deepseek-reasoner", "deepseek-v4", "grok", "kimi"]):
-  chat_model = ChatBotManager(model=args.model)
-elif any(s.lower() in args.model.lower() for s in ["llama", "vicuna", "gemma", "mistral", "command", "phi", "qwen", "deepseek"]):
-  chat_model = ChatModel(model=args.model)
+def local_model_options():
+  return dict(max_batch_size=args.batch_size, prefix_cache=args.prefix_cache, scoring=args.scoring,
+              early_stopping=args.early_stopping, answer_budget=args.answer_budget,
+              continuous_batching=args.continuous_batching, draft_model=args.draft_model,
+              cpu=args.cpu, cpu_dtype=args.cpu_dtype, quantization=args.quantization, nb_threads=args.threads)
+
+# with continuous batching, each chat_batch call keeps --batch_size rows running over this many batches
+# (the results are stored once all the scenarios of the call are done)
+CONTINUOUS_BATCHING_CHUNK = 8
+# with replicas, each chat_batch call holds this many chunks per replica; idle replicas take the next one
+REPLICA_CHUNKS = 4
+
+def chunk_size():
+  # number of scenarios generated by one ChatModel.chat_batch call
+  return args.batch_size * CONTINUOUS_BATCHING_CHUNK if args.continuous_batching else args.batch_size
+
+def load_chat_model(model):
+  # load LLM model (API)
+  if is_api_model(model):
+    chat_model = load_api_model(model)
+  elif is_local_model(model) and args.server is not None:
+    # the model options (--prefix_cache, --scoring, ...) are those the server was started with
+    from chatserver import ChatServerClient
+    chat_model = ChatServerClient(args.server, model)
+  elif is_local_model(model) and args.replicas > 1:
+    from replicapool import ReplicaPool
+    devices = None
+    if args.replica_devices is not None:
+      devices = args.replica_devices.split(";") if args.replica_devices != "cpu" else ["cpu"] * args.replicas
+    chat_model = ReplicaPool(model, args.replicas, batch_size=chunk_size(), devices=devices, **local_model_options())
+  elif is_local_model(model):
+    from chatmodel import ChatModel
+    chat_model = ChatModel(model=model, **local_model_options())
+  else:
+    raise ValueError("Unsupported model")
+
+  # (scores are not cached: only the response text is)
+  if cache is not None and not (args.scoring and not is_api_model(model)):
+    chat_model = CachedChatModel(chat_model, cache)
+  return chat_model
+
+for model in models:
+  if not is_api_model(model) and not is_local_model(model):
+    raise ValueError("Unsupported model: {}".format(model))
+
+# generate scenarios (once, shared by all models)
+# with --nb_shards, this worker handles a contiguous slice of the scenario indices
+shard_size = -(-args.nb_scenarios // args.nb_shards)
+indices = range(args.shard_id * shard_size, min((args.shard_id + 1) * shard_size, args.nb_scenarios))
+if args.scenario_file is not None:
+  scenario_set = load_scenario_set(args.scenario_file, set(indices))
 else:
-  raise ValueError("Unsupported model")
+  scenario_set = generate_scenario_set(args.random_seed, indices, legacy_rng=args.legacy_rng)
 
 # obtain LLM responses
-file_name = 'results_{}_scenarios_seed{}_{}.pickle'.format(args.nb_scenarios, args.random_seed, args.model)
-random.seed(args.random_seed)
-scenario_info_list = []
-for i in tqdm(range(args.nb_scenarios)):
-  # scenario dimension
-  dimension = random.choice(["species", "social_value", "gender", "age", "fitness", "utilitarianism"])
-  #dimension = "random"
-  # Interventionism #########
-  is_interventionism = random.choice([True, False])
-  # Relationship to vehicle #########
-  is_in_car = random.choice([True, False])
-  # Concern for law #########
-  is_law = random.choice([True, False])
-  
-  # generate a scenario
-  system_content, user_content, scenario_info = generate_moral_machine_scenarios(dimension, is_in_car, is_interventionism, is_law)
-
-  # obtain chatgpt response
-  response = chat_model.chat(system_content, user_content)
-  scenario_info['chat_response'] = response
-  #print(scenario_info)
-
-  scenario_info_list.append(scenario_info)
-
-  if (i+1) % 100 == 0:
-    df = pd.DataFrame(scenario_info_list)
-    df.to_pickle(file_name)
-
-df = pd.DataFrame(scenario_info_list)
-df.to_pickle(file_name)
+def chat_kwargs(chat_model, i):
+  # the scenario index keeps stochastic repeats of the same prompt distinct in the cache
+  return {'sample_index': i} if isinstance(chat_model, CachedChatModel) else {}
+
+def query_scenarios(chat_model, pending, store, desc=None):
+  for i in tqdm(pending, desc=desc):
+    system_content, user_content, scenario_info = scenario_set[i]
+    # obtain chatgpt response
+    # (stats collects per-call information, e.g., the number of retries, stored as extra columns)
+    stats = {}
+    response = chat_model.chat(system_content, user_content, stats=stats, **chat_kwargs(chat_model, i))
+    #print(scenario_info)
+
+    store.append(i, {**scenario_info, 'chat_response': response, **stats})
+
+def query_scenarios_batched(chat_model, pending, store, desc=None):
+  # scenarios of similar prompt length are generated together (less padding)
+  prompts = [scenario_set[i][:2] for i in pending]
+  size = chunk_size() * args.replicas * REPLICA_CHUNKS if args.replicas > 1 else chunk_size()
+  with tqdm(total=len(pending), desc=desc) as pbar:
+    for batch in chat_model.group_by_length(prompts, size):
+      indices = [pending[k] for k in batch]
+      stats = [{} for _ in batch]
+      kwargs = {'sample_indices': indices} if isinstance(chat_model, CachedChatModel) else {}
+      responses = chat_model.chat_batch([prompts[k] for k in batch], stats=stats, **kwargs)
+      for i, response, s in zip(indices, responses, stats):
+        store.append(i, {**scenario_set[i][2], 'chat_response': response, **s})
+      pbar.update(len(batch))
+
+async def query_scenarios_async(chat_model, pending, store, desc=None):
+  async def query(i):
+    system_content, user_content, _ = scenario_set[i]
+    stats = {}
+    response = await chat_model.achat(system_content, user_content, stats=stats, **chat_kwargs(chat_model, i))
+    return i, response, stats
+
+  tasks = [asyncio.create_task(query(i)) for i in pending]
+  for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=desc):
+    i, response, stats = await task
+    store.append(i, {**scenario_set[i][2], 'chat_response': response, **stats})
+
+def query_scenarios_batch(chat_model, pending, store, batch_file):
+  from chatapi import BATCH_MAX_REQUESTS
+  # submitted batch ids are kept in batch_file until their results are merged,
+  # so --resume waits for the batches already submitted instead of submitting them again
+  if args.resume and os.path.exists(batch_file):
+    with open(batch_file) as f:
+      batch_ids = json.load(f)
+  else:
+    requests = [('scenario-{}'.format(i), *scenario_set[i][:2]) for i in pending]
+    size = BATCH_MAX_REQUESTS.get(chat_model.provider, len(requests))
+    batch_ids = [chat_model.submit_batch(requests[k:k + size]) for k in range(0, len(requests), size)]
+    with open(batch_file, 'w') as f:
+      json.dump(batch_ids, f)
+
+  pending = set(pending)
+  for batch_id in batch_ids:
+    chat_model.wait_batch(batch_id, poll_interval=args.batch_poll_interval)
+    results = {int(custom_id.split('-')[1]): response for custom_id, response in chat_model.batch_results(batch_id).items()}
+    for i in sorted(results):
+      if i in pending:
+        store.append(i, {**scenario_set[i][2], 'chat_response': results[i]})
+        pending.remove(i)
+  os.remove(batch_file)
+
+  # failed or expired requests are left out of the store; --resume queries them again
+  if pending:
+    print("{}: {} scenarios missing from the batch results (rerun with --resume)".format(chat_model.model, len(pending)))
+
+def query_local_model(model, pending, store, desc=None):
+  chat_model = load_chat_model(model)
+  query = query_scenarios_batched if args.batch_size > 1 or args.replicas > 1 else query_scenarios
+  query(chat_model, pending, store, desc)
+  # the replicas free their devices before the next model is loaded
+  base_model = chat_model.chat_model if isinstance(chat_model, CachedChatModel) else chat_model
+  if hasattr(base_model, 'close'):
+    base_model.close()
+
+async def run_model(model, gpu_lock):
+  # every completed scenario is appended to a JSONL shard; the pickle is written once at the end
+  file_name = 'results_{}_scenarios_seed{}_{}.pickle'.format(args.nb_scenarios, args.random_seed, model)
+  if args.nb_shards > 1:
+    file_name = file_name.replace('.pickle', '_shard{}of{}.pickle'.format(args.shard_id, args.nb_shards))
+  store = ResultStore(file_name.replace('.pickle', '.jsonl'), resume=args.resume)
+  # the scenario set is regenerated from the seed, so skipping completed indices reproduces the run exactly
+  completed = store.completed_indices()
+  pending = [i for i in sorted(scenario_set) if i not in completed]
+  if completed:
+    print("{}: resuming, {} of {} scenarios already completed".format(model, len(completed), len(scenario_set)))
+
+  desc = model if len(models) > 1 else None
+  if args.batch and is_api_model(model):
+    # the batch API bypasses the response cache and the rate limits
+    if pending:
+      await asyncio.to_thread(query_scenarios_batch, load_api_model(model), pending, store, file_name.replace('.pickle', '.batch.json'))
+  elif is_api_model(model):
+    # API models run in parallel with each other
+    chat_model = load_chat_model(model)
+    if args.concurrency > 1:
+      await query_scenarios_async(chat_model, pending, store, desc)
+    else:
+      await asyncio.to_thread(query_scenarios, chat_model, pending, store, desc)
+  else:
+    # local models take turns on the GPU; each one is loaded only when its turn comes
+    async with gpu_lock:
+      await asyncio.to_thread(query_local_model, model, pending, store, desc)
+
+  # results are indexed by scenario index, so the tables of different models line up
+  df = store.to_dataframe()
+  df.to_pickle(file_name)
+  if 'stopped_early' in df.columns:
+    print("{}: {} of {} scenarios stopped early, {} tokens decoded, up to {} tokens saved".format(
+      model, int(df['stopped_early'].sum()), len(df), int(df['new_tokens'].sum()), int(df['tokens_saved'].sum())))
+  if 'draft_tokens' in df.columns:
+    # tokens per forward pass of the model: the decoding speedup, before the cost of the draft model
+    print("{}: draft acceptance rate {:.3f}, {:.2f} tokens per forward pass".format(
+      model, df['accepted_tokens'].sum() / max(df['draft_tokens'].sum(), 1), df['new_tokens'].sum() / max(df['target_forwards'].sum(), 1)))
+  store.close()
+
+async def run_models():
+  gpu_lock = asyncio.Lock()
+  # a thread per model for asyncio.to_thread: the default executor (min(32, cpus + 4) threads)
+  # would run only a few of the models at a time
+  executor = ThreadPoolExecutor(max_workers=len(models))
+  asyncio.get_running_loop().set_default_executor(executor)
+  try:
+    await asyncio.gather(*(run_model(model, gpu_lock) for model in models))
+  finally:
+    executor.shutdown()
+
+asyncio.run(run_models())
+
+if cache is not None:
+  print("response cache: {}".format(cache.stats()))
+  cache.close()
@@ -0,0 +1,119 @@
+import copy
+import io
+import json
+import os
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from chatmodel import ChatModel
+from generate_moral_machine_scenarios import generate_scenario_set
+
+# special tokens of the Llama 3 chat template, which the tiny models use
+SPECIAL_TOKENS = ["<|begin_of_text|>", "<|end_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>", "<pad>"]
+
+def tiny_tokenizer(vocab_size=512, nb_scenarios=50):
+    # byte-level BPE trained on a few scenarios
+    texts = [system_content + "\n" + user_content for system_content, user_content, _ in generate_scenario_set(0, range(nb_scenarios)).values()]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS, initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(texts, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|begin_of_text|>", eos_token="<|end_of_text|>", pad_token="<pad>")
+
+def tiny_draft_model(generator, nb_layers):
+    # the embeddings, first nb_layers layers and head of a tiny model (same tokenizer)
+    config = copy.deepcopy(generator.config)
+    config.num_hidden_layers = nb_layers
+    draft_generator = LlamaForCausalLM(config).eval()
+    draft_generator.load_state_dict({
+        name: weight for name, weight in generator.state_dict().items()
+        if not name.startswith("model.layers.") or int(name.split(".")[2]) < nb_layers
+    })
+    return draft_generator
+
+def tiny_chat_model(model="llama-3-tiny", seed=0, hidden_size=64, nb_layers=2, draft_layers=None, residual_scale=0.01, **kwargs):
+    # random-weight Llama behind the llama-3 chat template, for CPU benchmarks;
+    # with draft_layers, the layers above the draft_layers first ones only add residual_scale-scaled
+    # updates, so that a draft model made of the first layers mostly agrees with the model
+    tokenizer = tiny_tokenizer()
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=4 * hidden_size,
+        num_hidden_layers=nb_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    generator = LlamaForCausalLM(config).eval()
+    if draft_layers is not None:
+        with torch.no_grad():
+            for layer in generator.model.layers[draft_layers:]:
+                layer.self_attn.o_proj.weight.mul_(residual_scale)
+                layer.mlp.down_proj.weight.mul_(residual_scale)
+        kwargs["draft_generator"] = tiny_draft_model(generator, draft_layers)
+    return ChatModel(model, tokenizer=tokenizer, generator=generator, **kwargs)
+
+def tiny_llama_checkpoint(params, vocab_size, seed=0):
+    # random weights with the names and shapes of a Llama 2 checkpoint (llama/model.py)
+    generator = torch.Generator().manual_seed(seed)
+    dim, head_dim = params["dim"], params["dim"] // params["n_heads"]
+    kv_dim = params.get("n_kv_heads", params["n_heads"]) * head_dim
+    hidden_dim = int(2 * 4 * dim / 3)
+    hidden_dim = params["multiple_of"] * ((hidden_dim + params["multiple_of"] - 1) // params["multiple_of"])
+    shapes = {"tok_embeddings.weight": (vocab_size, dim), "norm.weight": (dim,), "output.weight": (vocab_size, dim)}
+    for layer in range(params["n_layers"]):
+        shapes.update({
+            f"layers.{layer}.attention.wq.weight": (dim, dim),
+            f"layers.{layer}.attention.wk.weight": (kv_dim, dim),
+            f"layers.{layer}.attention.wv.weight": (kv_dim, dim),
+            f"layers.{layer}.attention.wo.weight": (dim, dim),
+            f"layers.{layer}.feed_forward.w1.weight": (hidden_dim, dim),
+            f"layers.{layer}.feed_forward.w2.weight": (dim, hidden_dim),
+            f"layers.{layer}.feed_forward.w3.weight": (hidden_dim, dim),
+            f"layers.{layer}.attention_norm.weight": (dim,),
+            f"layers.{layer}.ffn_norm.weight": (dim,),
+        })
+    return {
+        name: torch.ones(shape) if name.endswith("norm.weight") else torch.randn(shape, generator=generator) / shape[-1] ** 0.5
+        for name, shape in shapes.items()
+    }
+
+def tiny_llama(directory, dim=64, n_layers=2, n_heads=4, n_kv_heads=2, vocab_size=512, max_seq_len=512, max_batch_size=4, seed=0, eos_scale=None, **kwargs):
+    # random-weight Llama 2 checkpoint and SentencePiece tokenizer written to directory,
+    # loaded with the reference implementation (kwargs: device, dtype); eos_scale sets the norm
+    # of the output weights of </s> (the larger, the shorter the sampled responses)
+    import sentencepiece
+    from llama import Llama
+    texts = [system_content + "\n" + user_content for system_content, user_content, _ in generate_scenario_set(0, range(50)).values()]
+    tokenizer_model = io.BytesIO()
+    sentencepiece.SentencePieceTrainer.train(
+        sentence_iterator=iter(texts), model_writer=tokenizer_model, vocab_size=vocab_size,
+        model_type="bpe", byte_fallback=True, minloglevel=2,
+    )
+    with open(os.path.join(directory, "tokenizer.model"), "wb") as f:
+        f.write(tokenizer_model.getvalue())
+
+    params = {"dim": dim, "n_layers": n_layers, "n_heads": n_heads, "n_kv_heads": n_kv_heads, "multiple_of": 32, "norm_eps": 1e-5}
+    with open(os.path.join(directory, "params.json"), "w") as f:
+        json.dump(params, f)
+    checkpoint = tiny_llama_checkpoint(params, vocab_size, seed)
+    if eos_scale is not None:
+        eos_id = sentencepiece.SentencePieceProcessor(model_proto=tokenizer_model.getvalue()).eos_id()
+        eos_weights = checkpoint["output.weight"][eos_id]
+        checkpoint["output.weight"][eos_id] = eos_weights / eos_weights.norm() * eos_scale
+    torch.save(checkpoint, os.path.join(directory, "consolidated.00.pth"))
+    return Llama.build(
+        ckpt_dir=directory,
+        tokenizer_path=os.path.join(directory, "tokenizer.model"),
+        max_seq_len=max_seq_len,
+        max_batch_size=max_batch_size,
+        **kwargs,
+    )